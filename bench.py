@@ -0,0 +1,1870 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарки бота.
+Запуск: python bench.py [имя ...] — без аргументов выполняются все.
+"""
+
+import os
+import re
+import json
+import sys
+import time
+import heapq
+import random
+import subprocess
+import shutil
+import asyncio
+import logging
+import tempfile
+import itertools
+import tracemalloc
+from collections import Counter, defaultdict, deque
+
+import aiohttp
+from aiohttp import web
+
+# Бенчмаркам не нужен настоящий токен и файл базы
+os.environ.setdefault('BOT_TOKEN', '123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA')
+os.environ['DB_PATH'] = ''
+logging.disable(logging.ERROR)
+
+import main
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.dispatcher.webhook import configure_app
+
+
+def report(name, count, seconds):
+    print(f"  {name:<32} {count / seconds:>12,.0f} оп/с  ({seconds * 1000:.1f} мс на {count:,})")
+
+
+# ========== ХРАНИЛИЩЕ ==========
+def bench_storage(count=100_000):
+    """Транзакции в секунду: только память против SQLite с групповым коммитом"""
+    print(f"storage: {count:,} транзакций")
+
+    db = main.Database()
+    start = time.perf_counter()
+    for i in range(count):
+        db.add_transaction('+79001234567', 500 + i, '💚Сбер💚', f'sir+{i}@outluk.ru', 'agent')
+    report('память', count, time.perf_counter() - start)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.db')
+        db = main.Database()
+        db.open(main.SQLiteStorage(path))
+
+        start = time.perf_counter()
+        for i in range(count):
+            db.add_transaction('+79001234567', 500 + i, '💚Сбер💚', f'sir+{i}@outluk.ru', 'agent')
+        enqueued = time.perf_counter() - start
+        report('sqlite: время в event loop', count, enqueued)
+
+        db.storage.flush()
+        report('sqlite: до записи на диск', count, time.perf_counter() - start)
+        db.close()
+
+        start = time.perf_counter()
+        restored = main.Database()
+        restored.open(main.SQLiteStorage(path))
+        report('sqlite: загрузка при старте', len(restored.transactions), time.perf_counter() - start)
+        # После рестарта — все транзакции, в том же порядке и с теми же суммами
+        assert [tx.id for tx in restored.transactions] == list(range(1, count + 1))
+        assert restored.transactions[-1].amount == 500 + count - 1
+        restored.close()
+
+
+# ========== ИНДЕКСЫ ==========
+def bench_lookups(sizes=(10_000, 100_000, 1_000_000), lookups=100_000):
+    """Время поиска по username/id транзакции/агенту при росте истории"""
+    print(f"lookups: {lookups:,} поисков каждого вида")
+
+    for size in sizes:
+        db = main.Database()
+        for user_id in range(1, 1001):
+            db.add_user(user_id, f'user{user_id}', f'User {user_id}')
+        agents = [db.set_agent(f'agent{n}')['username'] for n in range(50)]
+        for i in range(size):
+            db.add_transaction('+79001234567', 500, '💚Сбер💚', f'sir+{i}@outluk.ru', agents[i % 50])
+
+        timings = {}
+        start = time.perf_counter()
+        for i in range(lookups):
+            db.get_user_by_username(f'user{i % 1000 + 1}')
+        timings['get_user_by_username'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(lookups):
+            tx_id = i * 7919 % size + 1
+            db.mark_receipt_sent(tx_id, agents[(tx_id - 1) % 50])
+        timings['mark_receipt_sent'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(lookups):
+            db.get_agent_transactions(agents[i % 50])
+        timings['get_agent_transactions'] = time.perf_counter() - start
+
+        print(f"  {size:>9,} транзакций: " + ", ".join(
+            f"{name} {seconds / lookups * 1e9:,.0f} нс" for name, seconds in timings.items()
+        ))
+        # Индексы отвечают то же, что и проход по спискам
+        assert db.get_user_by_username('user1000')['id'] == 1000 and db.get_user_by_username('nobody') is None
+        assert all(tx.agent_username == agents[7] for tx in db.get_agent_transactions(agents[7]))
+        tx_id = 7919 % size + 1
+        assert db.transactions_by_id[tx_id].receipt_sent
+
+
+# ========== ИЗВЛЕЧЕНИЕ РЕКВИЗИТОВ ==========
+def legacy_extract_amount(text):
+    """Прежняя реализация extract_amount_from_text — эталон для сверки"""
+    matches = re.findall(r'(\d{3,})!', text)
+    if matches:
+        try:
+            amount = int(matches[-1])
+            if f'sir+{amount}@' not in text:
+                return amount
+        except ValueError:
+            pass
+
+    clean_text = re.sub(r'[^\d\s]', ' ', text)
+    for part in clean_text.split():
+        if part.isdigit():
+            try:
+                amount = int(part)
+                if f'sir+{part}@' not in text:
+                    return amount
+            except ValueError:
+                continue
+    return None
+
+
+def legacy_extract(text):
+    """Прежняя логика handle_admin_data — эталон для сверки"""
+    data = {'phone': None, 'amount': None, 'bank': None, 'email': None}
+
+    phone_match = re.search(r'\+7\d{10}', text)
+    if phone_match:
+        data['phone'] = phone_match.group()
+
+    data['amount'] = legacy_extract_amount(text)
+
+    if '💚Сбер💚' in text:
+        data['bank'] = '💚Сбер💚'
+    elif '💛Тбанк💛' in text:
+        data['bank'] = '💛Тбанк💛'
+    elif '💛Т-Банк💛' in text:
+        data['bank'] = '💛Т-Банк💛'
+    elif 'Тинькофф' in text or 'Тиньков' in text or 'Т-банк' in text:
+        data['bank'] = '💛Тбанк💛'
+
+    email_match = re.search(r'sir\+\d+@outluk\.ru', text)
+    if email_match:
+        data['email'] = email_match.group()
+    return data
+
+
+# Обрывки, из которых собирается эталонный корпус (включая неудобные случаи)
+GOLDEN_FRAGMENTS = [
+    '+79001234567', '+7900123456', '+790012345678', 'sir+79001234567@outluk.ru', '+7 900 123 45 67',
+    '500!', '0500!', '12!', '1500', '99', '٥٠٠!', '٥٠٠',
+    'sir+500@outluk.ru', 'sir+123@outluk.ru', 'sir+500@', 'sir+0500@outluk.ru', 'sir+@outluk.ru',
+    'ssir+42@outluk.rux', 'SIR+1@outluk.ru', 'sir++7123@',
+    '💚Сбер💚', '💛Тбанк💛', '💛Т-Банк💛', 'Тинькофф', 'Тиньков', 'Т-банк', 'Т-Банк', 'Сбер',
+    '💛Т-Банк💛Тбанк💛', '💛Тбанк💛Т-Банк💛', 'Тинькоффф',
+    'привет', 'перевод', '@', '!', '+', ' ', '\n', '\t', '\x1c', '\u2003', '-', '.', ',', '#1',
+]
+
+
+def golden_corpus(count, seed=1):
+    rng = random.Random(seed)
+    # Числа длиннее лимита int() (4300 цифр) — отдельно, прежняя логика на них квадратична
+    corpus = ['', '1' * 4400 + '! 500', '7' * 4400 + ' 12', '+7' + '1' * 4400] + GOLDEN_FRAGMENTS
+    for _ in range(count):
+        parts = rng.choices(GOLDEN_FRAGMENTS, k=rng.randint(1, 8))
+        corpus.append(rng.choice(['', ' ', '\n']).join(parts))
+    return corpus
+
+
+def requisites_message(i):
+    return (f"+7900{i % 10_000_000:07d}\n{500 + i % 5000}!\n"
+            f"{'💚Сбер💚' if i % 2 else '💛Тбанк💛'}\nsir+{i}@outluk.ru")
+
+
+def bench_extract(count=20_000):
+    """Сверка с прежней логикой на эталонном корпусе и скорость извлечения"""
+    corpus = golden_corpus(count)
+    mismatches = [text for text in corpus if main.extract_requisites(text) != legacy_extract(text)]
+    print(f"extract: сверка на {len(corpus):,} текстах — расхождений: {len(mismatches)}")
+    for text in mismatches[:5]:
+        print(f"  {text[:80]!r}: {main.extract_requisites(text)} != {legacy_extract(text)}")
+    assert not mismatches
+
+    # На чистых реквизитах обе версии идут вровень; выигрыш — на тексте с шумом,
+    # где прежняя логика гоняет несколько поисков и перебор чисел
+    corpora = [('реквизиты', [requisites_message(i) for i in range(count)]),
+               ('эталонный корпус', corpus[4:]),
+               ('болтовня группы', [CHATTER[i % len(CHATTER)] for i in range(count)])]
+    for label, texts in corpora:
+        start = time.perf_counter()
+        for text in texts:
+            legacy_extract(text)
+        report(f'{label}: прежняя логика', len(texts), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        main.extract_many(texts)
+        report(f'{label}: extract_many', len(texts), time.perf_counter() - start)
+
+
+# ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
+BENCH_CHAT_ID = -1001234567890
+BENCH_ADMIN = main.SPECIAL_ADMIN
+
+
+class StubBot(main.Bot):
+    """Bot без сети: запоминает вызовы API и отвечает правдоподобным результатом"""
+
+    def __init__(self, latency=0):
+        super().__init__(token=os.environ['BOT_TOKEN'])
+        self.calls = []
+        self.last_message_id = 0
+        self.latency = latency  # Верхняя граница случайной задержки ответа, с
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        self.calls.append((method, data))
+        if self.latency:
+            await asyncio.sleep(random.random() * self.latency)
+        if not method.startswith(('send', 'edit')):
+            return True
+        self.last_message_id += 1
+        return {
+            'message_id': self.last_message_id,
+            'date': int(time.time()),
+            'chat': {'id': (data or {}).get('chat_id', 0), 'type': 'supergroup'},
+            'text': (data or {}).get('text', ''),
+        }
+
+
+def install_stub_bot(latency=0):
+    """Подменяет бота и базу в main на чистые экземпляры"""
+    stub = StubBot(latency)
+    main.bot = stub
+    main.dp.bot = stub
+    main.Bot.set_current(stub)
+    main.Dispatcher.set_current(main.dp)
+    main.db = main.Database()
+    main.pipeline = main.ChatPipeline()
+    # Лимиты Telegram здесь не нужны: меряем сами обработчики
+    main.outbound = main.OutboundQueue(global_rate=1e9, group_rate=1e9, private_rate=1e9)
+    return stub
+
+
+async def drain_outbound():
+    """Хендлеры не ждут доставки: даём очереди дослать всё, что в неё поставлено"""
+    while main.outbound.depth():
+        await asyncio.sleep(0)
+
+
+def make_update(update_id, text, username, user_id, chat_id=BENCH_CHAT_ID):
+    return main.types.Update.to_object({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'text': text,
+        },
+    })
+
+
+CHATTER = [
+    'всем привет', 'кто сегодня на смене?', 'ок', 'скинь номер пж', 'перевёл 500 вроде',
+    'ждём реквизиты', 'спасибо!', 'чек пришёл?', '+', 'какой банк лучше, сбер или тиньков?',
+]
+
+
+def message_corpus(count, seed=1):
+    """Синтетический поток группы: в основном болтовня, плюс реквизиты и команды админа"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(count):
+        kind = rng.choices(['chatter', 'admin_chatter', 'requisites', 'agent', 'admin'],
+                           weights=[60, 10, 20, 6, 4])[0]
+        if kind == 'chatter':
+            user_id = rng.randint(1000, 1999)
+            corpus.append(make_update(i, rng.choice(CHATTER), f'user{user_id}', user_id))
+        elif kind == 'admin_chatter':
+            corpus.append(make_update(i, rng.choice(CHATTER), BENCH_ADMIN, 1))
+        elif kind == 'requisites':
+            corpus.append(make_update(i, requisites_message(i), BENCH_ADMIN, 1))
+        elif kind == 'agent':
+            corpus.append(make_update(i, f'агент @agent{rng.randint(1, 20)}', BENCH_ADMIN, 1))
+        else:
+            corpus.append(make_update(i, f'админ @helper{rng.randint(1, 5)}', BENCH_ADMIN, 1))
+    return corpus
+
+
+async def measure(name, items, func, alloc_sample=1000):
+    """Сообщений в секунду, p50/p99 и пик памяти на сообщение (отдельным проходом под tracemalloc)"""
+    latencies = []
+    for item in items:
+        start = time.perf_counter()
+        await func(item)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    peaks = []
+    for item in items[:alloc_sample]:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        await func(item)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(f"  {name:<28} {len(items) / sum(latencies):>10,.0f} сообщ/с  "
+          f"p50 {p50 * 1e6:>7.1f} мкс  p99 {p99 * 1e6:>7.1f} мкс  "
+          f"память {sum(peaks) / len(peaks) / 1024:>6.1f} КБ/сообщ")
+
+
+async def run_handlers(count):
+    admins = set(main.active_admins)
+    stub = install_stub_bot()
+    # Одни и те же реквизиты прогоняются по нескольку раз — отсев повторов здесь выключен
+    main.db.dedup = main.DedupCache(window=-1)
+    try:
+        updates = message_corpus(count)
+        await measure('dp → handle_all_messages', updates, main.dp.process_update)
+
+        requisites = [u.message for u in updates if 'sir+' in u.message.text]
+        await measure('handle_admin_data', requisites,
+                      lambda message: main.handle_admin_data(message, message.text))
+
+        prepared = [(message, main.extract_requisites(message.text)) for message in requisites]
+        await measure('process_admin_data', prepared,
+                      lambda item: main.process_admin_data(item[0], item[1], 'agent1'))
+
+        async def extract_amount(message):
+            main.extract_amount_from_text(message.text)
+
+        await measure('extract_amount_from_text', [u.message for u in updates], extract_amount)
+
+        await drain_outbound()
+        methods = Counter(method for method, _ in stub.calls)
+        print("  вызовы Bot API: " + ", ".join(f"{method} {n:,}" for method, n in methods.most_common()))
+        # id транзакций подряд, все ответы доставлены
+        assert [tx.id for tx in main.db.transactions] == list(range(1, len(main.db.transactions) + 1))
+        assert not main.outbound.stats()['failed']
+    finally:
+        main.active_admins.clear()
+        main.active_admins.update(admins)
+
+
+def bench_handlers(count=20_000):
+    """Горячий путь обработки сообщений группы на заглушке Bot"""
+    print(f"handlers: {count:,} сообщений группы")
+    asyncio.run(run_handlers(count))
+
+
+# ========== ОЧЕРЕДЬ ОТПРАВКИ ==========
+async def run_outbound(count, chats, speedup):
+    queue = main.OutboundQueue(global_rate=main.GLOBAL_RATE_LIMIT * speedup,
+                               group_rate=main.GROUP_RATE_LIMIT * speedup,
+                               private_rate=main.PRIVATE_RATE_LIMIT * speedup)
+    rng = random.Random(1)
+    delivered = []
+    floods = set(rng.sample(range(count), count // 50))
+
+    def make_send(n, chat_id):
+        async def send():
+            if n in floods:
+                floods.discard(n)
+                raise main.RetryAfter(0.5 / speedup)
+            delivered.append((time.monotonic(), chat_id, n))
+        return send
+
+    start = time.perf_counter()
+    start_monotonic = time.monotonic()
+    tasks = []
+    for n in range(count):
+        chat_id = -(n % chats) - 1
+        priority = main.PRIORITY_RECEIPT if n % 7 == 0 else main.PRIORITY_MENU
+        tasks.append(asyncio.ensure_future(queue.submit(chat_id, make_send(n, chat_id), priority)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - start
+    await queue.close()
+
+    # Соблюдение лимита: за любое окно в 60/speedup секунд в группу уходит не больше 20
+    window = 60 / speedup
+    worst = 0
+    by_chat = defaultdict(list)
+    for sent_at, chat_id, n in delivered:
+        by_chat[chat_id].append((sent_at, n))
+    for sends in by_chat.values():
+        times = [sent_at for sent_at, _ in sends]
+        left = 0
+        for right in range(len(times)):
+            while times[right] - times[left] > window:
+                left += 1
+            worst = max(worst, right - left + 1)
+    stats = queue.stats()
+    print(f"  доставлено {len(delivered):,}/{count:,} за {elapsed:.2f} с "
+          f"(≈ {elapsed * speedup / 60:.1f} мин реального времени), повторов после RetryAfter: {stats['retried']}")
+    print(f"  максимум в группу за минуту: {worst} (лимит {main.GROUP_MESSAGES_PER_MINUTE}), "
+          f"макс. глубина очереди: {stats['max_depth']}")
+    assert worst <= main.GROUP_MESSAGES_PER_MINUTE
+    # Доставлено всё, и внутри чата сообщения одного приоритета — в порядке постановки, даже после RetryAfter
+    assert len(delivered) == count and not stats['failed']
+    by_priority = defaultdict(list)
+    for _, chat_id, n in delivered:
+        by_priority[chat_id, n % 7 == 0].append(n)
+    assert all(sent == sorted(sent) for sent in by_priority.values())
+    # Через час простоя вёдра всех групп полные и выбрасываются
+    queue._prune(time.monotonic() + 3600)
+    assert not queue._buckets
+    for name, is_receipt in (('уведомления о чеках', True), ('меню', False)):
+        waits = [sent_at - start_monotonic for sent_at, _, n in delivered if (n % 7 == 0) == is_receipt]
+        print(f"  {name}: среднее ожидание ≈ {sum(waits) / len(waits) * speedup:.0f} с реального времени")
+
+
+def bench_outbound(count=2000, chats=20, speedup=200):
+    """Очередь отправки под всплеском: лимиты, приоритеты и повторы после RetryAfter"""
+    print(f"outbound: {count:,} сообщений в {chats} групп, время ускорено в {speedup} раз")
+    asyncio.run(run_outbound(count, chats, speedup))
+
+
+# ========== КЛАВИАТУРЫ ==========
+def bench_keyboards(calls=2_000, change_every=100):
+    """Меню участников/статистики агентов: сборка каждый раз против кэша по версии db"""
+    print(f"keyboards: {calls:,} открытий меню, изменение в db каждые {change_every}")
+    main.db = main.Database()
+    for n in range(10):
+        main.db.add_user(n + 1, f'admin{n}', f'Admin {n}', 'admin')
+    for n in range(50):
+        main.db.set_agent(f'agent{n}')
+
+    menus = [
+        ('get_members_menu', lambda: main.get_members_menu(True, True), lambda: main.build_members_menu(True, True)),
+        ('get_agents_stats_menu', main.get_agents_stats_menu, main.build_agents_stats_menu),
+        ('get_delete_agents_menu', main.get_delete_agents_menu, main.build_delete_agents_menu),
+    ]
+    for name, cached, build in menus:
+        for label, func in (('сборка', build), ('кэш', cached)):
+            start = time.perf_counter()
+            for i in range(calls):
+                if i % change_every == 0:
+                    main.db.add_transaction('+79001234567', 500, '💚Сбер💚', f'sir+{i}@outluk.ru', 'agent1')
+                func()
+            report(f'{name}: {label}', calls, time.perf_counter() - start)
+        # Из кэша — то же меню, что собирается заново после изменения db
+        main.db.add_transaction('+79001234567', 500, '💚Сбер💚', 'sir+1@outluk.ru', 'agent2')
+        assert cached().as_json() == build().as_json()
+
+
+# ========== АГРЕГАТЫ ==========
+def aggregate_size(aggregate):
+    return (sys.getsizeof(aggregate) + sys.getsizeof(aggregate.by_bank)
+            + sys.getsizeof(aggregate.recent_ids) + sum(sys.getsizeof(k) for k in aggregate.by_bank))
+
+
+def bench_aggregates(sizes=(10_000, 100_000, 1_000_000), agents=50):
+    """Память итогов по агентам при росте истории: списки ссылок на транзакции против Aggregate"""
+    print(f"aggregates: {agents} агентов")
+    for size in sizes:
+        db = main.Database()
+        db.start_session(10 ** 9)
+        legacy = defaultdict(list)  # Как было: agent_stats[...]['transactions']
+        for i in range(size):
+            tx = db.add_transaction('+79001234567', 500, '💚Сбер💚' if i % 3 else '💛Тбанк💛',
+                                    f'sir+{i}@outluk.ru', f'agent{i % agents}')
+            legacy[tx['agent_username']].append(tx)
+
+        for agent, transactions in legacy.items():
+            aggregate = db.agent_stats[agent]
+            assert aggregate.count == len(transactions)
+            assert aggregate.total_amount == sum(tx.amount for tx in transactions)
+        before = sum(sys.getsizeof(transactions) for transactions in legacy.values())
+        after = sum(aggregate_size(aggregate) for aggregate in db.agent_stats.values())
+        start = time.perf_counter()
+        db.start_session(10 ** 9)
+        reset = time.perf_counter() - start
+        print(f"  {size:>9,} транзакций: списки {before / 1024:>9,.0f} КБ, "
+              f"Aggregate {after / 1024:>6,.0f} КБ, сброс сессии {reset * 1e6:.1f} мкс")
+
+
+# ========== ПАМЯТЬ НА ТРАНЗАКЦИЮ ==========
+def traced_bytes(build, count):
+    tracemalloc.start()
+    records = build(count)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return size / count
+
+
+def build_dicts(count):
+    # Как было: dict на транзакцию, строки приходят из разбора сообщения
+    return [{
+        'id': i,
+        'phone': f'+7900{i:07d}',
+        'amount': 500 + i % 5000,
+        'bank': ''.join(['💚Сбер', '💚']),
+        'email': f'sir+{i}@outluk.ru',
+        'agent_username': f'agent{i % 50}',
+        'timestamp': time.time(),
+        'receipt_sent': False,
+    } for i in range(count)]
+
+
+def build_transactions(count):
+    return [main.Transaction(i, f'+7900{i:07d}', 500 + i % 5000, ''.join(['💚Сбер', '💚']),
+                             f'sir+{i}@outluk.ru', f'agent{i % 50}', time.time())
+            for i in range(count)]
+
+
+def bench_memory(count=1_000_000):
+    """Байт на транзакцию: dict против Transaction со __slots__ и интернированными строками"""
+    print(f"memory: {count:,} транзакций")
+    before = traced_bytes(build_dicts, count)
+    after = traced_bytes(build_transactions, count)
+    print(f"  dict        {before:>6.0f} байт/транзакцию")
+    print(f"  Transaction {after:>6.0f} байт/транзакцию  ({(1 - after / before) * 100:.0f}% меньше)")
+    assert after < before
+
+
+# ========== POLLING / WEBHOOK ==========
+class FakeTelegram:
+    """Локальный Bot API: отдаёт обновления через getUpdates и засекает, когда бот ответил в чат"""
+
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.calls = Counter()
+        self.replies = {}
+        self.last_message_id = 0
+        self.runner = None
+        self.url = None
+
+    async def start(self):
+        # Загрузки видео больше мегабайта по умолчанию aiohttp
+        app = web.Application(client_max_size=64 * 2 ** 20)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def make_bot(self):
+        return main.MeteredBot(token=os.environ['BOT_TOKEN'], server=TelegramAPIServer.from_base(self.url))
+
+    def expect_reply(self, chat_id):
+        self.replies[chat_id] = asyncio.get_event_loop().create_future()
+        return self.replies[chat_id]
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({'ok': True, 'result': result})
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        data = await request.post()
+        self.calls[method] += 1
+
+        if method == 'getUpdates':
+            updates = []
+            try:
+                updates.append(await asyncio.wait_for(self.updates.get(), float(data.get('timeout', 0))))
+            except asyncio.TimeoutError:
+                pass
+            while not self.updates.empty():
+                updates.append(self.updates.get_nowait())
+            return self.ok(updates)
+
+        if method == 'getWebhookInfo':
+            return self.ok({'url': '', 'has_custom_certificate': False, 'pending_update_count': 0})
+
+        if method.startswith(('send', 'edit')):
+            chat_id = int(data['chat_id'])
+            waiter = self.replies.pop(chat_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(time.perf_counter())
+            self.last_message_id += 1
+            return self.ok({
+                'message_id': self.last_message_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': data.get('text', ''),
+            })
+
+        return self.ok(True)
+
+
+def start_update(update_id, chat_id):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench', 'username': f'user{chat_id}'},
+            'text': '/start',
+        },
+    }
+
+
+async def measure_round_trips(name, fake, deliver, count):
+    """Время от передачи обновления боту до его ответа в Bot API"""
+    latencies = []
+    for i in range(count):
+        chat_id = 100_000 + i
+        waiter = fake.expect_reply(chat_id)
+        start = time.perf_counter()
+        await deliver(start_update(i + 1, chat_id))
+        latencies.append(await asyncio.wait_for(waiter, 10) - start)
+    latencies.sort()
+    print(f"  {name:<8} {count / sum(latencies):>8,.0f} обновл/с  "
+          f"p50 {latencies[len(latencies) // 2] * 1000:>6.2f} мс  "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:>6.2f} мс")
+
+
+async def run_delivery(count):
+    fake = FakeTelegram()
+    await fake.start()
+    bot = fake.make_bot()
+    main.bot = bot
+    main.dp.bot = bot
+    main.Bot.set_current(bot)
+    main.Dispatcher.set_current(main.dp)
+    main.db = main.Database()
+    main.outbound = main.OutboundQueue(global_rate=1e9, group_rate=1e9, private_rate=1e9)
+
+    try:
+        # Long polling
+        polling = asyncio.ensure_future(main.dp.start_polling(timeout=1, relax=0))
+        await measure_round_trips('polling', fake, fake.updates.put, count)
+        main.dp.stop_polling()
+        await main.dp.wait_closed()
+        await polling
+
+        # Webhook с проверкой секрета
+        main.WEBHOOK_SECRET = 'bench-secret'
+        app = main.create_webhook_app()
+        configure_app(main.dp, app, main.WEBHOOK_PATH)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{main.WEBHOOK_PATH}"
+
+        async with aiohttp.ClientSession() as session:
+            async def post_update(update, secret=main.WEBHOOK_SECRET):
+                headers = {'X-Telegram-Bot-Api-Secret-Token': secret}
+                async with session.post(url, json=update, headers=headers) as response:
+                    return response.status
+
+            await measure_round_trips('webhook', fake, post_update, count)
+            status = await post_update(start_update(0, 1), secret='wrong')
+            print(f"  webhook с неверным секретом: HTTP {status}")
+            assert status == 401
+
+        await runner.cleanup()
+    finally:
+        await (await bot.get_session()).close()
+        await fake.stop()
+
+
+def bench_delivery(count=500):
+    """Задержка «обновление → ответ» в режимах polling и webhook на локальном фейковом Telegram"""
+    print(f"delivery: {count:,} обновлений /start в каждом режиме")
+    asyncio.run(run_delivery(count))
+
+
+# ========== РАСПРЕДЕЛЕНИЕ ПО АГЕНТАМ ==========
+# (username, среднее время на чек в секундах, вес для weighted)
+SIM_AGENTS = [('fast', 20, 4), ('steady', 40, 2), ('slow', 80, 1), ('slower', 120, 1)]
+
+
+class FirstAgentScheduler(main.AgentScheduler):
+    """Как было: все реквизиты уходят первому агенту"""
+
+    def pick(self, candidates):
+        return next(iter(candidates), None)
+
+
+def simulate_assignment(scheduler, arrivals, load=0.9, seed=11):
+    """Дискретная симуляция: реквизиты приходят пуассоновским потоком, агенты отправляют чеки по одному"""
+    rnd = random.Random(seed)
+    db = main.Database()
+    db.scheduler = scheduler
+    for name, _, _ in SIM_AGENTS:
+        db.set_agent(name)
+    service = {name: mean for name, mean, _ in SIM_AGENTS}
+    capacity = sum(1 / mean for _, mean, _ in SIM_AGENTS)
+
+    events = [(rnd.expovariate(capacity * load), 0, 'arrival', None)]
+    queues = defaultdict(deque)
+    busy = set()
+    arrived_at = {}
+    waits = []
+    backlog = []
+    order = itertools.count(1)
+    picking = 0.0
+
+    def start_next(name, now):
+        if name not in busy and queues[name]:
+            busy.add(name)
+            tx_id = queues[name].popleft()
+            heapq.heappush(events, (now + rnd.expovariate(1 / service[name]), next(order), 'done', (name, tx_id)))
+
+    while events:
+        now, _, kind, data = heapq.heappop(events)
+        if kind == 'arrival':
+            start = time.perf_counter()
+            agent = db.assign_agent()
+            picking += time.perf_counter() - start
+            tx = db.add_transaction('+79001234567', 500, '💚Сбер💚', 'sir+1@outluk.ru', agent)
+            arrived_at[tx.id] = now
+            queues[agent].append(tx.id)
+            start_next(agent, now)
+            if len(arrived_at) < arrivals:
+                heapq.heappush(events, (now + rnd.expovariate(capacity * load), next(order), 'arrival', None))
+        else:
+            name, tx_id = data
+            busy.discard(name)
+            db.mark_receipt_sent(tx_id, name)
+            waits.append(now - arrived_at[tx_id])
+            start_next(name, now)
+        backlog.append(sum(db.scheduler.outstanding.values()))
+
+    waits.sort()
+    return {
+        'backlog_mean': sum(backlog) / len(backlog),
+        'backlog_max': max(backlog),
+        'wait_p50': waits[len(waits) // 2],
+        'wait_p99': waits[int(len(waits) * 0.99)],
+        'pick_us': picking / arrivals * 1e6,
+        'shares': Counter(tx.agent_username for tx in db.transactions),
+    }
+
+
+def bench_scheduler(arrivals=20_000, load=0.9):
+    """Очередь неотправленных чеков при разных политиках распределения, агенты разной скорости"""
+    print(f"scheduler: {arrivals:,} реквизитов, загрузка {load:.0%} от суммарной скорости агентов")
+    weights = {name: weight for name, _, weight in SIM_AGENTS}
+    schedulers = [('first', FirstAgentScheduler())]
+    schedulers += [(policy, main.AgentScheduler(policy, weights)) for policy in main.ASSIGN_POLICIES]
+    results = {}
+    for policy, scheduler in schedulers:
+        stats = results[policy] = simulate_assignment(scheduler, arrivals, load)
+        shares = ' '.join(f"{name}:{stats['shares'][name] / arrivals:.0%}" for name, _, _ in SIM_AGENTS)
+        print(f"  {policy:<18} очередь ср. {stats['backlog_mean']:>9,.1f} макс. {stats['backlog_max']:>6,}  "
+              f"ожидание p50 {stats['wait_p50']:>9,.0f} с p99 {stats['wait_p99']:>9,.0f} с  "
+              f"выбор {stats['pick_us']:.1f} мкс  [{shares}]")
+    # С учётом нагрузки очередь чеков короче, чем когда всё уходит первому агенту
+    assert results['least_outstanding']['wait_p99'] < results['first']['wait_p99']
+
+    # Агент, исключённый на одном выборе (например, при передаче чека), не пропадает из кучи
+    scheduler = main.AgentScheduler()
+    agents = {name: {} for name in ('agent1', 'agent2', 'agent3')}
+    for name in agents:
+        scheduler.track(name)
+    for _ in range(30):
+        scheduler.assigned(scheduler.pick({name: agent for name, agent in agents.items() if name != 'agent1'}))
+        scheduler.assigned(scheduler.pick(agents))
+    print(f"  исключение agent1 через выбор: {dict(scheduler.outstanding)}")
+    assert set(scheduler.outstanding.values()) == {20}
+
+
+# ========== СРОКИ ЧЕКОВ ==========
+def bench_receipts(sizes=(1_000, 10_000, 100_000), ticks=600):
+    """Стоимость тика: колесо таймеров против прохода по всем неотправленным чекам"""
+    print(f"receipts: {ticks} тиков по 1 с, сроки 10–30 мин")
+    rnd = random.Random(3)
+    for size in sizes:
+        start_at = 1_000_000.0
+        deadlines = {tx_id: start_at + rnd.uniform(1, 1800) for tx_id in range(size)}
+
+        # Как можно было бы без колеса: каждый тик сравниваем сроки всех чеков
+        pending = dict(deadlines)
+        start = time.perf_counter()
+        scan_fired = 0
+        for tick in range(1, ticks + 1):
+            now = start_at + tick
+            expired = [tx_id for tx_id, deadline in pending.items() if deadline <= now]
+            for tx_id in expired:
+                del pending[tx_id]
+            scan_fired += len(expired)
+        scan = time.perf_counter() - start
+
+        wheel = main.TimerWheel(tick=1.0, now=start_at)
+        start = time.perf_counter()
+        for tx_id, deadline in deadlines.items():
+            wheel.schedule(tx_id, deadline - start_at)
+        schedule = time.perf_counter() - start
+
+        start = time.perf_counter()
+        wheel_fired = 0
+        late = 0
+        for tick in range(1, ticks + 1):
+            now = start_at + tick
+            for tx_id, _ in wheel.advance(now):
+                wheel_fired += 1
+                # Срабатывание не раньше срока и не позже, чем через тик
+                late += not (0 <= now - deadlines[tx_id] < 1)
+        wheel_ticks = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for tx_id in list(wheel.where):
+            wheel.cancel(tx_id)
+        cancel = time.perf_counter() - start
+
+        assert wheel_fired == scan_fired and not late and not len(wheel)
+        print(f"  {size:>7,} чеков: тик проходом {scan / ticks * 1e3:>8.3f} мс, "
+              f"колесом {wheel_ticks / ticks * 1e3:>6.3f} мс; "
+              f"постановка {schedule / size * 1e6:.2f} мкс, отмена {cancel / max(1, size - wheel_fired) * 1e6:.2f} мкс")
+
+    receipts_restart()
+
+
+def receipts_restart(count=20):
+    """Напоминания не повторяются после рестарта, а просроченные за простой разносятся по тикам"""
+    def reopen(path, remind_after, reassign_after):
+        db = main.Database()
+        db.receipts.remind_after = remind_after
+        db.receipts.reassign_after = reassign_after
+        db.open(main.SQLiteStorage(path))
+        return db
+
+    def fired(db, after):
+        return Counter(stage for stage, _, _ in db.receipts.due(time.time() + after))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'receipts.db')
+        db = reopen(path, 0.01, 3600)
+        for i in range(count):
+            db.add_transaction(f'+7900{i:07d}', 500 + i, '💚Сбер💚', f'sir+{i}@outluk.ru', 'agent_one', -1001)
+        reminded = fired(db, 1.5)
+        db.close()
+
+        # Рестарт: напоминания уже были, до передачи ещё час — ничего не срабатывает
+        db = reopen(path, 0.01, 3600)
+        after_restart = fired(db, 1.5)
+        db.close()
+
+        # Рестарт после простоя дольше срока передачи: передачи идут по RECEIPT_RESUME_PER_TICK за тик
+        time.sleep(0.05)
+        db = reopen(path, 0.01, 0.01)
+        first_tick = fired(db, 1.5)
+        db.close()
+    print(f"  рестарт: напоминаний до {reminded['remind']}, после рестарта {sum(after_restart.values())}, "
+          f"после простоя в первый тик {dict(first_tick)} из {count}")
+    assert reminded['remind'] == count and not after_restart
+    assert first_tick == {'reassign': main.RECEIPT_RESUME_PER_TICK}
+
+
+# ========== МЕТРИКИ ==========
+async def run_metrics(count):
+    admins = set(main.active_admins)
+    middlewares = main.dp.middleware.applications
+    updates = message_corpus(count)
+    try:
+        # Прогрев, затем поочерёдно без middleware и с ним на чистой базе
+        install_stub_bot()
+        for update in updates[:1000]:
+            await main.dp.process_update(update)
+        middlewares.remove(main.metrics_middleware)
+        install_stub_bot()
+        await measure('без метрик', updates, main.dp.process_update)
+        middlewares.append(main.metrics_middleware)
+        install_stub_bot()
+        await measure('с MetricsMiddleware', updates, main.dp.process_update)
+    finally:
+        if main.metrics_middleware not in middlewares:
+            middlewares.append(main.metrics_middleware)
+        main.active_admins.clear()
+        main.active_admins.update(admins)
+
+
+def bench_metrics(count=20_000, observations=1_000_000):
+    """Накладные расходы метрик на апдейт, стоимость observe и выдачи /metrics"""
+    print(f"metrics: {count:,} апдейтов")
+    asyncio.run(run_metrics(count))
+
+    histogram = main.Histogram('bench_seconds', 'bench', ('handler',))
+    start = time.perf_counter()
+    for i in range(observations):
+        histogram.observe(i % 1000 / 10_000, 'handle_all_messages')
+    report('Histogram.observe', observations, time.perf_counter() - start)
+
+    start = time.perf_counter()
+    text = main.metrics.render()
+    print(f"  /metrics: {len(text.splitlines()):,} строк, {(time.perf_counter() - start) * 1e3:.2f} мс")
+    counts = [line for line in text.splitlines() if line.startswith('bot_handler_seconds_count')]
+    for line in counts:
+        print(f"    {line}")
+    assert any('handler="handle_all_messages"' in line for line in counts)
+
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+async def run_profile(count, seconds):
+    admins = set(main.active_admins)
+    updates = message_corpus(count)
+    try:
+        install_stub_bot()
+        await measure('без профиля', updates, main.dp.process_update)
+
+        for mode in ('', ' cprofile'):
+            stub = install_stub_bot()
+            command = make_update(count + 1, f'/profile {seconds}{mode}', main.SPECIAL_ADMIN, 1)
+            # Захват идёт в фоновой задаче: команда возвращается сразу
+            await main.dp.process_update(command)
+            # Апдейты продолжают обрабатываться, пока идёт захват
+            processed = 0
+            start = time.perf_counter()
+            while main.profile_lock.locked():
+                await main.dp.process_update(updates[processed % count])
+                processed += 1
+                await asyncio.sleep(0)
+            elapsed = time.perf_counter() - start
+
+            documents = [data for method, data in stub.calls if method == 'sendDocument']
+            print(f"  {'/profile ' + str(seconds) + mode:<28} {processed / elapsed:>10,.0f} сообщ/с  "
+                  f"({processed:,} апдейтов, файлов профиля: {len(documents)})")
+            assert processed and len(documents) == 1
+    finally:
+        main.active_admins.clear()
+        main.active_admins.update(admins)
+
+
+def bench_profile(count=20_000, seconds=3):
+    """Пропускная способность хендлеров во время /profile и без него"""
+    print(f"profile: {count:,} апдейтов, захват {seconds} с")
+    asyncio.run(run_profile(count, seconds))
+
+
+# ========== ЭКСПОРТ ==========
+def bench_export(sizes=(100_000, 300_000)):
+    """Скорость /export и пик памяти: при росте истории пик не должен расти"""
+    print("export: все транзакции и фильтр по агенту")
+    for size in sizes:
+        transactions = build_transactions(size)
+        for i, tx in enumerate(transactions):
+            tx.session_id = i // 10_000
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt, compress, filters in (('csv', False, {}), ('jsonl', False, {}), ('csv', True, {}),
+                                           ('csv', False, {'agent': 'agent7', 'session': 3})):
+                path = os.path.join(tmp, 'export')
+                tracemalloc.start()
+                start = time.perf_counter()
+                count = main.export_transactions(iter(transactions), path, fmt, compress, **filters)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                label = fmt + (' gz' if compress else '') + (' фильтр' if filters else '')
+                expected = sum(1 for tx in transactions if not filters
+                               or (tx.agent_username == filters['agent'] and tx.session_id == filters['session']))
+                assert count == expected
+                print(f"  {size:>9,} транзакций, {label:<11} {count:>9,} строк  {elapsed:>6.2f} с  "
+                      f"файл {os.path.getsize(path) / 2 ** 20:>6.1f} МБ  пик памяти {peak / 1024:>6.1f} КБ")
+
+
+# ========== ИСТОРИЯ СЕССИЙ ==========
+def bench_ledger(sessions=50, per_session=20_000):
+    """Учёт транзакции в истории сессий и расчёт темпа против пересчёта по всем транзакциям"""
+    print(f"ledger: {sessions} сессий по {per_session:,} транзакций")
+    ledger = main.SessionLedger()
+    transactions = build_transactions(sessions * per_session)
+    now = time.time()
+
+    start = time.perf_counter()
+    for session_id in range(sessions):
+        ledger.start(session_id, 10 ** 7, now=now - (sessions - session_id) * 3600)
+        for tx in transactions[session_id * per_session:(session_id + 1) * per_session]:
+            tx.session_id = session_id
+            tx.timestamp = ledger.current.started_at + (tx.id % per_session) * 0.15
+            ledger.add(tx)
+        ledger.stop(now=ledger.current.started_at + per_session * 0.15)
+    report('SessionLedger.add', len(transactions), time.perf_counter() - start)
+
+    record = ledger.current
+    end = record.stopped_at
+    start = time.perf_counter()
+    for _ in range(1000):
+        record.pace(end), record.recent_pace(end), record.eta(end)
+        [past.pace() for past in ledger.history(5)]
+    report('/pace по истории', 1000, time.perf_counter() - start)
+
+    # Как пришлось бы без истории: фильтровать все транзакции сессии и раскладывать по минутам
+    start = time.perf_counter()
+    for _ in range(10):
+        buckets = defaultdict(int)
+        for tx in transactions:
+            if tx.session_id == record.id:
+                buckets[int((tx.timestamp - record.started_at) // 60)] += tx.amount
+    report('/pace пересчётом', 10, time.perf_counter() - start)
+    assert dict(record.buckets) == dict(buckets) and record.count == per_session
+
+
+# ========== ХОЛОДНЫЙ СТАРТ ==========
+STARTUP_PROBE = r'''
+import os, sys, time, asyncio
+start = time.perf_counter()
+if os.environ.get('BENCH_EAGER_TELETHON'):
+    # Как было: Telethon импортируется вместе с модулем
+    import telethon
+import main
+imported = time.perf_counter()
+assert os.environ.get('BENCH_EAGER_TELETHON') or 'telethon' not in sys.modules
+import bench
+# Импорт самого bench и заглушки бота в замер не входят
+offset = time.perf_counter() - imported
+
+async def probe():
+    bench.install_stub_bot()
+    started = time.perf_counter()
+    await main.on_startup(main.dp)
+    ready = time.perf_counter()
+    await main.dp.process_update(bench.make_update(1, '/start', 'user1', 1001))
+    handled = time.perf_counter()
+    while main.TelegramClient is None and time.perf_counter() - start < 10:
+        await asyncio.sleep(0.005)
+    telethon = time.perf_counter()
+    print(imported - start, ready - started, handled - start - offset, telethon - start - offset)
+    sys.stdout.flush()
+    # Не ждём входа Telethon: в песочнице сети нет
+    os._exit(0)
+
+asyncio.run(probe())
+'''
+
+
+def bench_startup(runs=5):
+    """Время от запуска интерпретатора до первого обработанного апдейта (отдельные процессы)"""
+    print(f"startup: медиана по {runs} запускам")
+    # Во временном каталоге: Telethon создаёт там файл сессии
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, DB_PATH='', API_ID='1', API_HASH='bench', METRICS_PORT='0', PYTHONPATH=here)
+    for label, extra in (('Telethon при импорте', {'BENCH_EAGER_TELETHON': '1'}), ('Telethon в фоне', {})):
+        samples = []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as tmp:
+                output = subprocess.run([sys.executable, '-c', STARTUP_PROBE], env=dict(env, **extra),
+                                        cwd=tmp, capture_output=True, text=True, timeout=60, check=True).stdout
+            samples.append([float(value) for value in output.split()])
+        imported, ready, handled, telethon = (sorted(column)[runs // 2] for column in zip(*samples))
+        print(f"  {label:<22} import main {imported * 1e3:>6.0f} мс  on_startup {ready * 1e3:>5.1f} мс  "
+              f"первый апдейт {handled * 1e3:>6.0f} мс  Telethon готов к {telethon * 1e3:>6.0f} мс")
+    print("  (раньше on_startup ещё и ждал входа Telethon по сети — здесь сети нет)")
+
+
+# ========== CALLBACK-КНОПКИ ==========
+def make_callback(update_id, data, username, user_id, chat_id=BENCH_CHAT_ID):
+    return main.types.Update.to_object({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': 'bench',
+            'from': {'id': user_id, 'is_bot': False, 'first_name': username, 'username': username},
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'supergroup', 'title': 'bench'},
+                'text': 'menu',
+            },
+            'data': data,
+        },
+    })
+
+
+async def run_callback_flows():
+    """Все кнопки клавиатур проходят через роутер, чек подтверждается агентом и админом"""
+    admins = set(main.active_admins)
+    stub = install_stub_bot()
+    try:
+        db = main.db
+        db.set_agent('agent_one')
+        db.set_agent('agent2')
+        db.add_user(1, BENCH_ADMIN, 'Admin', 'admin')
+        first = db.add_transaction('+79001234567', 500, '💚Сбер💚', 'sir+1@outluk.ru', 'agent_one', BENCH_CHAT_ID)
+        second = db.add_transaction('+79001234568', 700, '💛Тбанк💛', 'sir+2@outluk.ru', 'agent2', BENCH_CHAT_ID)
+
+        presses = [(data, BENCH_ADMIN, 1) for data in (
+            'members', 'help', 'agent_form', 'send_receipt', 'subscribe', 'agent_instructions', 'back_to_main',
+            'agents_stats', 'agent_stats_agent_one', 'agent_detail_agent2', 'view_agent_one', 'back_to_members',
+            'delete_agent_menu', 'delete_all_confirm', 'cancel_delete', 'none', 'garbage',
+            f'send_receipt_email_{second.id}_agent2', f'confirm_receipt_{second.id}_agent2',
+        )]
+        presses += [
+            (f'receipt_sent_{first.id}_agent_one', 'agent2', 3),       # чужая кнопка
+            (f'receipt_problem_{first.id}_agent_one', 'agent_one', 2),
+            (f'receipt_sent_{first.id}_agent_one', 'agent_one', 2),
+            (f'receipt_sent_{first.id}_agent_one', 'agent_one', 2),    # повторное нажатие
+            ('delete_agent2', BENCH_ADMIN, 1),
+        ]
+        for i, (data, username, user_id) in enumerate(presses):
+            await main.dp.process_update(make_callback(i + 1, data, username, user_id))
+        await drain_outbound()
+
+        answers = [data.get('text') for method, data in stub.calls if method == 'answerCallbackQuery']
+        methods = Counter(method for method, _ in stub.calls)
+        print(f"  {len(presses)} нажатий: " + ", ".join(f"{method} {n}" for method, n in methods.most_common()))
+        print(f"  ответы: {[text for text in answers if text]}")
+        assert first.receipt_sent and second.receipt_sent and not db.receipts.pending
+        assert 'agent2' not in db.agents
+    finally:
+        main.active_admins.clear()
+        main.active_admins.update(admins)
+
+
+def legacy_resolve(chain, data):
+    # Как принято в aiogram: фильтры lambda c: c.data.startswith(...) проверяются по очереди
+    # а хендлер затем сам режет строку на id и username
+    for prefix, handler in chain:
+        if data.startswith(prefix):
+            transaction_id, agent_username = data[len(prefix):].split('_', 1)
+            return handler, (int(transaction_id), agent_username)
+    return None
+
+
+def bench_callbacks(route_counts=(20, 100, 500, 2000), clicks=200_000):
+    """Выбор хендлера и разбор аргументов кнопки при росте числа маршрутов: цепочка startswith против роутера"""
+    print("callbacks: сценарии кнопок")
+    asyncio.run(run_callback_flows())
+
+    rnd = random.Random(5)
+    real = ['receipt_sent_', 'receipt_problem_', 'confirm_receipt_', 'send_receipt_email_',
+            'agent_stats_', 'agent_detail_', 'view_', 'delete_']
+    print(f"callbacks: {clicks:,} разборов callback_data")
+    for count in route_counts:
+        router = main.CallbackRouter()
+        chain = []
+        prefixes = [f'route{i}_' for i in range(count - len(real))] + real
+        for prefix in prefixes:
+            handler = router.route(prefix, int, str)(lambda callback, *args: None)
+            chain.append((prefix, handler))
+        datas = [f'{rnd.choice(prefixes)}{rnd.randint(1, 10 ** 6)}_agent_{rnd.randint(1, 50)}' for _ in range(clicks)]
+
+        start = time.perf_counter()
+        for data in datas:
+            legacy_resolve(chain, data)
+        legacy = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for data in datas:
+            router.resolve(data)
+        routed = time.perf_counter() - start
+        print(f"  {count:>5} маршрутов: startswith {legacy / clicks * 1e6:>7.2f} мкс, "
+              f"роутер {routed / clicks * 1e6:>5.2f} мкс")
+        # Тот же хендлер и те же аргументы, что у цепочки startswith
+        for data in datas[:1000]:
+            handler, args = router.resolve(data)
+            assert (handler, tuple(args)) == legacy_resolve(chain, data)
+
+
+def bench_tokens(sizes=(1_000, 100_000, 1_000_000), clicks=200_000):
+    """Короткие токены кнопок чеков: длина callback_data, выдача, нажатие и срок жизни"""
+    print("tokens: длина callback_data кнопки чека")
+    for username in ('agent', 'agent_one_' + 'x' * 10, 'a' * 32):
+        for prefix in ('receipt_sent_', 'send_receipt_email_'):
+            legacy = f'{prefix}{10 ** 7}_{username}'
+            token = main.callbacks.tokens.issue(legacy)
+            print(f"  {prefix:<20} username {len(username):>2} симв.: строка {len(legacy.encode()):>3} байт "
+                  f"из 64, токен {len(token)} байт")
+
+    rnd = random.Random(19)
+    print(f"tokens: выдача и {clicks:,} нажатий при росте таблицы")
+    for size in sizes:
+        tokens = main.CallbackTokens(main.callbacks, capacity=size)
+        datas = [f'receipt_sent_{i}_agent_{i % 50}' for i in range(size)]
+        start = time.perf_counter()
+        issued = [tokens.issue(data) for data in datas]
+        issue = time.perf_counter() - start
+        picks = [rnd.randrange(size) for _ in range(clicks)]
+        start = time.perf_counter()
+        for i in picks:
+            tokens.resolve(issued[i])
+        resolve = time.perf_counter() - start
+        start = time.perf_counter()
+        for i in picks:
+            main.callbacks.resolve(datas[i])
+        parse = time.perf_counter() - start
+        print(f"  {size:>9,} токенов: выдача {issue / size * 1e6:>5.2f} мкс, нажатие {resolve / clicks * 1e6:>5.2f} мкс, "
+              f"разбор строки {parse / clicks * 1e6:>5.2f} мкс")
+
+    print("tokens: вытеснение и срок жизни")
+    tokens = main.CallbackTokens(main.callbacks, ttl=60, capacity=1000)
+    issued = [tokens.issue(f'receipt_sent_{i}_agent') for i in range(1500)]
+    assert len(tokens.table) == 1000 and tokens.resolve(issued[0]) is None and tokens.resolve(issued[-1])
+    kept = len(tokens.table)
+    real_time = main.time.time
+    main.time.time = lambda: real_time() + 61
+    try:
+        assert tokens.resolve(issued[-1]) is None
+    finally:
+        main.time.time = real_time
+    print(f"  1,500 выдано при ёмкости 1,000: в таблице {kept:,}, первый вытеснен, "
+          f"через 61 с при TTL 60 с — истёк ({tokens.expired})")
+
+    # Долгоживущий бот: просроченные токены удаляются из SQLite не только при старте
+    with tempfile.TemporaryDirectory() as tmp:
+        storage = main.SQLiteStorage(os.path.join(tmp, 'tokens.db'))
+        tokens = main.CallbackTokens(main.callbacks, ttl=60)
+        tokens.open(storage)
+        for i in range(100):
+            tokens.issue(f'receipt_sent_{i}_agent')
+        later = time.time() + main.CALLBACK_TOKEN_PRUNE_INTERVAL
+        tokens.prune(later)
+        fresh = tokens.issue('receipt_sent_100_agent')
+        storage.flush()
+        rows = storage.load_callback_tokens(0)
+        storage.close()
+    print(f"  через {main.CALLBACK_TOKEN_PRUNE_INTERVAL} с в SQLite осталось токенов: {len(rows)} из 101")
+    assert [row[0] for row in rows] == [fresh]
+
+    asyncio.run(run_token_flow())
+
+
+async def run_token_flow():
+    """Агент жмёт кнопки из настоящей клавиатуры уведомления, затем — по просроченному токену"""
+    stub = install_stub_bot()
+    db = main.db
+    agent = 'agent_with_long_name_32_chars__'
+    db.set_agent(agent)
+    tx = db.add_transaction('+79001234569', 900, '💚Сбер💚', 'sir+3@outluk.ru', agent, BENCH_CHAT_ID)
+    keyboard = main.get_agent_receipt_keyboard(tx.id, tx.agent_username)
+    sent, problem = (button.callback_data for button in keyboard.inline_keyboard[0])
+    for i, data in enumerate((problem, sent, '~zzzzzzzzz')):
+        await main.dp.process_update(make_callback(100 + i, data, tx.agent_username, 7))
+    await drain_outbound()
+    answers = [data.get('text') for method, data in stub.calls if method == 'answerCallbackQuery' and data.get('text')]
+    print(f"  нажатия по токенам {sent!r}, {problem!r}: {answers}")
+    assert tx.receipt_sent and answers[-1].startswith('⌛')
+
+
+def bench_dedup(sizes=(1_000, 100_000, 1_000_000), lookups=200_000):
+    """Повторные реквизиты: одна транзакция на оплату и стоимость проверки при росте кэша"""
+    asyncio.run(run_dedup_flow())
+
+    rnd = random.Random(20)
+    print(f"dedup: {lookups:,} проверок при росте кэша")
+    for size in sizes:
+        cache = main.DedupCache(window=3600, capacity=2 * size)
+        now = time.time()
+        keys = [main.requisites_fingerprint(f'+7900{i:07d}', 500 + i % 5000, f'sir+{i}@outluk.ru') for i in range(size)]
+        start = time.perf_counter()
+        for i, key in enumerate(keys):
+            cache.remember([key, (BENCH_CHAT_ID, i)], i, now)
+        remember = time.perf_counter() - start
+        picks = [keys[rnd.randrange(size)] if rnd.random() < 0.5 else ('new', i, 0) for i in range(lookups)]
+        start = time.perf_counter()
+        for key in picks:
+            cache.find([key], now)
+        find = time.perf_counter() - start
+        print(f"  {size:>9,} транзакций в окне: запись {remember / size * 1e6:>5.2f} мкс, "
+              f"проверка {find / lookups * 1e6:>5.2f} мкс, ключей {len(cache.entries):,}")
+
+    # Поток без остановки: окно 60 с, 2,000 транзакций в секунду модельного времени
+    cache = main.DedupCache(window=60, capacity=10 ** 7)
+    start = time.perf_counter()
+    for i in range(1_000_000):
+        now = i / 2000
+        key = ('fp', i)
+        cache.find([key], now)
+        cache.remember([key], i, now)
+    elapsed = time.perf_counter() - start
+    print(f"  1,000,000 транзакций потоком при окне 60 с: {elapsed:.2f} мкс на проверку+запись, "
+          f"в кэше {len(cache.entries):,} (≈ 60 с × 2,000)")
+    # Старше окна в кэше не задерживается
+    assert len(cache.entries) <= 60 * 2000 + 1
+
+
+async def run_dedup_flow():
+    """То же сообщение дважды, пересланная копия и иначе записанные реквизиты дают одну транзакцию"""
+    stub = install_stub_bot()
+    db = main.db
+    db.set_agent('agent_one')
+    db.start_session(10_000)
+    text = "+79001234567\n500!\n💚Сбер💚\nsir+77@outluk.ru"
+    updates = [
+        make_update(1, text, BENCH_ADMIN, 1),
+        make_update(1, text, BENCH_ADMIN, 1),                                           # повторная доставка
+        make_update(2, text, BENCH_ADMIN, 1),                                           # переслано заново
+        make_update(3, "💚Сбер💚 500! sir+77@outluk.ru +79001234567", BENCH_ADMIN, 1),  # в другом порядке
+        make_update(4, text.replace('500!', '700!'), BENCH_ADMIN, 1),                   # другая сумма
+    ]
+    for update in updates:
+        await main.dp.process_update(update)
+    await drain_outbound()
+    replies = [data['text'] for method, data in stub.calls if method == 'sendMessage' and '♻️' in data['text']]
+    notifications = sum(1 for method, data in stub.calls if method == 'sendMessage' and data['text'] == 'Выберите действие:')
+    print(f"dedup: {len(updates)} сообщений -> {len(db.transactions)} транзакции, уведомлений агенту {notifications}, "
+          f"оборот {db.session.total_amount}₽")
+    print(f"  ответ на повтор: {replies[0]}")
+    assert len(db.transactions) == 2 and len(replies) == 3 and notifications == 2
+
+
+def requisites_block(count, start=0, separator='\n\n'):
+    return separator.join(requisites_message(start + i) for i in range(count))
+
+
+async def run_bulk_flow(count=20):
+    """Блок из 20 реквизитов одним сообщением против 20 отдельных сообщений"""
+    stub = install_stub_bot()
+    db = main.db
+    for name in ('agent_one', 'agent2', 'agent3'):
+        db.set_agent(name)
+    db.start_session(100_000)
+    await main.dp.process_update(make_update(1, "Реквизиты на сегодня:\n" + requisites_block(count), BENCH_ADMIN, 1))
+    await drain_outbound()
+    block_calls = Counter(method for method, _ in stub.calls)
+    summary = next(data['text'] for method, data in stub.calls if method == 'sendMessage' and '📥' in data['text'])
+    assert len(db.transactions) == count
+
+    # Без пустых строк, с неполной записью, повтором внутри блока и уже принятой записью
+    messy = "\n".join([requisites_message(100), "+79005550000\n700!\nsir+555@outluk.ru",
+                       requisites_message(101), requisites_message(101), requisites_message(0)])
+    await main.dp.process_update(make_update(2, messy, BENCH_ADMIN, 1))
+    await drain_outbound()
+    messy_summary = [data['text'] for method, data in stub.calls if method == 'sendMessage' and '📥' in data['text']][-1]
+    assert len(db.transactions) == count + 2
+
+    # Агент отмечает чеки в сводном уведомлении по одному: строки исчезают
+    notification = next(data for method, data in stub.calls
+                        if method == 'sendMessage' and data['text'].startswith('💫 @agent_one'))
+    markup = main.types.InlineKeyboardMarkup.to_object(json.loads(notification['reply_markup']))
+    for i, data in enumerate([row[0].callback_data for row in markup.inline_keyboard]):
+        update = make_callback(1000 + i, data, 'agent_one', 2)
+        update.callback_query.message.reply_markup = markup
+        await main.dp.process_update(update)
+        await drain_outbound()
+        markup.inline_keyboard = [row for row in markup.inline_keyboard if row[0].callback_data != data]
+    done = [tx for tx in db.transactions if tx.agent_username == 'agent_one' and tx.receipt_sent]
+    edits = Counter(method for method, _ in stub.calls if method.startswith('edit'))
+
+    stub = install_stub_bot()
+    for name in ('agent_one', 'agent2', 'agent3'):
+        main.db.set_agent(name)
+    for i in range(count):
+        await main.dp.process_update(make_update(i + 1, requisites_message(i), BENCH_ADMIN, 1))
+    await drain_outbound()
+    single_calls = Counter(method for method, _ in stub.calls)
+
+    print(f"bulk: {count} реквизитов")
+    print(f"  одним блоком:       вызовов Bot API {sum(block_calls.values()):>3} ({dict(block_calls)})")
+    print(f"  отдельными сообщ.:  вызовов Bot API {sum(single_calls.values()):>3} ({dict(single_calls)})")
+    print("  сводка: " + " | ".join(summary.splitlines()[:3]) + " | …")
+    print("  блок с ошибками: " + " | ".join(messy_summary.splitlines()))
+    print(f"  @agent_one отметил {len(done)} чеков из сводного уведомления: {dict(edits)}")
+
+
+def bench_bulk(sizes=(100, 500, 1000)):
+    """Разбор блока реквизитов на записи и приём блока целиком"""
+    asyncio.run(run_bulk_flow())
+
+    # Телефон и почта повторяются внутри записи (цитата, пересылка) — это одна запись, а не две
+    record = requisites_message(7)
+    phone, _, _, email = record.splitlines()
+    quoted = [f"{phone}\n> {phone}, {email}\n" + "\n".join(record.splitlines()[1:]),
+              f"{record}\nЧек пришлите на {email}, номер {phone}"]
+    for text in quoted:
+        records = main.split_records(text)
+        assert len(records) == 1 and not main.missing_requisites(main.extract_requisites(records[0]))
+    # А тот же телефон после полной записи — уже следующая оплата
+    assert len(main.split_records(f"{record}\n{record.replace('507!', '700!')}")) == 2
+    print(f"bulk: повторы телефона и почты внутри записи — {len(quoted)} случая, лишних записей нет")
+
+    print("bulk: разбор блоков")
+    for size in sizes:
+        for label, separator in (('через пустую строку', '\n\n'), ('подряд', '\n')):
+            text = requisites_block(size, separator=separator)
+            start = time.perf_counter()
+            records = main.split_records(text)
+            split = time.perf_counter() - start
+            start = time.perf_counter()
+            parsed = [main.extract_requisites(record) for record in records]
+            extract = time.perf_counter() - start
+            assert len(records) == size and all(not main.missing_requisites(data) for data in parsed)
+            print(f"  {size:>5} записей {label:<20} деление {split / size * 1e6:>5.1f} мкс/запись, "
+                  f"извлечение {extract / size * 1e6:>5.1f} мкс/запись, весь блок {(split + extract) * 1e3:>6.1f} мс")
+
+    for size in sizes:
+        install_stub_bot()
+        for name in ('agent_one', 'agent2', 'agent3'):
+            main.db.set_agent(name)
+        message = make_update(1, requisites_block(size), BENCH_ADMIN, 1).message
+        start = time.perf_counter()
+        asyncio.run(main.handle_admin_data(message, message.text))
+        elapsed = time.perf_counter() - start
+        print(f"  handle_admin_data, {size:>5} записей: {elapsed * 1e3:>6.1f} мс "
+              f"({elapsed / size * 1e6:.0f} мкс/запись), транзакций {len(main.db.transactions)}")
+        assert len(main.db.transactions) == size
+
+
+# ========== РАССЫЛКА ==========
+class BroadcastTelegram(FakeTelegram):
+    """Bot API с задержкой ответа, заблокировавшими бота, разовыми 429 и 5xx"""
+
+    def __init__(self, latency=0.02, blocked=(), flood=(), flaky=()):
+        super().__init__()
+        self.latency = latency
+        self.blocked = set(blocked)
+        self.flood = set(flood)
+        self.flaky = set(flaky)
+        self.delivered = Counter()
+        self.edits = []
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if method not in ('sendMessage', 'editMessageText'):
+            return await super().handle(request)
+        data = await request.post()
+        chat_id = int(data['chat_id'])
+        await asyncio.sleep(self.latency)
+        if method == 'editMessageText':
+            self.edits.append(data['text'])
+            return await super().handle(request)
+        if chat_id in self.blocked:
+            return web.json_response({'ok': False, 'error_code': 403,
+                                      'description': 'Forbidden: bot was blocked by the user'}, status=403)
+        if chat_id in self.flood:
+            self.flood.discard(chat_id)
+            return web.json_response({'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                      'parameters': {'retry_after': 1}}, status=429)
+        if chat_id in self.flaky:
+            self.flaky.discard(chat_id)
+            return web.json_response({'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}, status=502)
+        if data['text'].startswith('📨'):
+            self.delivered[chat_id] += 1
+        return await super().handle(request)
+
+
+async def run_broadcast(recipients, concurrency, rate_limits=True, **faults):
+    fake = BroadcastTelegram(**faults)
+    await fake.start()
+    bot = fake.make_bot()
+    main.bot = bot
+    main.dp.bot = bot
+    main.Bot.set_current(bot)
+    main.db = main.Database()
+    main.outbound = (main.OutboundQueue() if rate_limits else
+                     main.OutboundQueue(global_rate=1e9, group_rate=1e9, private_rate=1e9))
+    for user_id in range(1, recipients + 1):
+        main.db.add_user(user_id, f'user{user_id}', 'Bench', 'agent' if user_id % 10 == 0 else 'user')
+    concurrency_was = main.BROADCAST_CONCURRENCY
+    main.Broadcast.__init__.__defaults__ = (concurrency,)
+    try:
+        start = time.perf_counter()
+        await main.dp.process_update(make_update(1, '/broadcast all Собрание в 18:00', BENCH_ADMIN, 1, chat_id=1))
+        while main.active_broadcast:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        return fake, elapsed
+    finally:
+        main.Broadcast.__init__.__defaults__ = (concurrency_was,)
+        await main.outbound.close()
+        await (await bot.get_session()).close()
+        await fake.stop()
+
+
+def bench_broadcast(recipients=300):
+    """Рассылка на локальный Bot API: параллельность, лимиты Telegram, сбои и заблокировавшие бота"""
+    rnd = random.Random(22)
+    users = range(2, recipients + 1)
+    faults = {'blocked': rnd.sample(users, recipients // 20), 'flood': rnd.sample(users, 5),
+              'flaky': rnd.sample(users, 10)}
+    print(f"broadcast: {recipients} получателей, ответ Bot API 20 мс, лимиты Telegram сняты")
+    for concurrency in (1, 5, 20, 50):
+        fake, elapsed = asyncio.run(run_broadcast(recipients, concurrency, rate_limits=False))
+        print(f"  параллельно {concurrency:>2}: {elapsed:>6.2f} с, {recipients / elapsed:>6.0f} сообщ/с")
+        # Каждому доставлено ровно одно сообщение
+        assert set(fake.delivered.values()) == {1} and len(fake.delivered) == recipients
+
+    print(f"broadcast: {recipients} получателей с лимитом 30 сообщ/с, "
+          f"{len(faults['blocked'])} заблокировали бота, 5 × 429, 10 × 502")
+    fake, elapsed = asyncio.run(run_broadcast(recipients, 20, **{k: list(v) for k, v in faults.items()}))
+    delivered = sum(fake.delivered.values())
+    print(f"  {elapsed:.2f} с ({delivered / elapsed:.1f} сообщ/с), доставлено {delivered}, "
+          f"повторно никому: {all(n == 1 for n in fake.delivered.values())}, правок прогресса {len(fake.edits)}")
+    print("  " + fake.edits[-1].replace("\n", " | "))
+    # Получатель 1 — сам админ, ему тоже уходит рассылка
+    assert delivered == recipients - len(faults['blocked']) and set(fake.delivered.values()) == {1}
+    # 429 повторяет только очередь отправки, рассылка повторяет лишь 5xx — по разу на сбой
+    print(f"  повторов после 429 в очереди отправки: {main.outbound.retried}")
+    assert main.outbound.retried == len(faults['flood']) and f"Повторов: {len(faults['flaky'])}," in fake.edits[-1]
+
+
+# ========== КОНВЕЙЕР АПДЕЙТОВ ==========
+class OrderProbe(main.BaseMiddleware):
+    """Запоминает, в каком порядке хендлеры закончили работу, сколько их шло одновременно и сколько слотов было занято"""
+
+    def __init__(self):
+        super().__init__()
+        self.finished = defaultdict(list)
+        self.running = 0
+        self.peak = 0
+        self.slots_peak = 0
+
+    async def on_process_message(self, message, data):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.slots_peak = max(self.slots_peak, main.pipeline.busy)
+
+    async def on_post_process_message(self, message, results, data):
+        self.running -= 1
+        self.finished[message.chat.id].append(message.message_id)
+
+
+def pipeline_updates(chats, per_chat):
+    """В каждом чате: цель сессии, затем реквизиты; все чаты вперемешку"""
+    updates = []
+    for n in range(per_chat):
+        for chat in range(chats):
+            chat_id = -1000 - chat
+            message_id = n + 1
+            text = '/rub 100000000' if n == 0 else requisites_message(chat * per_chat + n)
+            update = make_update(chat * per_chat + n, text, BENCH_ADMIN, 1, chat_id=chat_id)
+            update.message.message_id = message_id
+            updates.append(update)
+    return updates
+
+
+async def run_pipeline(chats, per_chat, ordered, outbound_limit=None, **limits):
+    stub = install_stub_bot(latency=0.005)
+    main.pipeline = main.ChatPipeline(**limits)
+    if outbound_limit:
+        # Очередь отправки медленнее хендлеров: 1000 сообщ/с на бота
+        main.outbound = main.OutboundQueue(global_rate=1000, group_rate=1e9, private_rate=1e9, limit=outbound_limit)
+    for name in ('agent_one', 'agent2', 'agent3'):
+        main.db.set_agent(name)
+    probe = OrderProbe()
+    main.dp.middleware.setup(probe)
+    updates = pipeline_updates(chats, per_chat)
+    process = main.dp.process_update if ordered else lambda update: main.Dispatcher.process_update(main.dp, update)
+
+    pending_peak = 0
+
+    async def watch():
+        nonlocal pending_peak
+        while True:
+            pending_peak = max(pending_peak, main.pipeline.pending)
+            await asyncio.sleep(0.001)
+
+    watcher = asyncio.ensure_future(watch())
+    tracemalloc.start()
+    start = time.perf_counter()
+    # Как при polling с fast=True: вся пачка сразу через gather
+    await asyncio.gather(*(process(update) for update in updates))
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    watcher.cancel()
+    main.dp.middleware.applications.remove(probe)
+    sending = main.outbound.stats()
+    await main.outbound.close()
+
+    db = main.db
+    requisites = chats * (per_chat - 1)
+    # Счётчики сходятся: столько транзакций, сколько реквизитов, id подряд, итоги агентов = итог сессии
+    ids = [tx.id for tx in db.transactions]
+    assert len(ids) == requisites and ids == list(range(1, requisites + 1))
+    assert sum(stats.total_amount for stats in db.agent_stats.values()) == sum(tx.amount for tx in db.transactions)
+    assert sum(db.scheduler.outstanding.values()) == requisites
+    out_of_order = sum(1 for finished in probe.finished.values() if finished != sorted(finished))
+    return elapsed, len(updates), probe, pending_peak, out_of_order, memory, main.pipeline.stats(), sending
+
+
+def bench_pipeline(chats=50, per_chat=61):
+    """Тысячи апдейтов сразу: порядок внутри чата, согласованность счётчиков, предел параллельности и очереди"""
+    print(f"pipeline: {chats} чатов × {per_chat} апдейтов одной пачкой, ответ Bot API до 5 мс")
+    runs = [('без конвейера', False, {}),
+            ('конвейер, 16 обработчиков', True, {}),
+            ('конвейер, 4 обработчика', True, {'workers': 4}),
+            ('конвейер, очередь ≤ 500', True, {'max_pending': 500}),
+            ('конвейер, ≤ 20 на чат', True, {'max_per_chat': 20}),
+            ('конвейер, отправка ≤ 200', True, {'outbound_limit': 200})]
+    for label, ordered, limits in runs:
+        elapsed, count, probe, pending_peak, out_of_order, memory, stats, sending = asyncio.run(
+            run_pipeline(chats, per_chat, ordered, **limits))
+        print(f"  {label:<26} {count / elapsed:>6,.0f} апд/с  хендлеров сразу до {probe.peak:>4}  "
+              f"слотов до {probe.slots_peak:>2}  в очереди до {pending_peak:>4}  "
+              f"чатов не по порядку {out_of_order:>2}/{chats}  "
+              f"пик памяти {memory / 2 ** 20:>5.1f} МБ  ждали места {stats['throttled']}  "
+              f"отправок в очереди до {sending['max_depth']:>5}, ждали её {sending['throttled_updates']}")
+        if ordered:
+            workers = limits.get('workers', main.PIPELINE_WORKERS)
+            assert out_of_order == 0 and probe.slots_peak <= workers
+            # Хендлер реквизитов ставит 3 сообщения: сверх limit — только отправки уже идущих хендлеров
+            assert sending['max_depth'] <= limits.get('outbound_limit', main.OUTBOUND_MAX_DEPTH) + 3 * workers
+
+    print("pipeline: реквизиты в группу с настоящими лимитами Telegram, следом нажатие кнопки")
+    for requisites in (4, 20):
+        answered, released, sends = asyncio.run(run_callback_behind_requisites(requisites))
+        print(f"  {requisites:>2} сообщений реквизитов: ответ на кнопку через {answered * 1e3:>6.1f} мс, "
+              f"конвейер свободен через {released * 1e3:>6.1f} мс, ждут лимита группы {sends} отправок")
+        assert answered < 1 and released < 1
+
+
+async def run_callback_behind_requisites(requisites):
+    stub = install_stub_bot()
+    main.outbound = main.OutboundQueue()
+    main.db.set_agent('agent_one')
+    updates = [make_update(1, '/rub 100000000', BENCH_ADMIN, 1, chat_id=-1001)]
+    updates += [make_update(i + 2, requisites_message(i), BENCH_ADMIN, 1, chat_id=-1001) for i in range(requisites)]
+    updates.append(make_callback(requisites + 2, 'back_to_main', BENCH_ADMIN, 1, chat_id=-1001))
+
+    start = time.perf_counter()
+    handlers = asyncio.ensure_future(asyncio.gather(*(main.dp.process_update(update) for update in updates)))
+    while not any(method == 'answerCallbackQuery' for method, _ in stub.calls):
+        await asyncio.sleep(0.001)
+    answered = time.perf_counter() - start
+    # Отправки, упёршиеся в лимит группы, доставит очередь — цепочку чата и слоты они не держат
+    while main.pipeline.pending or main.pipeline.busy:
+        await asyncio.sleep(0.001)
+    released = time.perf_counter() - start
+    sends = main.outbound.depth()
+    handlers.cancel()
+    main.outbound._worker.cancel()
+    return answered, released, sends
+
+
+# ========== ПРЕДФИЛЬТР ==========
+def chatter_stream(count, seed=24):
+    """Живая группа: почти всё — болтовня участников, изредка админ со своими сообщениями и реквизитами"""
+    rng = random.Random(seed)
+    stream = []
+    for i in range(count):
+        kind = rng.choices(['chatter', 'mention', 'admin_chatter', 'requisites', 'command'],
+                           weights=[85, 5, 6, 3, 1])[0]
+        user_id = rng.randint(1000, 1999)
+        if kind == 'chatter':
+            text = rng.choice(CHATTER)
+        elif kind == 'mention':
+            # Участники тоже пишут "@кому-то" и даже "агент @..." — админами они от этого не становятся
+            text = rng.choice([f'@user{user_id} глянь', f'агент @agent{rng.randint(1, 5)} где чек?'])
+        elif kind == 'admin_chatter':
+            stream.append(make_update(i, rng.choice(CHATTER), BENCH_ADMIN, 1))
+            continue
+        elif kind == 'requisites':
+            stream.append(make_update(i, requisites_message(i), BENCH_ADMIN, 1))
+            continue
+        else:
+            text = '/help'
+        stream.append(make_update(i, text, f'user{user_id}', user_id))
+    return stream
+
+
+async def run_prefilter(count, enabled):
+    stub = install_stub_bot()
+    main.db.set_agent('agent_one')
+    prefilter = main.PrefilterMiddleware()
+    if enabled:
+        main.dp.middleware.setup(prefilter)
+    # Оригинальный предфильтр бота на время замера снимаем, чтобы сравнить с ним и без него
+    main.dp.middleware.applications.remove(main.prefilter)
+    try:
+        stream = chatter_stream(count)
+        start = time.perf_counter()
+        for update in stream:
+            # Как polling и webhook: через updates_handler, где срабатывают pre_process_update
+            await main.dp.updates_handler.notify(update)
+        elapsed = time.perf_counter() - start
+    finally:
+        main.dp.middleware.applications.append(main.prefilter)
+        if enabled:
+            main.dp.middleware.applications.remove(prefilter)
+    await drain_outbound()
+    calls = Counter(method for method, _ in stub.calls)
+    return elapsed, prefilter, calls, len(main.db.transactions)
+
+
+def bench_prefilter(count=50_000):
+    """Поток группы, где почти всё — болтовня: сколько стоит сообщение с предфильтром и без"""
+    print(f"prefilter: {count:,} сообщений группы (85% болтовня участников)")
+    results = {}
+    for label, enabled in (('без предфильтра', False), ('с предфильтром', True)):
+        elapsed, prefilter, calls, transactions = asyncio.run(run_prefilter(count, enabled))
+        results[enabled] = (calls, transactions)
+        print(f"  {label:<16} {count / elapsed:>8,.0f} сообщ/с  {elapsed / count * 1e6:>6.1f} мкс/сообщ  "
+              f"транзакций {transactions}, вызовов Bot API {sum(calls.values())}")
+        if enabled:
+            print(f"  отсеяно {prefilter.dropped:,}, пропущено {prefilter.passed:,}: "
+                  + ", ".join(f"{result} {reason} {n:,}" for (result, reason), n in sorted(main.PREFILTER_TOTAL.values.items())))
+    # Предфильтр ничего полезного не отсекает: те же ответы и те же транзакции
+    assert results[True] == results[False]
+
+
+# ========== МЕДИА ==========
+class MediaTelegram(FakeTelegram):
+    """Bot API, принимающий загрузки фото и видео и выдающий на них file_id"""
+
+    METHODS = {'sendPhoto': 'photo', 'sendVideo': 'video', 'sendAnimation': 'animation'}
+
+    def __init__(self):
+        super().__init__()
+        self.files = {}            # file_id -> (поле, размер)
+        self.uploaded_bytes = 0
+        self.sends = Counter()     # 'upload' / 'file_id' / 'rejected' / 'failed'
+        self.video_as_animation = False  # Как Telegram с mp4 без звука: сохраняет его как animation
+        self.missing_chats = set()
+
+    @staticmethod
+    def bad_request(description):
+        return web.json_response({'ok': False, 'error_code': 400, 'description': f'Bad Request: {description}'},
+                                 status=400)
+
+    async def handle(self, request):
+        method = request.match_info['method']
+        if method not in self.METHODS:
+            return await super().handle(request)
+        field = self.METHODS[method]
+        data = await request.post()
+        if int(data['chat_id']) in self.missing_chats:
+            self.sends['failed'] += 1
+            return self.bad_request('chat not found')
+        media = data[field]
+        if isinstance(media, str):
+            if media not in self.files:
+                self.sends['rejected'] += 1
+                return self.bad_request('wrong file identifier/HTTP URL specified')
+            if self.files[media][0] != field:
+                self.sends['rejected'] += 1
+                return self.bad_request('type of file mismatch')
+            self.sends['file_id'] += 1
+            file_id, size = media, self.files[media][1]
+        else:
+            size = len(media.file.read())
+            self.uploaded_bytes += size
+            self.sends['upload'] += 1
+            if field == 'video' and self.video_as_animation:
+                field = 'animation'
+            file_id = f'{field}-{len(self.files) + 1}'
+            self.files[file_id] = (field, size)
+        self.last_message_id += 1
+        sent = {'file_id': file_id, 'file_unique_id': file_id, 'file_size': size}
+        if field == 'photo':
+            sent = [dict(sent, width=90, height=90), dict(sent, width=1280, height=1280)]
+        else:
+            sent.update(width=720, height=1280, duration=10)
+        return self.ok({'message_id': self.last_message_id, 'date': int(time.time()),
+                        'chat': {'id': int(data['chat_id']), 'type': 'private'}, field: sent})
+
+
+async def run_media(presses, tmp):
+    fake = MediaTelegram()
+    await fake.start()
+    bot = fake.make_bot()
+    main.bot = bot
+    main.Bot.set_current(bot)
+    main.outbound = main.OutboundQueue(global_rate=1e9, group_rate=1e9, private_rate=1e9)
+    storage = main.SQLiteStorage(os.path.join(tmp, 'media.db'))
+    try:
+        async def timed_round(label, cache, count, chats=1):
+            main.media_cache = cache
+            before = dict(fake.sends), fake.uploaded_bytes
+            start = time.perf_counter()
+            for i in range(count):
+                await asyncio.gather(*(main.send_help_media(100 + chat, filename, 'caption')
+                                       for chat in range(chats) for filename in ('check.mp4', 'example_screenshot.png')))
+            elapsed = time.perf_counter() - start
+            sends = {kind: n - before[0].get(kind, 0) for kind, n in fake.sends.items() if n - before[0].get(kind, 0)}
+            print(f"  {label:<38} {elapsed / (count * chats * 2) * 1e3:>7.2f} мс/отправку  "
+                  f"загружено {(fake.uploaded_bytes - before[1]) / 2 ** 20:>5.1f} МБ  {sends}")
+            return sends
+
+        cache = main.MediaCache()
+        cache.open(storage)
+        # Первая отправка — загрузка; пять чатов сразу не грузят файл пять раз
+        first = await timed_round('первые отправки, 5 чатов одновременно', cache, 1, chats=5)
+        assert first['upload'] == 2
+        await timed_round(f'повторные отправки ×{presses}', cache, presses)
+
+        # Файл заменили: другой хеш — одна новая загрузка (меняется копия во временной папке)
+        with open(os.path.join(main.MEDIA_DIR, 'check.mp4'), 'ab') as f:
+            f.write(b'\0')
+        changed = await timed_round('check.mp4 изменён', cache, 3)
+        assert changed['upload'] == 1
+
+        # Рестарт: file_id берутся из SQLite, загрузок нет
+        await asyncio.get_event_loop().run_in_executor(None, storage.flush)
+        restarted = main.MediaCache()
+        restarted.open(storage)
+        after_restart = await timed_round('после рестарта (file_id из SQLite)', restarted, 3)
+        assert 'upload' not in after_restart
+
+        # Telegram забыл file_id (другой токен бота): отказ, загрузка, дальше снова по file_id
+        fake.files.clear()
+        rejected = await timed_round('Telegram отверг file_id', restarted, 3)
+        assert rejected['rejected'] == 2 and rejected['upload'] == 2
+
+        # Чат не найден: к файлу это не относится — file_id не сбрасывается, повторной загрузки нет
+        fake.missing_chats.add(100)
+        try:
+            await main.send_help_media(100, 'check.mp4', 'caption')
+        except main.ChatNotFound:
+            pass
+        fake.missing_chats.clear()
+        missing = await timed_round('после «chat not found»', restarted, 1)
+        assert fake.sends['failed'] == 1 and 'upload' not in missing and restarted.rejected == 2
+
+        # mp4 сохранён как animation: дальше он уходит через sendAnimation по file_id, а не грузится снова
+        fake.files.clear()
+        fake.video_as_animation = True
+        animation = await timed_round('mp4 сохранён как animation', main.MediaCache(), 3)
+        assert animation['upload'] == 2 and animation['file_id'] == 4 and 'rejected' not in animation
+        print(f"  итого: загрузок {fake.sends['upload']}, по file_id {fake.sends['file_id']}, "
+              f"отвергнуто {fake.sends['rejected']}")
+    finally:
+        storage.close()
+        await main.outbound.close()
+        await (await bot.get_session()).close()
+        await fake.stop()
+
+
+def bench_media(presses=20):
+    """Медиа справки: загрузка один раз, дальше file_id; смена файла, отказ Telegram и рестарт"""
+    print("media: check.mp4 (2.8 МБ) и example_screenshot.png (0.3 МБ) через локальный Bot API")
+    media_dir = main.MEDIA_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        # Бенч меняет файл — работаем с копией, файлы репозитория не трогаем
+        main.MEDIA_DIR = shutil.copytree(media_dir, os.path.join(tmp, 'media'))
+        try:
+            asyncio.run(run_media(presses, tmp))
+        finally:
+            main.MEDIA_DIR = media_dir
+
+
+BENCHMARKS = {
+    'storage': bench_storage,
+    'lookups': bench_lookups,
+    'extract': bench_extract,
+    'handlers': bench_handlers,
+    'outbound': bench_outbound,
+    'keyboards': bench_keyboards,
+    'aggregates': bench_aggregates,
+    'memory': bench_memory,
+    'delivery': bench_delivery,
+    'scheduler': bench_scheduler,
+    'receipts': bench_receipts,
+    'metrics': bench_metrics,
+    'profile': bench_profile,
+    'export': bench_export,
+    'ledger': bench_ledger,
+    'startup': bench_startup,
+    'callbacks': bench_callbacks,
+    'tokens': bench_tokens,
+    'dedup': bench_dedup,
+    'bulk': bench_bulk,
+    'broadcast': bench_broadcast,
+    'pipeline': bench_pipeline,
+    'prefilter': bench_prefilter,
+    'media': bench_media,
+}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -6,15 +6,40 @@ Telegram Bot с премиум эмодзи через Telethon/Hikka
 
 import os
 import re
+import csv
+import gzip
+import json
+import ssl
+import sys
+import hmac
+import hashlib
+import time
+import datetime
+import heapq
+import queue
+import pstats
+import cProfile
+import sqlite3
 import logging
 import asyncio
-from collections import defaultdict
+import tempfile
+import threading
+import bisect
+import itertools
+import contextvars
+from collections import defaultdict, deque, Counter, OrderedDict
+from aiohttp import web
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ChatType
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.handler import current_handler, ctx_data, CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import (RetryAfter, MessageNotModified, Unauthorized, ChatNotFound, NetworkError,
+                                      RestartingTelegram, TelegramAPIError, BadRequest, WrongFileIdentifier,
+                                      WrongRemoteFileIdSpecified)
 
 # ========== НАСТРОЙКИ ==========
 logging.basicConfig(
@@ -26,50 +51,1297 @@ logger = logging.getLogger(__name__)
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 API_ID = os.getenv('API_ID', '')
 API_HASH = os.getenv('API_HASH', '')
+DB_PATH = os.getenv('DB_PATH', '')  # Не задан — хранение только в памяти; в контейнере — путь на томе
+
+# Режим запуска: polling (по умолчанию) или webhook
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '')  # Внешний адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SSL_CERT = os.getenv('WEBHOOK_SSL_CERT', '')  # Свой сертификат, если TLS терминирует сам бот
+WEBHOOK_SSL_KEY = os.getenv('WEBHOOK_SSL_KEY', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+
+# Распределение реквизитов между агентами: round_robin, least_outstanding или weighted
+ASSIGN_POLICIES = ('round_robin', 'least_outstanding', 'weighted')
+ASSIGN_POLICY = os.getenv('ASSIGN_POLICY', 'least_outstanding')
+# Веса для weighted в виде "agent1:3,agent2:1", у остальных агентов вес 1
+AGENT_WEIGHTS = {
+    name.strip().lstrip('@'): float(weight)
+    for name, weight in (item.split(':') for item in os.getenv('AGENT_WEIGHTS', '').split(',') if item.strip())
+}
+
+# Сроки по чекам (в секундах): напоминание агенту, затем передача другому агенту.
+# Чеки старше RECEIPT_GIVE_UP_AFTER больше не эскалируются, но остаются в статистике
+RECEIPT_REMIND_AFTER = int(os.getenv('RECEIPT_REMIND_AFTER', '600'))
+RECEIPT_REASSIGN_AFTER = int(os.getenv('RECEIPT_REASSIGN_AFTER', '1800'))
+RECEIPT_GIVE_UP_AFTER = int(os.getenv('RECEIPT_GIVE_UP_AFTER', '86400'))
+RECEIPT_TICK = 1.0
+RECEIPT_RESUME_PER_TICK = 5  # Сколько просроченных за время простоя чеков эскалировать за тик
+
+# Кнопки чеков несут короткий токен вместо id и username; сколько токен живёт и сколько их держим
+CALLBACK_TOKEN_TTL = int(os.getenv('CALLBACK_TOKEN_TTL', str(7 * 24 * 3600)))
+CALLBACK_TOKEN_CAPACITY = int(os.getenv('CALLBACK_TOKEN_CAPACITY', '100000'))
+CALLBACK_TOKEN_PRUNE_INTERVAL = 3600  # Как часто удалять из SQLite просроченные токены
+
+# Повторно присланные реквизиты (то же сообщение или та же почта+телефон+сумма) в течение окна не считаются
+DEDUP_WINDOW = int(os.getenv('DEDUP_WINDOW', str(6 * 3600)))
+DEDUP_CAPACITY = int(os.getenv('DEDUP_CAPACITY', '100000'))
+
+# Апдейты одного чата обрабатываются по очереди, разных чатов — параллельно, но не больше PIPELINE_WORKERS сразу.
+# Сверх PIPELINE_MAX_PENDING апдейтов в ожидании новые не принимаются, пока очередь не разойдётся
+PIPELINE_WORKERS = int(os.getenv('PIPELINE_WORKERS', '16'))
+PIPELINE_MAX_PENDING = int(os.getenv('PIPELINE_MAX_PENDING', '2000'))
+PIPELINE_MAX_PER_CHAT = int(os.getenv('PIPELINE_MAX_PER_CHAT', '200'))
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics, 0 — не поднимать сервер
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
 
 if not BOT_TOKEN:
     logger.error("❌ BOT_TOKEN не установлен!")
     exit(1)
 
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+if ASSIGN_POLICY not in ASSIGN_POLICIES:
+    logger.warning(f"⚠️ Неизвестная политика ASSIGN_POLICY={ASSIGN_POLICY}, используется least_outstanding")
+    ASSIGN_POLICY = 'least_outstanding'
+
+# ========== МЕТРИКИ ==========
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class MetricCounter:
+    """Счётчик с метками: значения лежат в dict по кортежу меток"""
+    kind = 'counter'
+    
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(int)
+    
+    def inc(self, *labels, amount=1):
+        self.values[labels] += amount
+    
+    def samples(self):
+        for labels, value in self.values.items():
+            yield self.name + _format_labels(self.labels, labels), value
+
+class Histogram:
+    """Гистограмма задержек: наблюдение — bisect и три сложения, накопление бакетов только при выдаче"""
+    kind = 'histogram'
+    
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # метки -> [счётчики по бакетам, сумма, количество]
+    
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+    
+    def samples(self):
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket
+                yield self.name + '_bucket' + _format_labels(self.labels, labels, f'le="{bound}"'), cumulative
+            yield self.name + '_sum' + _format_labels(self.labels, labels), total
+            yield self.name + '_count' + _format_labels(self.labels, labels), count
+
+class CollectedMetric:
+    """Значения, которые считываются в момент запроса /metrics (размеры базы, очереди)"""
+    
+    def __init__(self, name, help, collect, labels=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labels = labels
+        self.kind = kind
+    
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in values.items():
+            yield self.name + _format_labels(self.labels, labels), value
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+    
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self):
+        """Текстовый формат экспозиции Prometheus"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for sample, value in metric.samples():
+                lines.append(f"{sample} {value}")
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.register(Histogram(
+    'bot_handler_seconds', 'Время обработки апдейта хендлером', ('handler',)))
+HANDLER_ERRORS = metrics.register(MetricCounter(
+    'bot_handler_errors_total', 'Исключения в хендлерах', ('handler', 'error')))
+API_SECONDS = metrics.register(Histogram(
+    'bot_api_request_seconds', 'Время запросов к Telegram', ('transport', 'method')))
+API_ERRORS = metrics.register(MetricCounter(
+    'bot_api_errors_total', 'Ошибки запросов к Telegram', ('transport', 'method', 'error')))
+PREFILTER_TOTAL = metrics.register(MetricCounter(
+    'bot_prefilter_total', 'Сообщения после предфильтра', ('result', 'reason')))
+PIPELINE_WAIT = metrics.register(Histogram(
+    'bot_pipeline_wait_seconds', 'Ожидание апдейта в конвейере до начала обработки'))
+
+class MeteredBot(Bot):
+    """Bot, который засекает время каждого запроса к Bot API"""
+    
+    async def get_updates(self, *args, **kwargs):
+        # Long polling: пока конвейер переполнен, новые апдейты не забираем — Telegram подержит их у себя
+        await pipeline.wait_for_room()
+        return await super().get_updates(*args, **kwargs)
+    
+    async def request(self, method, data=None, files=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            API_ERRORS.inc('bot_api', method, type(e).__name__)
+            raise
+        finally:
+            # getUpdates — это long polling, его время ничего не говорит о задержках
+            if method != 'getUpdates':
+                API_SECONDS.observe(time.perf_counter() - start, 'bot_api', method)
+
+# Имя хендлера текущего апдейта — чтобы обработчик ошибок знал, кто упал
+handler_name = contextvars.ContextVar('handler_name', default='unknown')
+
+class MetricsMiddleware(BaseMiddleware):
+    """Время работы хендлеров: от выбора хендлера до конца обработки апдейта"""
+    
+    @staticmethod
+    def _start(data):
+        name = getattr(current_handler.get(), '__name__', 'unknown')
+        handler_name.set(name)
+        data['metrics_handler'] = name
+        data['metrics_start'] = time.perf_counter()
+    
+    @staticmethod
+    def _finish(data):
+        start = data.get('metrics_start')
+        if start is not None:
+            HANDLER_SECONDS.observe(time.perf_counter() - start, data['metrics_handler'])
+    
+    async def on_process_message(self, message, data):
+        self._start(data)
+    
+    async def on_post_process_message(self, message, results, data):
+        self._finish(data)
+    
+    async def on_process_callback_query(self, callback_query, data):
+        self._start(data)
+    
+    async def on_post_process_callback_query(self, callback_query, results, data):
+        self._finish(data)
+
+# ========== КОНВЕЙЕР АПДЕЙТОВ ==========
+def update_chat_id(update: types.Update):
+    """Чат апдейта; None — у апдейта нет чата (inline-запросы и т.п.)"""
+    message = update.message or update.edited_message or update.channel_post or update.edited_channel_post
+    if message:
+        return message.chat.id
+    if update.callback_query:
+        callback = update.callback_query
+        return callback.message.chat.id if callback.message else callback.from_user.id
+    member = update.my_chat_member or update.chat_member
+    if member:
+        return member.chat.id
+    return None
+
+class ChatPipeline:
+    """
+    aiogram обрабатывает апдейты одновременно, а хендлеры меняют общий db и ждут отправки.
+    Здесь апдейты одного чата выстраиваются в цепочку: следующий начинается, когда закончен
+    предыдущий, поэтому реквизиты и подтверждения применяются в порядке поступления.
+    Разные чаты идут параллельно, но не больше workers обработок сразу.
+    Каждый апдейт обрабатывается в своей задаче aiogram — контекст (текущий бот, апдейт, FSM) не теряется.
+    """
+    
+    def __init__(self, workers=PIPELINE_WORKERS, max_pending=PIPELINE_MAX_PENDING, max_per_chat=PIPELINE_MAX_PER_CHAT):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_chat = max_per_chat
+        self._slots = None          # обработки, идущие сейчас
+        self._capacity = None       # места в очереди; ждущие будятся по одному, в порядке прихода
+        self._room = None           # для long polling: очередь перестала быть полной
+        self._chat_capacity = {}    # chat_id -> Semaphore(max_per_chat)
+        self._tails = {}            # chat_id -> future последнего апдейта чата в цепочке
+        self.per_chat = Counter()   # chat_id -> апдейтов в ожидании и в работе
+        self.pending = 0
+        self.max_seen = 0
+        self.busy = 0
+        self.processed = 0
+        self.throttled = 0          # сколько раз апдейт ждал места в очереди
+    
+    def _ensure(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+            self._capacity = asyncio.Semaphore(self.max_pending)
+            self._room = asyncio.Event()
+    
+    async def wait_for_room(self):
+        """Ждёт, пока в очереди появится место (не занимая его)"""
+        self._ensure()
+        while self._capacity.locked():
+            self._room.clear()
+            await self._room.wait()
+    
+    async def submit(self, update, process):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            return await process(update)
+        
+        self._ensure()
+        chat_capacity = self._chat_capacity.get(chat_id)
+        if chat_capacity is None:
+            chat_capacity = self._chat_capacity[chat_id] = asyncio.Semaphore(self.max_per_chat)
+        self.per_chat[chat_id] += 1
+        if chat_capacity.locked() or self._capacity.locked():
+            self.throttled += 1
+        try:
+            async with chat_capacity, self._capacity:
+                return await self._run(chat_id, update, process)
+        finally:
+            self.per_chat[chat_id] -= 1
+            if not self.per_chat[chat_id]:
+                del self.per_chat[chat_id]
+                del self._chat_capacity[chat_id]
+            self._room.set()
+    
+    async def _run(self, chat_id, update, process):
+        previous = self._tails.get(chat_id)
+        done = self._tails[chat_id] = asyncio.get_event_loop().create_future()
+        self.pending += 1
+        self.max_seen = max(self.max_seen, self.pending)
+        queued_at = time.perf_counter()
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            async with self._slots:
+                PIPELINE_WAIT.observe(time.perf_counter() - queued_at)
+                self.busy += 1
+                try:
+                    return await process(update)
+                finally:
+                    self.busy -= 1
+                    self.processed += 1
+        finally:
+            if previous is not None and not previous.done():
+                # Отменили, не дождавшись очереди: следующий всё равно ждёт предыдущего
+                previous.add_done_callback(lambda _: done.set_result(None))
+            else:
+                done.set_result(None)
+            if self._tails.get(chat_id) is done:
+                del self._tails[chat_id]
+            self.pending -= 1
+    
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_seen,
+            'busy': self.busy,
+            'chats': len(self._tails),
+            'processed': self.processed,
+            'throttled': self.throttled,
+        }
+
+pipeline = ChatPipeline()
+
+class OrderedDispatcher(Dispatcher):
+    """Dispatcher, пропускающий каждый апдейт через конвейер (polling, webhook и process_updates)"""
+    
+    async def process_update(self, update: types.Update):
+        return await pipeline.submit(update, self._process)
+    
+    async def _process(self, update: types.Update):
+        # Очередь отправки переполнена: ждём в своём звене цепочки, порядок чата не меняется.
+        # Конвейер тем временем заполняется и останавливает getUpdates
+        await outbound.wait_for_room()
+        return await super().process_update(update)
+
+class PrefilterMiddleware(BaseMiddleware):
+    """
+    Отсекает сообщения, на которые бот всё равно не ответит, ещё до конвейера, фильтров и регулярок.
+    Без команды бот реагирует только на сообщения админов, и только если в тексте есть '@'
+    (агент @user, админ @user, почта sir+N@outluk.ru); исключение — ответ админа на вопрос FSM (/send).
+    """
+    
+    def __init__(self):
+        super().__init__()
+        self.passed = 0
+        self.dropped = 0
+    
+    def _drop(self, reason):
+        self.dropped += 1
+        PREFILTER_TOTAL.inc('dropped', reason)
+        raise CancelHandler()
+    
+    def _pass(self, reason):
+        self.passed += 1
+        PREFILTER_TOTAL.inc('passed', reason)
+    
+    async def on_pre_process_update(self, update: types.Update, data):
+        message = update.message
+        if message is None:
+            return
+        
+        text = message.text or ""
+        if text.startswith('/'):
+            return self._pass('command')
+        # active_admins меняется на месте (/add_admin, "админ @"), поэтому смотрим в само множество
+        user = message.from_user
+        if not user or user.username not in active_admins:
+            return self._drop('not_admin')
+        if '@' in text:
+            return self._pass('admin')
+        if await dp.current_state(chat=message.chat.id, user=user.id).get_state():
+            return self._pass('state')
+        self._drop('no_marker')
+
+bot = MeteredBot(token=BOT_TOKEN)
+dp = OrderedDispatcher(bot, storage=MemoryStorage())
+metrics_middleware = MetricsMiddleware()
+dp.middleware.setup(metrics_middleware)
+prefilter = PrefilterMiddleware()
+dp.middleware.setup(prefilter)
+
+@dp.errors_handler()
+async def count_handler_errors(update, exception):
+    # Только считаем: ошибку дальше, как и раньше, логирует aiogram
+    HANDLER_ERRORS.inc(handler_name.get(), type(exception).__name__)
 
 # ========== ДЛЯ ПРЕМИУМ ЭМОДЗИ ==========
-try:
-    # Попробуем использовать Telethon для премиум эмодзи
-    from telethon import TelegramClient
-    from telethon.tl.types import MessageEntityCustomEmoji
-    
-    telethon_client = None
-    if API_ID and API_HASH:
-        telethon_client = TelegramClient(
-            'bot_session',
-            int(API_ID),
-            API_HASH
-        )
+# Telethon импортируется и подключается в фоне, когда бот уже принимает апдейты:
+# премиум эмодзи нужны только в уведомлениях о чеках, а импорт и вход занимают секунды
+TelegramClient = None
+MessageEntityCustomEmoji = None
+FloodWaitError = None
+telethon_markdown = None
+
+def import_telethon():
+    """Импортирует Telethon в глобальные имена модуля; False, если он не установлен"""
+    global TelegramClient, MessageEntityCustomEmoji, FloodWaitError, telethon_markdown
+    try:
+        from telethon import TelegramClient
+        from telethon.tl.types import MessageEntityCustomEmoji
+        from telethon.errors import FloodWaitError
+        from telethon.extensions import markdown as telethon_markdown
+    except ImportError:
+        logger.warning("⚠️ Telethon не установлен. Премиум эмодзи будут отображаться как текст")
+        return False
+    return True
+
+TELETHON_HEALTH_INTERVAL = 30  # Секунды между проверками соединения
+TELETHON_MAX_BACKOFF = 300
+
+class TelethonTransport:
+    """
+    Постоянное соединение Telethon: импорт и подключение идут в фоне после старта,
+    дальше проверяем, что клиент на связи, и переподключаемся с нарастающей паузой.
+    Пока ready ложно, уведомления уходят через aiogram с обычным эмодзи.
+    """
+    
+    def __init__(self):
+        self.client = None
+        self.ready = False
+        self._peers = {}
+        self._monitor = None
+    
+    async def start(self):
+        """Не ждёт ни импорта, ни входа — только запускает фоновую задачу"""
+        self._monitor = asyncio.ensure_future(self._run())
+    
+    async def _run(self):
+        # Импорт тяжёлый и синхронный — в пуле потоков, чтобы не держать event loop
+        if not await asyncio.get_event_loop().run_in_executor(None, import_telethon):
+            return
+        
+        self.client = TelegramClient('bot_session', int(API_ID), API_HASH)
         logger.info("✅ Telethon клиент инициализирован для премиум эмодзи")
-except ImportError:
-    telethon_client = None
-    logger.warning("⚠️ Telethon не установлен. Премиум эмодзи будут отображаться как текст")
+        await self._watch()
+    
+    async def _connect(self):
+        await self.client.start(bot_token=BOT_TOKEN)
+        self.ready = True
+        logger.info("✅ Telethon клиент запущен")
+    
+    async def _watch(self):
+        backoff = 1
+        while True:
+            if not (self.ready and self.client.is_connected()):
+                self.ready = False
+                try:
+                    await self._connect()
+                    backoff = 1
+                except Exception as e:
+                    backoff = min(backoff * 2, TELETHON_MAX_BACKOFF)
+                    logger.error(f"❌ Telethon не подключился: {e}, следующая попытка через {backoff} с")
+            
+            await asyncio.sleep(TELETHON_HEALTH_INTERVAL if self.ready else backoff)
+    
+    async def send(self, chat_id, text, entities):
+        """Один RPC: peer берём из кэша, текст и entities уже готовы"""
+        peer = self._peers.get(chat_id)
+        if peer is None:
+            peer = self._peers[chat_id] = await self.client.get_input_entity(chat_id)
+        start = time.perf_counter()
+        try:
+            return await self.client.send_message(peer, text, formatting_entities=entities)
+        except Exception as e:
+            API_ERRORS.inc('telethon', 'send_message', type(e).__name__)
+            if isinstance(e, ConnectionError):
+                self.ready = False
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - start, 'telethon', 'send_message')
+    
+    async def stop(self):
+        if self._monitor:
+            self._monitor.cancel()
+        if self.client:
+            await self.client.disconnect()
+
+telethon_transport = TelethonTransport() if API_ID and API_HASH else None
+
+class PremiumTemplate:
+    """
+    Шаблон сообщения (Markdown) с премиум эмодзи в самом начале.
+    Эмодзи стоит первым, поэтому его MessageEntityCustomEmoji не зависит от подставленных
+    значений и собирается один раз на шаблон.
+    """
+    
+    def __init__(self, template, emoji, emoji_id):
+        self.template = f"{emoji} {template}"
+        self.emoji = emoji
+        self.emoji_id = emoji_id
+        self._emoji_entity = None
+    
+    def markdown(self, **fields):
+        """Текст для aiogram: обычный эмодзи вместо премиум"""
+        return self.template.format(**fields)
+    
+    def entities(self, **fields):
+        """Текст и entities для Telethon, включая премиум эмодзи"""
+        if self._emoji_entity is None:
+            # Длина в UTF-16, как считает Telegram
+            length = len(self.emoji.encode('utf-16-le')) // 2
+            self._emoji_entity = MessageEntityCustomEmoji(offset=0, length=length, document_id=self.emoji_id)
+        
+        text, entities = telethon_markdown.parse(self.markdown(**fields))
+        return text, [self._emoji_entity] + entities
+
+# ========== ХРАНИЛИЩЕ SQLITE ==========
+class SQLiteStorage:
+    """
+    Постоянное хранилище для Database (SQLite в режиме WAL).
+    Запись идёт в отдельном потоке пачками: event loop только кладёт операцию в очередь
+    и никогда не ждёт fsync.
+    """
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER NOT NULL UNIQUE,
+        username TEXT NOT NULL,
+        full_name TEXT,
+        role TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY,
+        phone TEXT,
+        amount INTEGER,
+        bank TEXT,
+        email TEXT,
+        agent_username TEXT,
+        timestamp REAL,
+        receipt_sent INTEGER NOT NULL DEFAULT 0,
+        receipt_sent_at REAL,
+        session_id INTEGER,
+        chat_id INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS sessions (
+        id INTEGER PRIMARY KEY,
+        target INTEGER,
+        started_at REAL,
+        stopped_at REAL
+    );
+    CREATE TABLE IF NOT EXISTS callback_tokens (
+        token TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS receipt_timers (
+        transaction_id INTEGER PRIMARY KEY,
+        since REAL NOT NULL,
+        reminded INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS media_cache (
+        sha256 TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        PRIMARY KEY (sha256, kind)
+    );
+    CREATE TABLE IF NOT EXISTS admins (
+        username TEXT PRIMARY KEY
+    );
+    CREATE TABLE IF NOT EXISTS state (
+        key TEXT PRIMARY KEY,
+        value
+    );
+    """
+
+    REPLAY_ATTEMPTS = 3   # Попыток на операцию, когда пачка откатилась
+    REPLAY_DELAY = 0.1
+
+    def __init__(self, path, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        # SimpleQueue: put без блокировок Condition — event loop тратит на операцию доли микросекунды
+        self._queue = queue.SimpleQueue()
+
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.executescript(self.SCHEMA)
+        # Базы, созданные до появления сессий и чата группы у транзакций
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(transactions)')}
+        if 'session_id' not in columns:
+            conn.execute('ALTER TABLE transactions ADD COLUMN session_id INTEGER')
+        if 'chat_id' not in columns:
+            conn.execute('ALTER TABLE transactions ADD COLUMN chat_id INTEGER')
+        conn.close()
+
+        self._thread = threading.Thread(target=self._writer, name='sqlite-writer', daemon=True)
+        self._thread.start()
+
+    def _writer(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        running = True
+
+        while running:
+            batch = [self._queue.get()]
+            # Групповой коммит: забираем всё, что накопилось, пока шла прошлая запись
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            ops = []
+            waiters = []
+            for op in batch:
+                if op is None:
+                    running = False
+                elif isinstance(op, threading.Event):
+                    waiters.append(op)
+                else:
+                    ops.append(op)
+            try:
+                with conn:
+                    for op in ops:
+                        conn.execute(*op)
+            except sqlite3.Error as e:
+                logger.warning(f"⚠️ Пачка из {len(ops)} операций откатилась ({e}), пишем по одной")
+                self._replay(conn, ops)
+
+            for waiter in waiters:
+                waiter.set()
+
+        conn.close()
+
+    def _replay(self, conn, ops):
+        """Пишет откатившуюся пачку по одной операции: плохая теряется одна, а не вместе с остальными"""
+        for op in ops:
+            for attempt in range(1, self.REPLAY_ATTEMPTS + 1):
+                try:
+                    with conn:
+                        conn.execute(*op)
+                    break
+                except sqlite3.Error as e:
+                    # База занята другим соединением — есть смысл подождать и повторить
+                    locked = isinstance(e, sqlite3.OperationalError) and 'locked' in str(e)
+                    if locked and attempt < self.REPLAY_ATTEMPTS:
+                        time.sleep(self.REPLAY_DELAY * attempt)
+                        continue
+                    logger.error(f"❌ Ошибка записи в SQLite: {e} ({op[0]})")
+                    break
+
+    def execute(self, sql, params=()):
+        self._queue.put((sql, params))
+
+    def flush(self, timeout=None):
+        """Блокирующе ждёт, пока всё из очереди будет записано (не вызывать в event loop)"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def pending(self):
+        return self._queue.qsize()
+
+    # ----- Операции -----
+    def save_user(self, user):
+        self.execute(
+            # upsert сохраняет rowid, а значит и порядок регистрации пользователей
+            'INSERT INTO users (id, username, full_name, role) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT(id) DO UPDATE SET username = excluded.username, '
+            'full_name = excluded.full_name, role = excluded.role',
+            (user['id'], user['username'], user['full_name'], user['role'])
+        )
+
+    def save_admin(self, username):
+        self.execute('INSERT OR IGNORE INTO admins (username) VALUES (?)', (username,))
+
+    def save_transaction(self, tx):
+        self.execute(
+            'INSERT OR REPLACE INTO transactions '
+            '(id, phone, amount, bank, email, agent_username, timestamp, receipt_sent, receipt_sent_at, session_id, '
+            'chat_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (tx.id, tx.phone, tx.amount, tx.bank, tx.email, tx.agent_username,
+             tx.timestamp, int(tx.receipt_sent), tx.receipt_sent_at, tx.session_id, tx.chat_id)
+        )
+
+    def save_receipt_sent(self, tx):
+        self.execute(
+            'UPDATE transactions SET receipt_sent = 1, receipt_sent_at = ? WHERE id = ?',
+            (tx.receipt_sent_at, tx.id)
+        )
+
+    def save_session(self, record):
+        self.execute(
+            'INSERT OR REPLACE INTO sessions (id, target, started_at, stopped_at) VALUES (?, ?, ?, ?)',
+            (record.id, record.target, record.started_at, record.stopped_at)
+        )
+
+    def save_callback_token(self, token, data, expires_at):
+        self.execute('INSERT OR REPLACE INTO callback_tokens (token, data, expires_at) VALUES (?, ?, ?)',
+                     (token, data, expires_at))
+
+    def delete_expired_callback_tokens(self, now):
+        self.execute('DELETE FROM callback_tokens WHERE expires_at < ?', (now,))
+
+    def load_callback_tokens(self, now):
+        """Живые токены кнопок; просроченные удаляются"""
+        self.delete_expired_callback_tokens(now)
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(
+                'SELECT token, data, expires_at FROM callback_tokens WHERE expires_at >= ? ORDER BY expires_at',
+                (now,)
+            ).fetchall()
+        finally:
+            conn.close()
+
+    def save_media_file_id(self, sha256, kind, file_id):
+        # У файла один file_id: видео, сохранённое Telegram как animation, заменяет прежнюю запись video
+        self.execute('DELETE FROM media_cache WHERE sha256 = ?', (sha256,))
+        self.execute('INSERT INTO media_cache (sha256, kind, file_id) VALUES (?, ?, ?)',
+                     (sha256, kind, file_id))
+
+    def save_receipt_timer(self, transaction_id, since, reminded):
+        self.execute('INSERT OR REPLACE INTO receipt_timers (transaction_id, since, reminded) VALUES (?, ?, ?)',
+                     (transaction_id, since, int(reminded)))
+
+    def delete_receipt_timer(self, transaction_id):
+        self.execute('DELETE FROM receipt_timers WHERE transaction_id = ?', (transaction_id,))
+
+    def load_receipt_timers(self):
+        """id транзакции -> (с какого момента ждём агента, было ли напоминание)"""
+        conn = sqlite3.connect(self.path)
+        try:
+            return {row[0]: (row[1], bool(row[2]))
+                    for row in conn.execute('SELECT transaction_id, since, reminded FROM receipt_timers')}
+        finally:
+            conn.close()
+
+    def load_media_file_ids(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute('SELECT sha256, kind, file_id FROM media_cache').fetchall()
+        finally:
+            conn.close()
+
+    def save_state(self, **values):
+        for key, value in values.items():
+            self.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, value))
+
+    def load(self):
+        """Читает всё сохранённое состояние одним проходом по каждой таблице"""
+        conn = sqlite3.connect(self.path)
+        try:
+            users = conn.execute('SELECT id, username, full_name, role FROM users ORDER BY rowid').fetchall()
+            transactions = conn.execute(
+                'SELECT id, phone, amount, bank, email, agent_username, timestamp, receipt_sent, receipt_sent_at, '
+                'session_id, chat_id FROM transactions ORDER BY id'
+            ).fetchall()
+            admins = [row[0] for row in conn.execute('SELECT username FROM admins')]
+            state = dict(conn.execute('SELECT key, value FROM state'))
+            sessions = conn.execute('SELECT id, target, started_at, stopped_at FROM sessions ORDER BY id').fetchall()
+        finally:
+            conn.close()
+        return users, transactions, admins, state, sessions
 
 # ========== БАЗА ДАННЫХ ==========
-class Database:
+AGENT_RECENT_LIMIT = 20  # Сколько последних транзакций агента держать под рукой
+
+class Transaction:
+    """
+    Транзакция в компактном виде: __slots__ вместо dict, повторяющиеся строки
+    (банк, агент, домен почты) интернированы.
+    Читается и пишется как словарь: tx['amount'], tx.get('receipt_sent_at'), tx['receipt_sent'] = True.
+    """
+    __slots__ = ('id', 'phone', 'amount', 'bank', 'email_user', 'email_domain',
+                 'agent_username', 'timestamp', 'session_id', 'chat_id', 'receipt_sent', 'receipt_sent_at')
+    
+    KEYS = ('id', 'phone', 'amount', 'bank', 'email', 'agent_username',
+            'timestamp', 'session_id', 'chat_id', 'receipt_sent', 'receipt_sent_at')
+    
+    def __init__(self, id, phone, amount, bank, email, agent_username,
+                 timestamp, receipt_sent=False, receipt_sent_at=None, session_id=None, chat_id=None):
+        self.id = id
+        self.phone = phone
+        self.amount = amount
+        self.bank = sys.intern(bank) if bank else bank
+        self.email = email
+        self.agent_username = sys.intern(agent_username) if agent_username else agent_username
+        self.timestamp = timestamp
+        self.receipt_sent = bool(receipt_sent)
+        self.receipt_sent_at = receipt_sent_at
+        self.session_id = session_id  # Номер сессии /rub, в которую попала транзакция
+        self.chat_id = chat_id        # Группа, куда пришли реквизиты и где ждут чек
+    
+    @property
+    def email(self):
+        if self.email_domain is None:
+            return self.email_user
+        return f"{self.email_user}@{self.email_domain}"
+    
+    @email.setter
+    def email(self, email):
+        self.email_user = email
+        self.email_domain = None
+        if email and '@' in email:
+            user, _, domain = email.rpartition('@')
+            self.email_user = user
+            self.email_domain = sys.intern(domain)
+    
+    def __getitem__(self, key):
+        if key not in self.KEYS or (key == 'receipt_sent_at' and self.receipt_sent_at is None):
+            raise KeyError(key)
+        return getattr(self, key)
+    
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+    
+    def __contains__(self, key):
+        return key in self.keys()
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        # receipt_sent_at появляется, только когда чек отправлен — как было в dict
+        return self.KEYS if self.receipt_sent_at is not None else self.KEYS[:-1]
+    
+    def to_dict(self):
+        return {key: getattr(self, key) for key in self.keys()}
+    
+    copy = to_dict
+    
+    def __repr__(self):
+        return f"Transaction({self.to_dict()!r})"
+
+class Aggregate:
+    """Нарастающие итоги без хранения самих транзакций: сумма, количество, суммы по банкам, последние id"""
+    __slots__ = ('total_amount', 'count', 'by_bank', 'recent_ids')
+    
+    def __init__(self, recent=AGENT_RECENT_LIMIT):
+        self.total_amount = 0
+        self.count = 0
+        self.by_bank = {}
+        self.recent_ids = deque(maxlen=recent)
+    
+    def add(self, transaction):
+        amount = transaction.amount
+        bank = transaction.bank
+        self.total_amount += amount
+        self.count += 1
+        self.by_bank[bank] = self.by_bank.get(bank, 0) + amount
+        self.recent_ids.append(transaction.id)
+    
+    def remove(self, transaction):
+        self.total_amount -= transaction.amount
+        self.count -= 1
+        self.by_bank[transaction.bank] -= transaction.amount
+        if transaction.id in self.recent_ids:
+            self.recent_ids.remove(transaction.id)
+
+class AgentScheduler:
+    """Выбор агента для новых реквизитов.
+    
+    round_robin — по очереди; least_outstanding — агент с наименьшим числом
+    неотправленных чеков; weighted — то же, но нагрузка делится на вес агента.
+    Нагрузка лежит в куче с ленивым удалением: устаревшие записи
+    отбрасываются при выборе, поэтому обновление и выбор — O(log n).
+    """
+    
+    def __init__(self, policy='least_outstanding', weights=None):
+        self.policy = policy
+        self.weights = weights or {}
+        self.outstanding = Counter()
+        self._heap = []
+        self._order = itertools.count()
+        self._next = 0
+    
+    def _load(self, username):
+        if self.policy == 'weighted':
+            # +1: при равной нулевой нагрузке первым идёт агент с большим весом
+            return (self.outstanding[username] + 1) / self.weights.get(username, 1)
+        return self.outstanding[username]
+    
+    def track(self, username):
+        """Добавляет агента в кучу с его текущей нагрузкой"""
+        self.outstanding.setdefault(username, 0)
+        heapq.heappush(self._heap, (self._load(username), next(self._order), username))
+        # Устаревшие записи копятся только при смене нагрузки — изредка пересобираем кучу
+        if len(self._heap) > 4 * len(self.outstanding) + 64:
+            self._heap = [(self._load(name), next(self._order), name) for name in self.outstanding]
+            heapq.heapify(self._heap)
+    
+    def assigned(self, username):
+        self.outstanding[username] += 1
+        self.track(username)
+    
+    def completed(self, username):
+        if self.outstanding[username] > 0:
+            self.outstanding[username] -= 1
+            self.track(username)
+    
+    def pick(self, candidates):
+        """Возвращает username агента из candidates или None, если выбирать не из кого"""
+        if not candidates:
+            return None
+        
+        if self.policy == 'round_robin':
+            names = list(candidates)
+            username = names[self._next % len(names)]
+            self._next += 1
+            return username
+        
+        skipped = []
+        try:
+            while self._heap:
+                load, _, username = self._heap[0]
+                if load != self._load(username):
+                    # Запись устарела: нагрузка агента с тех пор изменилась
+                    heapq.heappop(self._heap)
+                elif username in candidates:
+                    return username
+                else:
+                    # Запись верна, но агент не подходит именно сейчас (исключён) — вернём её в кучу
+                    skipped.append(heapq.heappop(self._heap))
+            
+            # Ни одного кандидата в куче — добавляем их с текущей нагрузкой
+            for username in candidates:
+                self.track(username)
+            return min(candidates, key=self._load)
+        finally:
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+
+class TimerWheel:
+    """
+    Хешированное колесо таймеров: постановка и отмена за O(1),
+    на тике просматривается только один слот, а не все таймеры.
+    Таймер дальше одного оборота колеса ждёт нужное число кругов в своём слоте.
+    """
+    
+    def __init__(self, tick=RECEIPT_TICK, slots=512, now=None):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.where = {}  # ключ -> номер слота, для отмены
+        self.current = 0
+        self.last = time.time() if now is None else now
+    
+    def __len__(self):
+        return len(self.where)
+    
+    def schedule(self, key, delay, payload=None):
+        self.cancel(key)
+        ticks = max(1, int(-(-delay // self.tick)))
+        slot = (self.current + ticks) % len(self.slots)
+        self.slots[slot][key] = [(ticks - 1) // len(self.slots), payload]
+        self.where[key] = slot
+    
+    def cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+    
+    def advance(self, now):
+        """Проворачивает колесо до now и возвращает сработавшие таймеры [(ключ, payload)]"""
+        expired = []
+        while self.last + self.tick <= now:
+            self.last += self.tick
+            self.current = (self.current + 1) % len(self.slots)
+            bucket = self.slots[self.current]
+            for key in list(bucket):
+                entry = bucket[key]
+                if entry[0]:
+                    entry[0] -= 1
+                else:
+                    del bucket[key]
+                    del self.where[key]
+                    expired.append((key, entry[1]))
+        return expired
+
+class ReceiptTracker:
+    """
+    Неотправленные чеки и их сроки: сначала напоминание, потом передача другому агенту.
+    Стадия и начало ожидания пишутся в storage, чтобы после рестарта продолжить с того же места.
+    """
+    
+    def __init__(self, remind_after=RECEIPT_REMIND_AFTER, reassign_after=RECEIPT_REASSIGN_AFTER,
+                 give_up_after=RECEIPT_GIVE_UP_AFTER, tick=RECEIPT_TICK):
+        self.remind_after = remind_after
+        self.reassign_after = reassign_after
+        self.give_up_after = give_up_after
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+        self.pending = {}  # id транзакции -> (транзакция, чат группы, с какого момента ждём агента)
+        self.storage = None
+        self.overdue = 0   # Просроченных за время простоя: их сроки разносятся по тикам
+        self.reminders = 0
+        self.reassigned = 0
+    
+    def watch(self, transaction, chat_id=None, since=None, reminded=False):
+        """Ставит (или переставляет после смены агента) сроки по чеку"""
+        now = time.time()
+        since = now if since is None else since
+        self.pending[transaction.id] = (transaction, chat_id, since)
+        if now - transaction.timestamp >= self.give_up_after:
+            self.wheel.cancel(transaction.id)
+            return
+        
+        stage = 'reassign' if reminded else 'remind'
+        delay = since + (self.reassign_after if reminded else self.remind_after) - now
+        if delay <= 0:
+            # Срок вышел, пока бот лежал: не больше RECEIPT_RESUME_PER_TICK таких чеков за тик,
+            # иначе после рестарта все напоминания разом забьют очередь группы
+            delay = self.tick * (1 + self.overdue // RECEIPT_RESUME_PER_TICK)
+            self.overdue += 1
+        self.wheel.schedule(transaction.id, delay, stage)
+        # Новый чек ждёт с момента создания — так его и восстановит open(), строка не нужна
+        if self.storage and (reminded or since != transaction.timestamp):
+            self.storage.save_receipt_timer(transaction.id, since, reminded)
+    
+    def done(self, transaction_id):
+        self.wheel.cancel(transaction_id)
+        if self.pending.pop(transaction_id, None) and self.storage:
+            self.storage.delete_receipt_timer(transaction_id)
+    
+    def due(self, now=None):
+        """Сработавшие сроки: [(стадия, транзакция, чат)], стадия — 'remind' или 'reassign'"""
+        now = time.time() if now is None else now
+        actions = []
+        for transaction_id, stage in self.wheel.advance(now):
+            transaction, chat_id, since = self.pending[transaction_id]
+            if stage == 'remind':
+                self.reminders += 1
+                self.wheel.schedule(transaction_id, since + self.reassign_after - now, 'reassign')
+                if self.storage:
+                    self.storage.save_receipt_timer(transaction_id, since, True)
+            else:
+                self.reassigned += 1
+            actions.append((stage, transaction, chat_id))
+        return actions
+    
+    def stats(self, now=None):
+        """Сколько чеков ждёт и как давно (перцентили возраста в секундах)"""
+        now = time.time() if now is None else now
+        ages = sorted(now - transaction.timestamp for transaction, _, _ in self.pending.values())
+        
+        def percentile(q):
+            return ages[min(len(ages) - 1, int(len(ages) * q))] if ages else 0
+        
+        return {
+            'pending': len(ages),
+            'scheduled': len(self.wheel),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': ages[-1] if ages else 0,
+            'reminders': self.reminders,
+            'reassigned': self.reassigned,
+        }
+
+def requisites_fingerprint(phone, amount, email):
+    """Ключ реквизитов без учёта записи: регистр почты, пробелы и скобки в телефоне, +7/8"""
+    digits = re.sub(r'\D', '', phone or '')[-10:]
+    return (email or '').strip().lower(), digits, int(amount or 0)
+
+class DedupCache:
+    """
+    Ключ (id сообщения или отпечаток реквизитов) -> (id транзакции, когда принята).
+    Записи лежат в порядке поступления, поэтому устаревшие всегда в начале и срезаются
+    за амортизированное O(1); сверх capacity вытесняются самые старые.
+    """
+    
+    def __init__(self, window=DEDUP_WINDOW, capacity=DEDUP_CAPACITY):
+        self.window = window
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+    
+    def _expire(self, now):
+        entries = self.entries
+        deadline = now - self.window
+        while entries:
+            key, (tx_id, seen_at) = next(iter(entries.items()))
+            if seen_at >= deadline:
+                break
+            del entries[key]
+    
+    def find(self, keys, now=None):
+        """id транзакции, уже принятой по одному из ключей, или None"""
+        self._expire(time.time() if now is None else now)
+        for key in keys:
+            entry = self.entries.get(key)
+            if entry:
+                self.hits += 1
+                return entry[0]
+        return None
+    
+    def remember(self, keys, tx_id, now=None):
+        now = time.time() if now is None else now
+        for key in keys:
+            # Повторная вставка должна уйти в конец, иначе порядок по времени нарушится
+            self.entries.pop(key, None)
+            self.entries[key] = (tx_id, now)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+PACE_WINDOW_MINUTES = 10  # За сколько последних минут считать текущий темп
+
+class SessionRecord:
+    """Одна сессия /rub: цель, итог, время и оборот по минутам от начала"""
+    __slots__ = ('id', 'target', 'started_at', 'stopped_at', 'total', 'count', 'buckets')
+    
+    def __init__(self, id, target, started_at, stopped_at=None):
+        self.id = id
+        self.target = target
+        self.started_at = started_at
+        self.stopped_at = stopped_at
+        self.total = 0
+        self.count = 0
+        self.buckets = defaultdict(int)  # минута от начала сессии -> оборот
+    
+    def add(self, amount, timestamp):
+        self.total += amount
+        self.count += 1
+        self.buckets[int((timestamp - self.started_at) // 60)] += amount
+    
+    def duration(self, now=None):
+        end = self.stopped_at or (time.time() if now is None else now)
+        return max(0.0, end - self.started_at)
+    
+    def pace(self, now=None):
+        """Средний оборот в минуту за всю сессию"""
+        minutes = self.duration(now) / 60
+        return self.total / minutes if minutes >= 1 else float(self.total)
+    
+    def recent_pace(self, now=None, window=PACE_WINDOW_MINUTES):
+        """Оборот в минуту за последние window минут (для остановленной — перед остановкой)"""
+        minutes = self.duration(now) / 60
+        last = int(minutes)
+        window = max(1, min(window, last + 1))
+        return sum(self.buckets.get(minute, 0) for minute in range(last - window + 1, last + 1)) / window
+    
+    def eta(self, now=None):
+        """Секунд до цели при текущем темпе; None — если цели нет или темп нулевой"""
+        if not self.target or self.total >= self.target:
+            return 0 if self.target else None
+        pace = self.recent_pace(now) or self.pace(now)
+        return (self.target - self.total) / pace * 60 if pace else None
+
+class SessionLedger:
+    """История сессий: каждая хранит итог и оборот по минутам, учёт транзакции — O(1)"""
+    
     def __init__(self):
+        self.sessions = {}
+        self.current = None
+    
+    def start(self, session_id, target, now=None):
+        now = time.time() if now is None else now
+        if self.current and self.current.stopped_at is None:
+            self.current.stopped_at = now
+        self.current = self.sessions[session_id] = SessionRecord(session_id, target, now)
+        return self.current
+    
+    def stop(self, now=None):
+        if self.current and self.current.stopped_at is None:
+            self.current.stopped_at = time.time() if now is None else now
+        return self.current
+    
+    def add(self, transaction):
+        record = self.sessions.get(transaction.session_id)
+        if record:
+            record.add(transaction.amount, transaction.timestamp)
+    
+    def history(self, limit=None):
+        """Завершённые сессии, последние первыми"""
+        finished = [record for record in reversed(self.sessions.values()) if record.stopped_at is not None]
+        return finished[:limit] if limit else finished
+
+class Database:
+    def __init__(self, storage=None):
+        self.storage = storage
         self.users = {}
         self.agents = {}
         self.transactions = []
-        self.agent_stats = defaultdict(lambda: {'total_amount': 0, 'transactions': []})
+        # Индексы вместо линейных проходов по users/transactions
+        self.users_by_username = {}
+        self.transactions_by_id = {}
+        self.next_agent_id = -1
+        # Растёт при любом изменении пользователей, агентов и транзакций (для кэша клавиатур)
+        self.version = 0
+        # Итоги по агентам и по текущей сессии — постоянный объём памяти на агента
+        self.agent_stats = defaultdict(Aggregate)
+        self.session = Aggregate()
+        self.scheduler = AgentScheduler(ASSIGN_POLICY, AGENT_WEIGHTS)
+        self.receipts = ReceiptTracker()
+        self.ledger = SessionLedger()
+        self.dedup = DedupCache()
         self.transaction_counter = 1
         self.session_counter = 1
         self.current_target = 0
-        self.current_amount = 0
         self.active_session = False
-        self.last_transaction_for_agent = None
+    
+    @property
+    def current_amount(self):
+        return self.session.total_amount
+    
+    def open(self, storage):
+        """Подключает постоянное хранилище и восстанавливает из него состояние"""
+        self.storage = storage
+        users, transactions, admins, state, sessions = storage.load()
+        timers = storage.load_receipt_timers()
+        
+        for user_id, username, full_name, role in users:
+            user = {'id': user_id, 'username': username, 'full_name': full_name, 'role': role}
+            self.users[user_id] = user
+            self.users_by_username.setdefault(username, user)
+            self.next_agent_id = min(self.next_agent_id, user_id - 1)
+            if role == 'agent':
+                self.agents[username] = user
+        
+        for row in sessions:
+            self.ledger.current = self.ledger.sessions[row[0]] = SessionRecord(*row)
+        
+        # Последняя начатая /rub (идёт она или уже остановлена) — её итоги показывает статистика
+        last_session = state.get('session_counter', self.session_counter) - 1
+        for row in transactions:
+            transaction = Transaction(*row)
+            self.transactions.append(transaction)
+            self.transactions_by_id[transaction.id] = transaction
+            # Итоги и минутные корзины сессий восстанавливаются из самих транзакций
+            self.ledger.add(transaction)
+            if transaction.session_id == last_session:
+                self.session.add(transaction)
+            if transaction.agent_username:
+                self.agent_stats[transaction.agent_username].add(transaction)
+                if not transaction.receipt_sent:
+                    self.scheduler.outstanding[transaction.agent_username] += 1
+                    # Продолжаем с сохранённой стадии: напоминание после рестарта не повторяется
+                    since, reminded = timers.get(transaction.id, (transaction.timestamp, False))
+                    self.receipts.watch(transaction, transaction.chat_id, since=since, reminded=reminded)
+        
+        # Сроки уже лежат в базе — дальше пишем только их изменения
+        self.receipts.storage = storage
+        
+        # Отпечатки недавних транзакций — чтобы повтор сразу после рестарта тоже распознавался
+        deadline = time.time() - self.dedup.window
+        for transaction in self.transactions:
+            if transaction.timestamp >= deadline:
+                self.dedup.remember([requisites_fingerprint(transaction.phone, transaction.amount, transaction.email)],
+                                    transaction.id, transaction.timestamp)
+        
+        for username in self.agents:
+            self.scheduler.track(username)
+        
+        if self.transactions:
+            self.transaction_counter = self.transactions[-1].id + 1
+        
+        active_admins.update(admins)
+        
+        self.session_counter = state.get('session_counter', self.session_counter)
+        self.current_target = state.get('current_target', self.current_target)
+        if not self.session.count:
+            # Сессия из базы, где у транзакций ещё не было session_id: известна только сумма
+            self.session.total_amount = state.get('current_amount', 0)
+        self.active_session = bool(state.get('active_session', self.active_session))
+        if self.active_session and self.session_counter - 1 not in self.ledger.sessions:
+            # Сессия начата до появления истории сессий — считаем её с момента рестарта
+            self._save_ledger(self.ledger.start(self.session_counter - 1, self.current_target))
+        self.version += 1
+        
+        logger.info(f"✅ Загружено из {storage.path}: {len(self.users)} пользователей, "
+                    f"{len(self.transactions)} транзакций")
+    
+    def close(self):
+        if self.storage:
+            self.storage.close()
+    
+    def _save_session_state(self):
+        if self.storage:
+            self.storage.save_state(
+                session_counter=self.session_counter,
+                current_target=self.current_target,
+                current_amount=self.current_amount,
+                active_session=int(self.active_session)
+            )
         
     def add_user(self, user_id, username, full_name, role='user'):
         username = username or f"user_{user_id}"
         
         if user_id not in self.users:
+            self.version += 1
             self.users[user_id] = {
                 'id': user_id,
                 'username': username,
@@ -77,21 +1349,24 @@ class Database:
                 'role': role
             }
             
+            self.users_by_username.setdefault(username, self.users[user_id])
+            
             if username in active_admins:
                 self.users[user_id]['role'] = 'admin'
                 logger.info(f"Зарегистрирован админ: {username}")
             
             if role == 'agent':
                 self.agents[username] = self.users[user_id]
+                self.scheduler.track(username)
+            
+            if self.storage:
+                self.storage.save_user(self.users[user_id])
     
     def get_user(self, user_id):
         return self.users.get(user_id)
     
     def get_user_by_username(self, username):
-        for user in self.users.values():
-            if user['username'] == username:
-                return user
-        return None
+        return self.users_by_username.get(username)
     
     def get_user_by_id(self, user_id):
         return self.users.get(user_id)
@@ -99,7 +1374,9 @@ class Database:
     def set_agent(self, username, full_name=""):
         agent = self.get_user_by_username(username)
         if not agent:
-            agent_id = -len(self.agents) - 1
+            # Отрицательные id не переиспользуются, иначе новый агент затрёт удалённого
+            agent_id = self.next_agent_id
+            self.next_agent_id -= 1
             agent = {
                 'id': agent_id,
                 'username': username,
@@ -107,9 +1384,14 @@ class Database:
                 'role': 'agent'
             }
             self.users[agent_id] = agent
-            self.agents[username] = agent
+            self.users_by_username[username] = agent
         
+        self.agents[username] = agent
         agent['role'] = 'agent'
+        self.scheduler.track(username)
+        self.version += 1
+        if self.storage:
+            self.storage.save_user(agent)
         return agent
     
     def add_admin_by_username(self, username):
@@ -117,10 +1399,15 @@ class Database:
             active_admins.add(username)
             logger.info(f"Добавлен новый админ: {username}")
         
-        for user in self.users.values():
-            if user['username'] == username:
-                user['role'] = 'admin'
-                break
+        if self.storage:
+            self.storage.save_admin(username)
+        
+        user = self.users_by_username.get(username)
+        if user:
+            user['role'] = 'admin'
+            self.version += 1
+            if self.storage:
+                self.storage.save_user(user)
     
     def get_all_users(self):
         return [user for user in self.users.values() 
@@ -134,85 +1421,166 @@ class Database:
             agent = self.agents[username]
             agent['role'] = 'user'
             del self.agents[username]
+            self.version += 1
+            if self.storage:
+                self.storage.save_user(agent)
             return True
         return False
     
     def delete_all_agents(self):
         for agent in list(self.agents.values()):
             agent['role'] = 'user'
+            if self.storage:
+                self.storage.save_user(agent)
         self.agents.clear()
+        self.version += 1
     
     def start_session(self, target_amount):
+        if self.active_session:
+            self._save_ledger(self.ledger.stop())
         self.current_target = target_amount
-        self.current_amount = 0
+        self.session = Aggregate()
         self.active_session = True
         self.session_counter += 1
+        self._save_ledger(self.ledger.start(self.session_counter - 1, target_amount))
+        self._save_session_state()
         return self.session_counter - 1
     
     def stop_session(self):
         self.active_session = False
+        self._save_ledger(self.ledger.stop())
+        self._save_session_state()
         return self.current_amount
     
-    def add_transaction(self, phone, amount, bank, email, agent_username=None):
-        transaction = {
-            'id': self.transaction_counter,
-            'phone': phone,
-            'amount': amount,
-            'bank': bank,
-            'email': email,
-            'agent_username': agent_username,
-            'timestamp': asyncio.get_event_loop().time(),
-            'receipt_sent': False
-        }
+    def _save_ledger(self, record):
+        if self.storage and record:
+            self.storage.save_session(record)
+    
+    def find_duplicate(self, phone, amount, email, message_key=None):
+        """Уже принятая в окне DEDUP_WINDOW транзакция с теми же реквизитами или из того же сообщения"""
+        keys = [requisites_fingerprint(phone, amount, email)]
+        if message_key:
+            keys.append(message_key)
+        tx_id = self.dedup.find(keys)
+        return self.transactions_by_id.get(tx_id) if tx_id is not None else None
+    
+    def add_transactions(self, records, chat_id=None):
+        """
+        Пачка транзакций из одного сообщения: records — (данные, ключ сообщения).
+        Агент назначается на каждую по очереди, так что планировщик видит уже розданные из пачки.
+        Строки уходят в SQLite одним групповым коммитом, итог сессии сохраняется один раз.
+        """
+        transactions = [
+            self.add_transaction(data['phone'], data['amount'], data['bank'], data['email'],
+                                 self.assign_agent() or "agent",
+                                 chat_id=chat_id, message_key=message_key, save_state=False)
+            for data, message_key in records
+        ]
+        if self.storage and self.active_session and transactions:
+            self.storage.save_state(current_amount=self.current_amount)
+        return transactions
+    
+    def add_transaction(self, phone, amount, bank, email, agent_username=None, chat_id=None, message_key=None,
+                        save_state=True):
+        transaction = Transaction(self.transaction_counter, phone, amount, bank, email,
+                                  agent_username, time.time(),
+                                  session_id=self.session_counter - 1 if self.active_session else None,
+                                  chat_id=chat_id)
         self.transactions.append(transaction)
-        
-        self.last_transaction_for_agent = transaction.copy()
-        self.last_transaction_for_agent['id'] = self.transaction_counter
+        self.transactions_by_id[transaction.id] = transaction
         
         if agent_username:
-            self.agent_stats[agent_username]['total_amount'] += amount
-            self.agent_stats[agent_username]['transactions'].append(transaction)
+            self.agent_stats[agent_username].add(transaction)
+            self.scheduler.assigned(agent_username)
+            self.receipts.watch(transaction, chat_id, since=transaction.timestamp)
         
         self.transaction_counter += 1
+        self.version += 1
+        
+        keys = [requisites_fingerprint(phone, amount, email)]
+        if message_key:
+            keys.append(message_key)
+        self.dedup.remember(keys, transaction.id, transaction.timestamp)
         
         if self.active_session:
-            self.current_amount += amount
+            self.session.add(transaction)
+            self.ledger.add(transaction)
+        
+        if self.storage:
+            self.storage.save_transaction(transaction)
+            if self.active_session and save_state:
+                self.storage.save_state(current_amount=self.current_amount)
         
         return transaction
     
     def get_last_transaction_for_agent(self):
-        return self.last_transaction_for_agent
+        return self.transactions[-1] if self.transactions else None
     
     def mark_receipt_sent(self, transaction_id, agent_username):
-        for tx in self.transactions:
-            if tx['id'] == transaction_id and tx.get('agent_username') == agent_username:
-                tx['receipt_sent'] = True
-                tx['receipt_sent_at'] = asyncio.get_event_loop().time()
-                return True
+        tx = self.transactions_by_id.get(transaction_id)
+        if tx and tx.agent_username == agent_username:
+            if not tx.receipt_sent:
+                self.scheduler.completed(agent_username)
+                self.receipts.done(transaction_id)
+            tx.receipt_sent = True
+            tx.receipt_sent_at = time.time()
+            self.version += 1
+            if self.storage:
+                self.storage.save_receipt_sent(tx)
+            return True
         return False
     
+    def assign_agent(self, exclude=None):
+        """Агент для новых реквизитов; админы в списке агентов — только если других нет"""
+        candidates = {username: agent for username, agent in self.agents.items()
+                      if agent['role'] == 'agent' and username != exclude}
+        return self.scheduler.pick(candidates or
+                                   {username: agent for username, agent in self.agents.items()
+                                    if username != exclude})
+    
+    def reassign_transaction(self, transaction_id, agent_username, chat_id=None):
+        """Передаёт неотправленный чек другому агенту; возвращает прежнего агента"""
+        tx = self.transactions_by_id.get(transaction_id)
+        if not tx or tx.receipt_sent or tx.agent_username == agent_username:
+            return None
+        
+        previous = tx.agent_username
+        if previous:
+            self.agent_stats[previous].remove(tx)
+            self.scheduler.completed(previous)
+        tx.agent_username = sys.intern(agent_username)
+        self.agent_stats[agent_username].add(tx)
+        self.scheduler.assigned(agent_username)
+        self.receipts.watch(tx, chat_id)
+        self.version += 1
+        if self.storage:
+            self.storage.save_transaction(tx)
+        return previous
+    
     def get_transactions(self):
         return self.transactions[-10:]
     
     def get_agent_transactions(self, agent_username):
-        agent_tx = []
-        for tx in self.transactions:
-            if tx.get('agent_username') == agent_username:
-                agent_tx.append(tx)
-        return agent_tx[-20:]
+        stats = self.agent_stats.get(agent_username)
+        if not stats:
+            return []
+        return [self.transactions_by_id[tx_id] for tx_id in stats.recent_ids]
     
     def get_agent_stats(self, agent_username):
-        stats = self.agent_stats.get(agent_username, {'total_amount': 0, 'transactions': []})
+        stats = self.agent_stats.get(agent_username) or Aggregate()
         return {
-            'total_amount': stats['total_amount'],
-            'transaction_count': len(stats['transactions']),
-            'last_transactions': stats['transactions'][-5:]
+            'total_amount': stats.total_amount,
+            'transaction_count': stats.count,
+            'by_bank': dict(stats.by_bank),
+            'last_transactions': [self.transactions_by_id[tx_id] for tx_id in list(stats.recent_ids)[-5:]]
         }
     
     def get_session_stats(self):
         return {
             'target': self.current_target,
             'current': self.current_amount,
+            'count': self.session.count,
+            'by_bank': dict(self.session.by_bank),
             'active': self.active_session
         }
 
@@ -228,37 +1596,187 @@ SPECIAL_ADMIN = 'MaksimXyila'
 # ========== ХРАНИЛИЩЕ ДАННЫХ АДМИНА ==========
 admin_temp_data = defaultdict(dict)
 
-# ========== ФУНКЦИЯ ИЗВЛЕЧЕНИЯ СУММЫ ==========
-def extract_amount_from_text(text):
-    """Извлекает сумму из текста, включая суммы с восклицательными знаками"""
-    # Сначала ищем суммы с восклицательными знаками
-    matches = re.findall(r'(\d{3,})!', text)
-    if matches:
+# ========== ИЗВЛЕЧЕНИЕ РЕКВИЗИТОВ ==========
+# Банки в порядке приоритета: (как пишут в сообщении, как показываем)
+BANK_ALIASES = [
+    ('💚Сбер💚', '💚Сбер💚'),
+    ('💛Тбанк💛', '💛Тбанк💛'),
+    ('💛Т-Банк💛', '💛Т-Банк💛'),
+    ('Тинькофф', '💛Тбанк💛'),
+    ('Тиньков', '💛Тбанк💛'),
+    ('Т-банк', '💛Тбанк💛'),
+]
+
+def _bank_alias_pattern(alias):
+    # Закрывающее сердечко не поглощаем: с него может начинаться следующий банк ("💛Т-Банк💛Тбанк💛")
+    if alias[-1] in '💚💛':
+        return re.escape(alias[:-1]) + '(?=' + re.escape(alias[-1]) + ')'
+    return re.escape(alias)
+
+# Один проход по тексту: банки и числа вместе с окружением,
+# по которому видно телефон, почту и сумму вида "500!"
+REQUISITES_PATTERN = re.compile(
+    r'(?P<bank>' + '|'.join(_bank_alias_pattern(alias) for alias, _ in BANK_ALIASES) + r')'
+    r'|(?P<prefix>sir\+|\+)?(?P<number>\d+)(?P<suffix>!|@outluk\.ru|@)?'
+)
+# Ключ — то, что реально попадает в группу bank (без закрывающего сердечка)
+BANK_RANKS = {alias[:-1] if alias[-1] in '💚💛' else alias: rank
+              for rank, (alias, _) in enumerate(BANK_ALIASES)}
+
+def extract_requisites(text):
+    """Извлекает телефон, сумму, банк и почту за один проход по тексту"""
+    phone = None
+    email = None
+    bank_rank = len(BANK_ALIASES)
+    numbers = []
+    marked_amount = None  # Последнее число вида "500!"
+    email_numbers = set()  # Числа, которые стоят в почте sir+N@
+    
+    for bank, prefix, number, suffix in REQUISITES_PATTERN.findall(text):
+        if bank:
+            rank = BANK_RANKS[bank]
+            if rank < bank_rank:
+                bank_rank = rank
+            continue
+        
+        numbers.append(number)
+        
+        if prefix:
+            if phone is None and number[0] == '7' and len(number) >= 11:
+                phone = '+' + number[:11]
+            if prefix == 'sir+' and suffix and suffix[0] == '@':
+                email_numbers.add(number)
+                if email is None and suffix == '@outluk.ru':
+                    email = f'sir+{number}@outluk.ru'
+        
+        if suffix == '!' and len(number) >= 3:
+            marked_amount = number
+    
+    # Сначала сумма с восклицательным знаком, затем первое число не из почты
+    amount = None
+    if marked_amount is not None:
         try:
-            amount = int(matches[-1])
-            # Проверяем, что это не часть email
-            if f'sir+{amount}@' not in text:
-                return amount
+            value = int(marked_amount)
+            if str(value) not in email_numbers:
+                amount = value
         except ValueError:
             pass
     
-    # Затем ищем суммы без знаков
-    clean_text = re.sub(r'[^\d\s]', ' ', text)
-    parts = clean_text.split()
-    
-    for part in parts:
-        if part.isdigit():
-            try:
-                amount = int(part)
-                # Проверяем, что это не часть email
-                if f'sir+{part}@' not in text:
-                    return amount
-            except ValueError:
-                continue
-    
-    return None
+    if amount is None:
+        for number in numbers:
+            if number not in email_numbers:
+                try:
+                    amount = int(number)
+                    break
+                except ValueError:
+                    continue
+    
+    return {
+        'phone': phone,
+        'amount': amount,
+        'bank': BANK_ALIASES[bank_rank][1] if bank_rank < len(BANK_ALIASES) else None,
+        'email': email
+    }
+
+def extract_many(texts):
+    """
+    extract_requisites для списка текстов. Отдельного пакетного прохода нет: один findall
+    по склеенным через разделитель текстам замерен медленнее, чем проход по каждому
+    """
+    return [extract_requisites(text) for text in texts]
+
+def extract_amount_from_text(text):
+    """Извлекает сумму из текста, включая суммы с восклицательными знаками"""
+    return extract_requisites(text)['amount']
+
+def line_fields(line):
+    """Поля реквизитов в строке и их значения: {'phone' | 'amount' | 'bank' | 'email': {значение, ...}}"""
+    fields = defaultdict(set)
+    for bank, prefix, number, suffix in REQUISITES_PATTERN.findall(line):
+        if bank:
+            fields['bank'].add(BANK_ALIASES[BANK_RANKS[bank]][1])
+        elif prefix == 'sir+' and suffix and suffix[0] == '@':
+            fields['email'].add(number)
+        elif prefix and number[0] == '7' and len(number) >= 11:
+            fields['phone'].add(number[:11])
+        elif suffix == '!' or len(number) >= 3:
+            # Номера вида "1." в нумерованном списке суммой не считаем
+            fields['amount'].add(number)
+    return fields
+
+def split_records(text):
+    """
+    Делит блок реквизитов на записи. Запись заканчивается пустой строкой или строкой,
+    поле из которой в записи уже есть, если запись полная (дальше — следующая, даже с тем же
+    телефоном) или значение другое (второй телефон у неполной записи — значит, началась следующая).
+    Повторы того же телефона или почты (цитата, пересылка) запись не порождают: неполный кусок,
+    где только значения предыдущей записи, к ней и присоединяется.
+    Строки без реквизитов (заголовки, комментарии) остаются в своей записи.
+    """
+    records = []
+    previous = {}
+    lines = []
+    seen = defaultdict(set)  # поле -> значения в текущей записи
+    
+    def close():
+        nonlocal previous
+        if records and len(seen) < 4 and all(values <= previous.get(field, set()) for field, values in seen.items()):
+            records[-1] += '\n' + '\n'.join(lines)
+        else:
+            records.append('\n'.join(lines))
+            previous = seen
+    
+    for line in text.splitlines():
+        fields = line_fields(line)
+        repeated = [field for field in fields if field in seen]
+        next_record = repeated and (len(seen) == 4 or any(fields[field] - seen[field] for field in repeated))
+        if (not line.strip() or next_record) and seen:
+            close()
+            lines = []
+            seen = defaultdict(set)
+        if line.strip():
+            lines.append(line)
+            for field, values in fields.items():
+                seen[field] |= values
+    if seen:
+        close()
+    return records
+
+def missing_requisites(data):
+    """Названия недостающих обязательных полей"""
+    missing_fields = []
+    if not data.get('phone'): 
+        missing_fields.append("телефон (+7XXXXXXXXXX)")
+    if not data.get('amount'): 
+        missing_fields.append("сумма (например: 500!)")
+    if not data.get('bank'): 
+        missing_fields.append("банк (💚Сбер💚 или 💛Тбанк💛)")
+    if not data.get('email'): 
+        missing_fields.append("почта (sir+N@outluk.ru)")
+    return missing_fields
 
 # ========== КЛАВИАТУРЫ ==========
+class KeyboardCache:
+    """Готовые клавиатуры по (меню, флаги); пересобираются только после изменений в db"""
+    
+    def __init__(self):
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, build):
+        cached = self._cache.get(key)
+        if cached and cached[0] is db and cached[1] == db.version:
+            self.hits += 1
+            return cached[2]
+        
+        self.misses += 1
+        keyboard = build()
+        self._cache[key] = (db, db.version, keyboard)
+        return keyboard
+
+keyboards = KeyboardCache()
+
 def get_main_menu():
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
@@ -271,14 +1789,18 @@ def get_help_menu():
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
         InlineKeyboardButton("Анкета агента", callback_data="agent_form"),
-        InlineKeyboardButton("Отправка чека", callback_data="subscribe"),
-        InlineKeyboardButton("Подключить подписку", callback_data="send_receipt"),
+        InlineKeyboardButton("Отправка чека", callback_data="send_receipt"),
+        InlineKeyboardButton("Подключить подписку", callback_data="subscribe"),
         InlineKeyboardButton("Инструкция агента", callback_data="agent_instructions"),
         InlineKeyboardButton("Назад", callback_data="back_to_main")
     )
     return keyboard
 
 def get_members_menu(show_delete=False, show_agent_stats=False):
+    return keyboards.get(('members', show_delete, show_agent_stats),
+                         lambda: build_members_menu(show_delete, show_agent_stats))
+
+def build_members_menu(show_delete=False, show_agent_stats=False):
     keyboard = InlineKeyboardMarkup(row_width=1)
     users = db.get_all_users()
     
@@ -306,6 +1828,9 @@ def get_members_menu(show_delete=False, show_agent_stats=False):
     return keyboard
 
 def get_agents_stats_menu():
+    return keyboards.get(('agents_stats',), build_agents_stats_menu)
+
+def build_agents_stats_menu():
     keyboard = InlineKeyboardMarkup(row_width=1)
     agents = db.get_agents()
     
@@ -323,12 +1848,32 @@ def get_agents_stats_menu():
 def get_agent_receipt_keyboard(transaction_id, agent_username):
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
-        InlineKeyboardButton("✅ Чек отправлен", callback_data=f"receipt_sent_{transaction_id}_{agent_username}"),
-        InlineKeyboardButton("❌ Проблема с отправкой", callback_data=f"receipt_problem_{transaction_id}_{agent_username}")
+        InlineKeyboardButton("✅ Чек отправлен",
+                             callback_data=callbacks.tokens.issue(f"receipt_sent_{transaction_id}_{agent_username}")),
+        InlineKeyboardButton("❌ Проблема с отправкой",
+                             callback_data=callbacks.tokens.issue(f"receipt_problem_{transaction_id}_{agent_username}"))
     )
     return keyboard
 
+BULK_NOTIFY_CHUNK = 40  # Чеков в одном сводном уведомлении: по 2 кнопки, у Telegram предел 100
+BULK_SUMMARY_LINES = 30  # Строк в сводке админу, чтобы уложиться в 4096 символов
+
+def get_bulk_receipt_keyboard(transactions):
+    """Строка на чек: отметить отправленным (строка исчезает) или сообщить о проблеме"""
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for tx in transactions:
+        keyboard.row(
+            InlineKeyboardButton(f"✅ #{tx.id}: {tx.amount}₽",
+                                 callback_data=callbacks.tokens.issue(f"receipt_row_{tx.id}_{tx.agent_username}")),
+            InlineKeyboardButton(f"❌ #{tx.id}",
+                                 callback_data=callbacks.tokens.issue(f"receipt_problem_{tx.id}_{tx.agent_username}"))
+        )
+    return keyboard
+
 def get_delete_agents_menu():
+    return keyboards.get(('delete_agents',), build_delete_agents_menu)
+
+def build_delete_agents_menu():
     keyboard = InlineKeyboardMarkup(row_width=1)
     agents = db.get_agents()
     
@@ -352,9 +1897,9 @@ def get_receipt_confirmation_keyboard(transaction_id, agent_username):
     keyboard = InlineKeyboardMarkup(row_width=2)
     keyboard.add(
         InlineKeyboardButton("✅ Подтвердить отправку чека", 
-                           callback_data=f"confirm_receipt_{transaction_id}_{agent_username}"),
+                           callback_data=callbacks.tokens.issue(f"confirm_receipt_{transaction_id}_{agent_username}")),
         InlineKeyboardButton("📧 Отправить чек на почту", 
-                           callback_data=f"send_receipt_email_{transaction_id}_{agent_username}")
+                           callback_data=callbacks.tokens.issue(f"send_receipt_email_{transaction_id}_{agent_username}"))
     )
     return keyboard
 
@@ -373,47 +1918,320 @@ def is_special_admin(user):
     username = user.username or ""
     return username == SPECIAL_ADMIN
 
-# ========== ФУНКЦИЯ ОТПРАВКИ С ПРЕМИУМ ЭМОДЗИ ==========
-async def send_message_with_premium_emoji(chat_id, text, emoji_id=None):
+# ========== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ==========
+# Лимиты Telegram: ~30 сообщений/с на бота, ~20 сообщений/мин в группу, ~1/с в личку
+GLOBAL_RATE_LIMIT = 30
+GROUP_MESSAGES_PER_MINUTE = 20
+GROUP_BURST = 5
+# Ведро отдаёт burst сразу и rate·60 за минуту: вместе не больше 20 за любые 60 с
+GROUP_RATE_LIMIT = (GROUP_MESSAGES_PER_MINUTE - GROUP_BURST) / 60
+PRIVATE_RATE_LIMIT = 1
+PRIVATE_BURST = 3
+SEND_MAX_RETRIES = 5
+OUTBOUND_MAX_DEPTH = int(os.getenv('OUTBOUND_MAX_DEPTH', '1000'))  # Дальше апдейты ждут, пока очередь разойдётся
+BUCKET_PRUNE_INTERVAL = 60  # Как часто выбрасывать вёдра чатов, которым давно ничего не слали
+
+# Чем меньше число, тем раньше уйдёт сообщение
+PRIORITY_RECEIPT = 0  # Уведомления агентам о чеках
+PRIORITY_NORMAL = 1   # Ответы на команды и реквизиты
+PRIORITY_MENU = 2     # Меню и справка
+PRIORITY_BROADCAST = 3  # Рассылки — после всего остального
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def delay(self, now):
+        """Через сколько секунд появится токен"""
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+    
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+    
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def retry_after_seconds(error):
+    """Сколько ждать по ответу flood control (RetryAfter / FloodWaitError), иначе None"""
+    if isinstance(error, RetryAfter):
+        return error.timeout
+    if FloodWaitError and isinstance(error, FloodWaitError):
+        return error.seconds
+    return None
+
+class OutboundQueue:
     """
-    Отправляет сообщение с премиум эмодзи
-    emoji_id: ID премиум эмодзи из Telegram (например: 5872974298146149488)
+    Единая очередь исходящих сообщений.
+    Держит общий лимит бота и лимит каждого чата, пропускает вперёд более важные
+    сообщения, а после RetryAfter возвращает отправку в очередь и ждёт.
+    Внутри одного чата порядок сообщений одного приоритета сохраняется.
+    post() не ждёт, поэтому глубину держит конвейер: перед каждым апдейтом он ждёт
+    wait_for_room(), и очередь выходит за limit не больше чем на отправки уже идущих хендлеров.
     """
-    try:
-        if telethon_client and emoji_id:
-            # Используем Telethon для премиум эмодзи
-            await telethon_client.start(bot_token=BOT_TOKEN)
-            
-            # Форматируем сообщение с эмодзи
-            formatted_text = text
-            
-            # Отправляем через Telethon
-            await telethon_client.send_message(
-                chat_id,
-                formatted_text,
-                parse_mode='html'
-            )
-            logger.info(f"✅ Сообщение с премиум эмодзи отправлено в {chat_id}")
-        else:
-            # Отправляем через aiogram (обычные эмодзи)
-            await bot.send_message(
-                chat_id=chat_id,
-                text=text,
-                parse_mode='Markdown'
-            )
-            logger.info(f"✅ Сообщение отправлено в {chat_id}")
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки сообщения с премиум эмодзи: {e}")
-        # Fallback: отправляем через aiogram без эмодзи
-        await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            parse_mode='Markdown'
-        )
+    
+    def __init__(self, global_rate=GLOBAL_RATE_LIMIT, group_rate=GROUP_RATE_LIMIT,
+                 private_rate=PRIVATE_RATE_LIMIT, limit=OUTBOUND_MAX_DEPTH):
+        self.global_bucket = TokenBucket(global_rate, max(global_rate, 1))
+        self.group_rate = group_rate
+        self.private_rate = private_rate
+        self._chats = {}        # chat_id -> куча (priority, seq, attempt, send, future)
+        self._buckets = {}      # chat_id -> TokenBucket
+        self._blocked = {}      # chat_id -> до какого момента ждём после RetryAfter
+        self._busy = set()      # чаты, где отправка уже в полёте
+        self._ready = []        # куча (priority, seq, chat_id): чаты, куда можно слать сейчас
+        self._sleeping = []     # куча (когда, chat_id): чаты, упёршиеся в лимит
+        self._waiting = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._prune_at = time.monotonic() + BUCKET_PRUNE_INTERVAL
+        self._room = asyncio.Event()  # очередь опустилась ниже limit
+        self.limit = limit
+        self.queued = Counter()  # глубина очереди по приоритетам
+        self.max_depth = 0
+        self.throttled = 0      # сколько раз апдейт ждал, пока очередь разойдётся
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+    
+    async def submit(self, chat_id, send, priority=PRIORITY_NORMAL):
+        """Ставит отправку в очередь и ждёт результат. send — функция, возвращающая корутину"""
+        return await self.post(chat_id, send, priority)
+    
+    async def wait_for_room(self):
+        """Ждёт, пока глубина очереди опустится ниже limit"""
+        if self.depth() < self.limit:
+            return
+        self.throttled += 1
+        while self.depth() >= self.limit:
+            self._room.clear()
+            await self._room.wait()
+    
+    def post(self, chat_id, send, priority=PRIORITY_NORMAL):
+        """Ставит отправку в очередь, не дожидаясь её, и возвращает future с результатом"""
+        loop = asyncio.get_event_loop()
+        if self._worker is None or self._worker.done():
+            self._wakeup = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        
+        future = loop.create_future()
+        heapq.heappush(self._chats.setdefault(chat_id, []), (priority, next(self._seq), 0, send, future))
+        if chat_id not in self._buckets:
+            if chat_id < 0:
+                self._buckets[chat_id] = TokenBucket(self.group_rate, GROUP_BURST)
+            else:
+                self._buckets[chat_id] = TokenBucket(self.private_rate, PRIVATE_BURST)
+        
+        self.queued[priority] += 1
+        self.max_depth = max(self.max_depth, self.depth())
+        self._schedule(chat_id, time.monotonic())
+        self._wakeup.set()
+        return future
+    
+    def _delay(self, chat_id, now):
+        return max(self._buckets[chat_id].delay(now), self._blocked.get(chat_id, 0) - now)
+    
+    def _schedule(self, chat_id, now):
+        items = self._chats.get(chat_id)
+        if not items or chat_id in self._busy or chat_id in self._waiting:
+            return
+        
+        delay = self._delay(chat_id, now)
+        if delay > 0:
+            self._waiting.add(chat_id)
+            heapq.heappush(self._sleeping, (now + delay, chat_id))
+        else:
+            priority, seq = items[0][:2]
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+    
+    def _pop_ready(self, now):
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            items = self._chats.get(chat_id)
+            # Запись устарела: чат занят или у него уже другое первое сообщение
+            if not items or chat_id in self._busy or items[0][:2] != (priority, seq):
+                continue
+            if self._delay(chat_id, now) > 0:
+                self._schedule(chat_id, now)
+                continue
+            return chat_id
+        return None
+    
+    def _prune(self, now):
+        """Полное ведро простаивающего чата ничем не отличается от нового — его можно выбросить"""
+        for chat_id in [chat_id for chat_id, bucket in self._buckets.items()
+                        if chat_id not in self._chats and bucket.full(now)]:
+            del self._buckets[chat_id]
+        self._prune_at = now + BUCKET_PRUNE_INTERVAL
+    
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            if now >= self._prune_at:
+                self._prune(now)
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, chat_id = heapq.heappop(self._sleeping)
+                self._waiting.discard(chat_id)
+                self._schedule(chat_id, now)
+            
+            chat_id = self._pop_ready(now)
+            if chat_id is None:
+                timeout = self._sleeping[0][0] - now if self._sleeping else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            delay = self.global_bucket.delay(now)
+            if delay:
+                priority, seq = self._chats[chat_id][0][:2]
+                heapq.heappush(self._ready, (priority, seq, chat_id))
+                await asyncio.sleep(delay)
+                continue
+            
+            self.global_bucket.consume(now)
+            self._buckets[chat_id].consume(now)
+            self._busy.add(chat_id)
+            asyncio.ensure_future(self._send(chat_id, heapq.heappop(self._chats[chat_id])))
+    
+    async def _send(self, chat_id, item):
+        priority, seq, attempt, send, future = item
+        try:
+            result = await send()
+        except Exception as e:
+            wait = retry_after_seconds(e)
+            if wait is not None and attempt < SEND_MAX_RETRIES:
+                logger.warning(f"⏳ Flood control в чате {chat_id}: ждём {wait} с (попытка {attempt + 1})")
+                self.retried += 1
+                self._blocked[chat_id] = time.monotonic() + wait
+                heapq.heappush(self._chats[chat_id], (priority, seq, attempt + 1, send, future))
+                return
+            self.failed += 1
+            self.queued[priority] -= 1
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.sent += 1
+            self.queued[priority] -= 1
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._busy.discard(chat_id)
+            if not self._chats[chat_id]:
+                del self._chats[chat_id]
+                self._blocked.pop(chat_id, None)
+            self._schedule(chat_id, time.monotonic())
+            self._wakeup.set()
+            if self.depth() < self.limit:
+                self._room.set()
+    
+    def depth(self):
+        return sum(self.queued.values())
+    
+    def stats(self):
+        return {
+            'depth': self.depth(),
+            'by_priority': {priority: n for priority, n in sorted(self.queued.items()) if n},
+            'max_depth': self.max_depth,
+            'in_flight': len(self._busy),
+            'throttled_chats': len(self._waiting),
+            'limit': self.limit,
+            'throttled_updates': self.throttled,
+            'sent': self.sent,
+            'retried': self.retried,
+            'failed': self.failed
+        }
+    
+    async def close(self, timeout=5):
+        """Даёт дослать хвост очереди и останавливает обработчик"""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker:
+            self._worker.cancel()
+
+outbound = OutboundQueue()
+
+async def send_message(chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    """bot.send_message через общую очередь"""
+    return await outbound.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+async def answer(message: types.Message, text, priority=PRIORITY_NORMAL, **kwargs):
+    """message.answer через общую очередь"""
+    return await send_message(message.chat.id, text, priority, **kwargs)
+
+def log_send_failure(chat_id, future):
+    if not future.cancelled() and future.exception():
+        logger.error(f"❌ Не удалось отправить сообщение в {chat_id}: {future.exception()}")
+
+def post_message(chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+    """
+    bot.send_message через общую очередь, не дожидаясь доставки: хендлер не держит цепочку чата,
+    пока сообщение ждёт лимита группы. Ошибки только пишутся в лог
+    """
+    future = outbound.post(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+    future.add_done_callback(lambda f: log_send_failure(chat_id, f))
+    return future
+
+# ========== ФУНКЦИЯ ОТПРАВКИ С ПРЕМИУМ ЭМОДЗИ ==========
+def post_message_with_premium_emoji(chat_id, template: PremiumTemplate, **fields):
+    """
+    Ставит в очередь сообщение по шаблону с премиум эмодзи.
+    Через Telethon, если он подключён, иначе через aiogram с обычным эмодзи.
+    """
+    async def send():
+        if telethon_transport and telethon_transport.ready:
+            try:
+                text, entities = template.entities(**fields)
+                result = await telethon_transport.send(chat_id, text, entities)
+                logger.info(f"✅ Сообщение с премиум эмодзи отправлено в {chat_id}")
+                return result
+            except Exception as e:
+                if retry_after_seconds(e) is not None:
+                    raise
+                logger.error(f"❌ Ошибка отправки сообщения с премиум эмодзи: {e}")
+        
+        # Отправляем через aiogram (обычные эмодзи)
+        result = await bot.send_message(chat_id, template.markdown(**fields), parse_mode='Markdown')
+        logger.info(f"✅ Сообщение отправлено в {chat_id}")
+        return result
+    
+    future = outbound.post(chat_id, send, PRIORITY_RECEIPT)
+    future.add_done_callback(lambda f: log_send_failure(chat_id, f))
+    return future
 
 # ========== ОБНОВЛЕННАЯ ФУНКЦИЯ УВЕДОМЛЕНИЯ ==========
-async def notify_agent_about_receipt(agent_username, transaction_data, group_chat_id):
-    """Отправить уведомление агенту с премиум эмодзи"""
+# Сообщение с премиум эмодзи: "💫" будет заменён на премиум, если доступен Telethon
+RECEIPT_NOTIFICATION = PremiumTemplate(
+    """**Уведомление для агента @{agent_username}**
+
+📧 **Получены реквизиты для отправки чека:**
+• Email: `{email}`
+• Сумма: `{amount}₽`
+• Банк: {bank}
+
+**Вы отправили чек на указанную почту?**""",
+    emoji="💫",
+    emoji_id=5872974298146149488  # ID вашего эмодзи
+)
+
+def notify_agent_about_receipt(agent_username, transaction_data, group_chat_id):
+    """Поставить в очередь уведомление агенту с премиум эмодзи"""
     if not group_chat_id:
         logger.error(f"Нет ID группового чата для уведомления агенту @{agent_username}")
         return None
@@ -433,45 +2251,87 @@ async def notify_agent_about_receipt(agent_username, transaction_data, group_cha
                 logger.error(f"Нет доступных агентов для уведомления")
                 return None
         
-        # Сообщение с премиум эмодзи
-        premium_emoji = "💫"  # Будет заменен на премиум если доступно
-        premium_emoji_id = 5872974298146149488  # ID вашего эмодзи
-        
-        message_text = f"""**Уведомление для агента @{agent_username}**
-
-📧 **Получены реквизиты для отправки чека:**
-• Email: `{transaction_data['email']}`
-• Сумма: `{transaction_data['amount']}₽`
-• Банк: {transaction_data['bank']}
-
-**Вы отправили чек на указанную почту?**"""
-        
         keyboard = get_agent_receipt_keyboard(
             transaction_data['id'], 
             agent_username
         )
         
         # Отправляем с премиум эмодзи
-        await send_message_with_premium_emoji(
+        post_message_with_premium_emoji(
             group_chat_id,
-            message_text,
-            premium_emoji_id
+            RECEIPT_NOTIFICATION,
+            agent_username=agent_username,
+            email=transaction_data['email'],
+            amount=transaction_data['amount'],
+            bank=transaction_data['bank']
         )
         
         # Отправляем клавиатуру отдельно
-        await bot.send_message(
-            chat_id=group_chat_id,
-            text="Выберите действие:",
-            reply_markup=keyboard
-        )
+        post_message(group_chat_id, "Выберите действие:", PRIORITY_RECEIPT, reply_markup=keyboard)
         
-        logger.info(f"✅ Уведомление отправлено агенту @{agent_username}")
+        logger.info(f"✅ Уведомление для агента @{agent_username} поставлено в очередь")
         return True
         
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления агенту @{agent_username}: {e}")
         return None
 
+# ========== КОНТРОЛЬ СРОКОВ ЧЕКОВ ==========
+receipt_watchdog_task = None
+
+async def escalate_receipt(stage, transaction, chat_id):
+    """Напоминание агенту или передача чека другому агенту по истечении срока"""
+    agent_username = transaction.agent_username
+    waited = int((time.time() - transaction.timestamp) // 60)
+    
+    if stage == 'remind':
+        logger.info(f"⏰ Чек #{transaction.id} ждёт @{agent_username} уже {waited} мин")
+        if chat_id:
+            # Без parse_mode: в username бывают '_', и Markdown отверг бы всё сообщение
+            await send_message(
+                chat_id,
+                f"⏰ @{agent_username}, чек по транзакции #{transaction.id} "
+                f"({transaction.amount}₽, {transaction.email}) ждёт уже {waited} мин",
+                PRIORITY_RECEIPT
+            )
+        return
+    
+    if not chat_id:
+        # Транзакция из базы, где чат ещё не хранился: молча передавать чек нельзя — никто не узнает
+        logger.warning(f"⏰ Чек #{transaction.id} не передан: неизвестен чат группы")
+        return
+    
+    new_agent = db.assign_agent(exclude=agent_username)
+    if not new_agent:
+        # Передать некому — начинаем цикл напоминаний заново
+        db.receipts.watch(transaction, chat_id)
+        return
+    
+    db.reassign_transaction(transaction.id, new_agent, chat_id)
+    logger.info(f"🔁 Чек #{transaction.id} передан от @{agent_username} к @{new_agent}")
+    await send_message(
+        chat_id,
+        f"🔁 Чек #{transaction.id} не отправлен за {waited} мин — передаём @{new_agent}",
+        PRIORITY_RECEIPT
+    )
+    notify_agent_about_receipt(new_agent, transaction, chat_id)
+
+async def receipt_watchdog():
+    """Раз в тик проворачивает колесо таймеров и эскалирует просроченные чеки; заодно чистит токены кнопок"""
+    while True:
+        await asyncio.sleep(RECEIPT_TICK)
+        callbacks.tokens.prune()
+        for stage, transaction, chat_id in db.receipts.due():
+            try:
+                await escalate_receipt(stage, transaction, chat_id)
+            except Exception as e:
+                logger.error(f"❌ Ошибка эскалации чека #{transaction.id}: {e}")
+
+# ========== СОСТОЯНИЯ ==========
+class SendMessageStates(StatesGroup):
+    waiting_for_username = State()
+    waiting_for_message = State()
+
 # ========== КОМАНДЫ ==========
 @dp.message_handler(Command('start'))
 async def start_command(message: types.Message):
@@ -487,40 +2347,104 @@ async def start_command(message: types.Message):
     else:
         text = "Вы в главном меню, есть вопросы? Жми кнопки снизу, возможно там есть ответ на ваш вопрос."
     
-    await message.answer(text, reply_markup=get_main_menu())
+    await answer(message, text, PRIORITY_MENU, reply_markup=get_main_menu())
 
 @dp.message_handler(Command('help'))
 async def help_command(message: types.Message):
-    await message.answer("📋 Раздел помощи:", reply_markup=get_help_menu())
+    await answer(message, "📋 Раздел помощи:", PRIORITY_MENU, reply_markup=get_help_menu())
 
 @dp.message_handler(Command('members'))
 async def members_command(message: types.Message):
     is_admin_user = is_admin(message.from_user)
-    await message.answer("👥 Список участников:", 
-                        reply_markup=get_members_menu(show_delete=is_admin_user, show_agent_stats=is_admin_user))
+    await answer(message, "👥 Список участников:", PRIORITY_MENU,
+                 reply_markup=get_members_menu(show_delete=is_admin_user, show_agent_stats=is_admin_user))
 
 @dp.message_handler(Command('rub'))
 async def rub_command(message: types.Message):
     if not is_admin(message.from_user):
-        return await message.answer("⚠️ Только для администраторов")
+        return await answer(message, "⚠️ Только для администраторов")
     
     try:
         amount = int(message.text.split()[1])
         session_id = db.start_session(amount)
-        await message.answer(f"✅ Цель на сессию установлена: {amount}₽")
+        await answer(message, f"✅ Цель на сессию #{session_id} установлена: {amount}₽")
     except:
-        await message.answer("Использование: /rub сумма")
+        await answer(message, "Использование: /rub сумма")
+
+def format_duration(seconds):
+    minutes = int(seconds // 60)
+    if minutes < 60:
+        return f"{minutes} мин"
+    return f"{minutes // 60} ч {minutes % 60:02d} мин"
 
 @dp.message_handler(Command('stop'))
 async def stop_command(message: types.Message):
     if not is_admin(message.from_user):
-        return await message.answer("⚠️ Только для администраторов")
+        return await answer(message, "⚠️ Только для администраторов")
     
     if db.active_session:
         total = db.stop_session()
-        await message.answer(f"✅ Сессия остановлена. Итог: {total}₽")
+        record = db.ledger.current
+        await answer(message, f"✅ Сессия остановлена. Итог: {total}₽\n"
+                              f"⏱ {format_duration(record.duration())}, в среднем {record.pace():.0f}₽/мин")
     else:
-        await message.answer("⚠️ Нет активной сессии")
+        await answer(message, "⚠️ Нет активной сессии")
+
+@dp.message_handler(Command('pace'))
+async def pace_command(message: types.Message):
+    if not is_admin(message.from_user):
+        return await answer(message, "⚠️ Только для администраторов")
+    
+    record = db.ledger.current
+    if not db.active_session or not record:
+        return await answer(message, "⚠️ Нет активной сессии")
+    
+    pace = record.pace()
+    recent = record.recent_pace()
+    eta = record.eta()
+    if eta is None:
+        eta_text = "нет данных" if record.target else "цель не задана"
+    elif eta == 0:
+        eta_text = "цель достигнута ✅"
+    else:
+        eta_text = f"≈ {format_duration(eta)}"
+    
+    past = db.ledger.history(5)
+    if past:
+        past_pace = sum(r.pace() for r in past) / len(past)
+        compare = f"{(pace / past_pace - 1) * 100:+.0f}% к среднему {past_pace:.0f}₽/мин" if past_pace else "—"
+    else:
+        compare = "прошлых сессий ещё нет"
+    
+    text = f"""⏱ **Сессия #{record.id}** идёт {format_duration(record.duration())}
+┣ Оборот: `{record.total}₽` из `{record.target}₽`, операций: {record.count}
+┣ Темп: `{pace:.0f}₽/мин`, за последние {PACE_WINDOW_MINUTES} мин: `{recent:.0f}₽/мин`
+┣ До цели: {eta_text}
+┗ Против последних {len(past)} сессий: {compare}"""
+    
+    await answer(message, text, parse_mode='Markdown')
+
+@dp.message_handler(Command('sessions'))
+async def sessions_command(message: types.Message):
+    if not is_admin(message.from_user):
+        return await answer(message, "⚠️ Только для администраторов")
+    
+    try:
+        limit = int(message.text.split()[1])
+    except (IndexError, ValueError):
+        limit = 5
+    
+    past = db.ledger.history(limit)
+    if not past:
+        return await answer(message, "📭 Завершённых сессий ещё нет")
+    
+    lines = [f"📚 **Последние сессии ({len(past)}):**"]
+    for record in past:
+        progress = f", {record.total / record.target * 100:.0f}% цели" if record.target else ""
+        lines.append(f"#{record.id}: `{record.total}₽` из `{record.target}₽`{progress} "
+                     f"за {format_duration(record.duration())}, {record.pace():.0f}₽/мин")
+    
+    await answer(message, "\n".join(lines), parse_mode='Markdown')
 
 @dp.message_handler(Command('send'))
 async def send_message_command(message: types.Message, state: FSMContext):
@@ -528,17 +2452,17 @@ async def send_message_command(message: types.Message, state: FSMContext):
         return
     
     if message.chat.type not in [ChatType.PRIVATE]:
-        await message.answer("⚠️ Эта команда доступна только в личных сообщениях")
+        await answer(message, "⚠️ Эта команда доступна только в личных сообщениях")
         return
     
     args = message.text.split(maxsplit=1)
     if len(args) < 2:
-        await message.answer("Использование: /send Текст сообщения\nБот запросит username получателя")
+        await answer(message, "Использование: /send Текст сообщения\nБот запросит username получателя")
         await SendMessageStates.waiting_for_username.set()
         return
     
     text = args[1]
-    await message.answer("Введите username получателя (без @):")
+    await answer(message, "Введите username получателя (без @):")
     await state.update_data(message_text=text)
     await SendMessageStates.waiting_for_username.set()
 
@@ -547,7 +2471,7 @@ async def process_username(message: types.Message, state: FSMContext):
     username = message.text.strip().replace('@', '')
     
     if not username:
-        await message.answer("❌ Username не может быть пустым")
+        await answer(message, "❌ Username не может быть пустым")
         return
     
     data = await state.get_data()
@@ -556,29 +2480,180 @@ async def process_username(message: types.Message, state: FSMContext):
     user = db.get_user_by_username(username)
     
     if not user:
-        await message.answer(f"❌ Пользователь @{username} не найден в базе")
+        await answer(message, f"❌ Пользователь @{username} не найден в базе")
         await state.finish()
         return
     
     try:
-        await bot.send_message(
-            chat_id=user['id'],
-            text=f"📨 **Сообщение от администратора:**\n\n{message_text}",
+        await send_message(
+            user['id'],
+            f"📨 **Сообщение от администратора:**\n\n{message_text}",
             parse_mode='Markdown'
         )
         
-        await message.answer(f"✅ Сообщение отправлено пользователю @{username}")
+        await answer(message, f"✅ Сообщение отправлено пользователю @{username}")
         logger.info(f"Спец-админ @{message.from_user.username} отправил сообщение пользователю @{username}")
         
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения: {e}")
-        await message.answer(f"❌ Не удалось отправить сообщение пользователю @{username}")
+        await answer(message, f"❌ Не удалось отправить сообщение пользователю @{username}")
     
     await state.finish()
 
+# ========== РАССЫЛКА ==========
+BROADCAST_AUDIENCES = {'agents': 'агентам', 'admins': 'админам', 'all': 'всем'}
+BROADCAST_CONCURRENCY = 20      # Одновременных отправок; общий темп всё равно держит очередь отправки
+BROADCAST_RETRIES = 3           # Повторов после сетевых сбоев и ошибок 5xx
+BROADCAST_PROGRESS_EVERY = 2.0  # Как часто обновлять сообщение с прогрессом, с
+
+# Бот заблокирован, аккаунт удалён, диалог с ботом не начат — повтор не поможет
+UNREACHABLE_ERRORS = (Unauthorized, ChatNotFound)
+
+def is_transient(error):
+    """
+    Сбой, после которого стоит повторить: сеть, перезапуск Telegram, 5xx (приходят голым TelegramAPIError).
+    RetryAfter сюда не входит: его уже повторяет очередь отправки, и дошёл он сюда, только исчерпав попытки
+    """
+    return (isinstance(error, (NetworkError, RestartingTelegram, asyncio.TimeoutError))
+            or type(error) is TelegramAPIError)
+
+def broadcast_recipients(audience):
+    """Получатели без повторов; агентам, добавленным только по username, написать нельзя — у них нет id"""
+    if audience == 'agents':
+        users = db.get_agents()
+    elif audience == 'admins':
+        users = [user for user in db.users.values()
+                 if user['role'] == 'admin' or user['username'] in active_admins]
+    else:
+        users = db.users.values()
+    return list({user['id']: user for user in users if user['id'] > 0}.values())
+
+class Broadcast:
+    """
+    Рассылка одного текста: BROADCAST_CONCURRENCY обработчиков разбирают общий список получателей.
+    Лимиты Telegram и RetryAfter соблюдает очередь отправки, здесь — повторы после сбоев
+    и пропуск тех, кому доставить невозможно.
+    """
+    
+    def __init__(self, recipients, text, concurrency=BROADCAST_CONCURRENCY):
+        self.recipients = recipients
+        self.text = text
+        self.concurrency = concurrency
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retried = 0
+        self.started_at = None
+    
+    @property
+    def done(self):
+        return self.sent + self.failed + self.skipped
+    
+    async def _deliver(self, user):
+        for attempt in range(BROADCAST_RETRIES + 1):
+            try:
+                await send_message(user['id'], self.text, PRIORITY_BROADCAST)
+                self.sent += 1
+                return
+            except UNREACHABLE_ERRORS:
+                self.skipped += 1
+                return
+            except Exception as e:
+                if not is_transient(e) or attempt == BROADCAST_RETRIES:
+                    logger.warning(f"❌ Рассылка: не доставлено @{user['username']}: {e}")
+                    self.failed += 1
+                    return
+                self.retried += 1
+                await asyncio.sleep(2 ** attempt)
+    
+    async def _worker(self, recipients):
+        # Общий итератор: следующий получатель достаётся тому, кто освободился
+        for user in recipients:
+            await self._deliver(user)
+    
+    async def run(self, on_progress=None):
+        self.started_at = time.monotonic()
+        recipients = iter(self.recipients)
+        workers = [asyncio.ensure_future(self._worker(recipients))
+                   for _ in range(min(self.concurrency, len(self.recipients)))]
+        pending = set(workers)
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=BROADCAST_PROGRESS_EVERY)
+            if on_progress and pending:
+                await on_progress(self)
+        if on_progress:
+            await on_progress(self)
+    
+    def progress_text(self, audience):
+        elapsed = time.monotonic() - self.started_at
+        status = "✅ Рассылка завершена" if self.done == len(self.recipients) else "📣 Рассылка идёт"
+        return (f"{status} ({BROADCAST_AUDIENCES[audience]}): {self.done}/{len(self.recipients)}\n"
+                f"Доставлено: {self.sent}, не доставлено: {self.failed}, "
+                f"недоступны (бот заблокирован или диалог не начат): {self.skipped}\n"
+                f"Повторов: {self.retried}, прошло {elapsed:.0f} с")
+
+active_broadcast = None
+
+async def run_broadcast(broadcast, audience, progress):
+    global active_broadcast
+    
+    async def update_progress(broadcast):
+        async def edit():
+            try:
+                return await bot.edit_message_text(broadcast.progress_text(audience), progress.chat.id,
+                                                   progress.message_id)
+            except MessageNotModified:
+                return None
+        try:
+            await outbound.submit(progress.chat.id, edit)
+        except Exception as e:
+            logger.warning(f"Не удалось обновить прогресс рассылки: {e}")
+    
+    try:
+        await broadcast.run(update_progress)
+        logger.info(f"📣 Рассылка {audience}: доставлено {broadcast.sent}, не доставлено {broadcast.failed}, "
+                    f"недоступны {broadcast.skipped}")
+    finally:
+        active_broadcast = None
+
+@dp.message_handler(Command('broadcast'))
+async def broadcast_command(message: types.Message):
+    """/broadcast agents|admins|all Текст — рассылка в личные сообщения"""
+    global active_broadcast
+    if not is_special_admin(message.from_user):
+        return
+    
+    args = (message.get_args() or "").split(maxsplit=1)
+    if len(args) < 2 or args[0] not in BROADCAST_AUDIENCES:
+        await answer(message, "Использование: /broadcast agents|admins|all Текст сообщения")
+        return
+    if active_broadcast:
+        await answer(message, f"⏳ Уже идёт рассылка: {active_broadcast.done}/{len(active_broadcast.recipients)}")
+        return
+    
+    audience, text = args
+    recipients = broadcast_recipients(audience)
+    if not recipients:
+        await answer(message, "⚠️ Некому отправлять: получатели ещё не писали боту")
+        return
+    
+    # Занимаем рассылку до отправки прогресса, чтобы вторая /broadcast не проскочила, пока он уходит
+    active_broadcast = Broadcast(recipients, f"📨 Сообщение от администратора:\n\n{text}")
+    try:
+        progress = await answer(message, f"📣 Рассылка {BROADCAST_AUDIENCES[audience]}: 0/{len(recipients)}")
+    except Exception:
+        # run_broadcast так и не запустится — его finally не сбросит флаг
+        active_broadcast = None
+        raise
+    logger.info(f"📣 @{message.from_user.username} начал рассылку {audience} на {len(recipients)} получателей")
+    # Рассылка может идти минутами — не держим обработку апдейта
+    asyncio.ensure_future(run_broadcast(active_broadcast, audience, progress))
+
 @dp.message_handler(Command('debug'))
 async def debug_command(message: types.Message):
     user = message.from_user
+    queue_stats = outbound.stats()
+    pipeline_stats = pipeline.stats()
     
     debug_info = f"""
 👤 **Информация:**
@@ -594,9 +2669,39 @@ Username: @{user.username or 'нет'}
 👥 **Статистика:**
 Агентов: {len(db.get_agents())}
 Транзакций: {len(db.transactions)}
+Распределение: {db.scheduler.policy}, ждут чека: {sum(db.scheduler.outstanding.values())}
+Повторов отклонено: {db.dedup.hits} (в окне {len(db.dedup.entries)} ключей)
+
+📤 **Очередь отправки:**
+В очереди: {queue_stats['depth']}/{queue_stats['limit']} (макс. {queue_stats['max_depth']}), апдейтов ждали её: {queue_stats['throttled_updates']}
+Отправлено: {queue_stats['sent']}, повторов: {queue_stats['retried']}, ошибок: {queue_stats['failed']}
+
+📥 **Конвейер апдейтов:**
+В работе: {pipeline_stats['busy']}/{pipeline.workers}, ждут: {pipeline_stats['pending'] - pipeline_stats['busy']} (макс. {pipeline_stats['max_pending']}), чатов: {pipeline_stats['chats']}
+Обработано: {pipeline_stats['processed']}, ждали места в очереди: {pipeline_stats['throttled']}
+Отсеяно предфильтром: {prefilter.dropped}, пропущено: {prefilter.passed}
+Медиа: загружено {media_cache.uploaded}, по file_id {media_cache.reused}, отвергнуто {media_cache.rejected}
     """
     
-    await message.answer(debug_info, parse_mode='Markdown')
+    await answer(message, debug_info, parse_mode='Markdown')
+
+@dp.message_handler(Command('receipts'))
+async def receipts_command(message: types.Message):
+    if not is_admin(message.from_user):
+        return await answer(message, "⚠️ Только для администраторов")
+    
+    stats = db.receipts.stats()
+    
+    def minutes(seconds):
+        return f"{seconds / 60:.0f} мин"
+    
+    text = f"""🧾 **Неотправленные чеки:** {stats['pending']}
+┣ Под контролем сроков: {stats['scheduled']}
+┣ Возраст p50: {minutes(stats['p50'])}, p90: {minutes(stats['p90'])}, p99: {minutes(stats['p99'])}
+┣ Самый старый: {minutes(stats['max'])}
+┗ Напоминаний: {stats['reminders']}, передано другим агентам: {stats['reassigned']}"""
+    
+    await answer(message, text, parse_mode='Markdown')
 
 @dp.message_handler(Command('add_admin'))
 async def add_admin_command(message: types.Message):
@@ -607,14 +2712,271 @@ async def add_admin_command(message: types.Message):
         username = message.text.split()[1].replace('@', '')
         db.add_admin_by_username(username)
         active_admins.add(username)
-        await message.answer(f"✅ @{username} добавлен как администратор с полными правами!")
+        await answer(message, f"✅ @{username} добавлен как администратор с полными правами!")
     except:
-        await message.answer("Использование: /add_admin @username")
+        await answer(message, "Использование: /add_admin @username")
 
-# ========== СОСТОЯНИЯ ==========
-class SendMessageStates(StatesGroup):
-    waiting_for_username = State()
-    waiting_for_message = State()
+# ========== ЭКСПОРТ ==========
+EXPORT_COLUMNS = ('id', 'time', 'phone', 'amount', 'bank', 'email', 'agent',
+                  'session', 'receipt_sent', 'receipt_sent_at')
+
+def parse_export_args(args):
+    """
+    Аргументы /export: формат (csv или jsonl), gz для сжатия и фильтры agent=, bank=, session=, from=, to=.
+    Даты — ГГГГ-ММ-ДД, to включительно. Возвращает (формат, сжатие, фильтры) или бросает ValueError.
+    """
+    fmt = 'csv'
+    compress = False
+    filters = {}
+    for arg in args:
+        if arg.lower() in ('csv', 'jsonl'):
+            fmt = arg.lower()
+            continue
+        if arg.lower() == 'gz':
+            compress = True
+            continue
+        key, sep, value = arg.partition('=')
+        if not sep or not value:
+            raise ValueError(arg)
+        key = key.lower()
+        if key == 'agent':
+            filters['agent'] = value.lstrip('@')
+        elif key == 'bank':
+            filters['bank'] = value.lower()
+        elif key == 'session':
+            filters['session'] = db.session_counter - 1 if value == 'current' else int(value)
+        elif key in ('from', 'to'):
+            day = datetime.datetime.strptime(value, '%Y-%m-%d')
+            if key == 'to':
+                day += datetime.timedelta(days=1)
+            filters['since' if key == 'from' else 'until'] = day.timestamp()
+        else:
+            raise ValueError(arg)
+    return fmt, compress, filters
+
+def filter_transactions(transactions, agent=None, bank=None, session=None, since=None, until=None):
+    for tx in transactions:
+        if agent is not None and tx.agent_username != agent:
+            continue
+        if bank is not None and bank not in tx.bank.lower():
+            continue
+        if session is not None and tx.session_id != session:
+            continue
+        if since is not None and tx.timestamp < since:
+            continue
+        if until is not None and tx.timestamp >= until:
+            continue
+        yield tx
+
+def export_rows(transactions):
+    def iso(timestamp):
+        return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec='seconds') if timestamp else None
+    
+    for tx in transactions:
+        yield (tx.id, iso(tx.timestamp), tx.phone, tx.amount, tx.bank, tx.email, tx.agent_username,
+               tx.session_id, tx.receipt_sent, iso(tx.receipt_sent_at))
+
+def export_transactions(transactions, path, fmt='csv', compress=False, **filters):
+    """
+    Генераторами пишет транзакции в файл построчно: в памяти одна строка,
+    сколько бы транзакций ни было. Возвращает число выгруженных строк.
+    """
+    count = 0
+    rows = export_rows(filter_transactions(transactions, **filters))
+    opener = gzip.open if compress else open
+    with opener(path, 'wt', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False))
+                f.write('\n')
+                count += 1
+    return count
+
+@dp.message_handler(Command('export'))
+async def export_command(message: types.Message):
+    if not is_admin(message.from_user):
+        return await answer(message, "⚠️ Только для администраторов")
+    
+    try:
+        fmt, compress, filters = parse_export_args(message.text.split()[1:])
+    except ValueError:
+        return await answer(
+            message,
+            "Использование: /export [csv|jsonl] [gz] [agent=@username] [bank=сбер] "
+            "[session=N|current] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД]"
+        )
+    
+    # Транзакции только добавляются в конец, поэтому срез по текущей длине —
+    # согласованный снимок, даже если новые придут во время записи в потоке
+    snapshot = itertools.islice(db.transactions, len(db.transactions))
+    # Большая выгрузка пишется и отправляется долго — не держим цепочку чата
+    asyncio.ensure_future(run_export(message.chat.id, snapshot, fmt, compress, filters))
+
+async def run_export(chat_id, snapshot, fmt, compress, filters):
+    # Больше 50 МБ бот отправить не может — для больших выгрузок есть gz
+    extension = f"{fmt}.gz" if compress else fmt
+    fd, path = tempfile.mkstemp(prefix='transactions-', suffix=f'.{extension}')
+    os.close(fd)
+    try:
+        count = await asyncio.get_event_loop().run_in_executor(
+            None, lambda: export_transactions(snapshot, path, fmt, compress, **filters)
+        )
+        if not count:
+            return await send_message(chat_id, "📭 Нет транзакций по этим условиям")
+        
+        filename = f"transactions-{datetime.datetime.now():%Y%m%d-%H%M}.{extension}"
+        await outbound.submit(
+            chat_id,
+            lambda: bot.send_document(chat_id, types.InputFile(path, filename=filename),
+                                      caption=f"📤 Транзакций: {count}")
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка выгрузки транзакций: {e}")
+    finally:
+        os.remove(path)
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+PROFILE_DEFAULT_SECONDS = 10
+PROFILE_MAX_SECONDS = 300
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_TOP = 25
+profile_lock = asyncio.Lock()  # Одновременно идёт только один захват
+
+class StackSampler:
+    """
+    Сэмплирующий профайлер: отдельный поток раз в interval снимает стек потока
+    event loop. Сам loop ничего не делает, поэтому накладные расходы почти нулевые.
+    """
+    
+    def __init__(self, thread_id, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()  # стек (от корня к вершине) -> число сэмплов
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+                frame = frame.f_back
+            self.stacks[tuple(reversed(stack))] += 1
+
+def summarize_samples(sampler, path):
+    """Пишет стеки в path в формате collapsed (flamegraph.pl, speedscope) и возвращает топ функций"""
+    own = Counter()
+    total = Counter()
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in sampler.stacks.items():
+            f.write(';'.join(f"{function} ({filename}:{line})" for filename, line, function in stack))
+            f.write(f" {count}\n")
+            if stack:
+                own[stack[-1]] += count
+            for frame in set(stack):
+                total[frame] += count
+    
+    samples = sum(sampler.stacks.values())
+    lines = [f"{'своё':>6} {'всего':>6}  функция (доля сэмплов, %)"]
+    for frame, count in own.most_common(PROFILE_TOP):
+        filename, line, function = frame
+        lines.append(f"{count / samples * 100:>6.1f} {total[frame] / samples * 100:>6.1f}  "
+                     f"{function} ({filename}:{line})")
+    return '\n'.join(lines), f"{samples} сэмплов"
+
+def summarize_profile(profiler, path):
+    """Сохраняет сырой профиль cProfile в path и возвращает топ функций по собственному времени"""
+    profiler.dump_stats(path)
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP]
+    
+    lines = [f"{'tottime':>8} {'cumtime':>8} {'calls':>8}  функция"]
+    for (filename, line, function), (_, calls, tottime, cumtime, _) in rows:
+        lines.append(f"{tottime:>8.3f} {cumtime:>8.3f} {calls:>8}  {function} ({os.path.basename(filename)}:{line})")
+    return '\n'.join(lines), f"CPU в потоке бота {stats.total_tt:.2f} с"
+
+@dp.message_handler(Command('profile'))
+async def profile_command(message: types.Message):
+    """/profile [секунды] [cprofile] — по умолчанию сэмплирование, cprofile точнее, но замедляет бота"""
+    if not is_special_admin(message.from_user):
+        return
+    
+    args = message.text.split()
+    try:
+        seconds = int(args[1]) if len(args) > 1 else PROFILE_DEFAULT_SECONDS
+    except ValueError:
+        return await answer(message, f"Использование: /profile секунды [cprofile], до {PROFILE_MAX_SECONDS} с")
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    deterministic = len(args) > 2 and args[2].lower() == 'cprofile'
+    
+    if profile_lock.locked():
+        return await answer(message, "⏳ Профилирование уже идёт")
+    
+    # Замок берём здесь, а отпускает его фоновая задача: захват длится до PROFILE_MAX_SECONDS
+    await profile_lock.acquire()
+    asyncio.ensure_future(run_profile(message, seconds, deterministic))
+
+async def run_profile(message: types.Message, seconds, deterministic):
+    try:
+        mode = 'cProfile' if deterministic else 'сэмплирование'
+        await answer(message, f"🔬 Профилирую {seconds} с ({mode}), обработка апдейтов не останавливается")
+        
+        # Профиль снимается с потока event loop: пока эта задача спит,
+        # в него попадают все хендлеры, очередь отправки и Telethon
+        if deterministic:
+            collector = cProfile.Profile()
+            collector.enable()
+        else:
+            collector = StackSampler(threading.get_ident())
+            collector.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            if deterministic:
+                collector.disable()
+            else:
+                collector.stop()
+        
+        suffix = '.prof' if deterministic else '.folded'
+        fd, path = tempfile.mkstemp(prefix='profile-', suffix=suffix)
+        os.close(fd)
+        try:
+            # Сортировка и запись файла — в пуле потоков, чтобы не тормозить бота
+            summarize = summarize_profile if deterministic else summarize_samples
+            summary, total = await asyncio.get_event_loop().run_in_executor(None, summarize, collector, path)
+            await answer(
+                message,
+                f"🔬 **Профиль за {seconds} с** ({mode}, {total})\n```\n{summary[:3500]}\n```",
+                parse_mode='Markdown'
+            )
+            filename = f"profile-{int(time.time())}{suffix}"
+            chat_id = message.chat.id
+            await outbound.submit(
+                chat_id,
+                lambda: bot.send_document(chat_id, types.InputFile(path, filename=filename))
+            )
+        finally:
+            os.remove(path)
+    except Exception as e:
+        logger.error(f"❌ Ошибка профилирования: {e}")
+    finally:
+        profile_lock.release()
 
 # ========== ОБРАБОТКА ВСЕХ СООБЩЕНИЙ ==========
 @dp.message_handler()
@@ -632,7 +2994,7 @@ async def handle_all_messages(message: types.Message):
     if agent_match and is_admin(user):
         agent_username = agent_match.group(1)
         db.set_agent(agent_username)
-        await message.answer(f"✅ @{agent_username} назначен агентом")
+        await answer(message, f"✅ @{agent_username} назначен агентом")
         return
     
     if is_admin(user):
@@ -645,78 +3007,49 @@ async def handle_admin_addition(message: types.Message, text: str):
     if match and is_admin(message.from_user):
         new_admin_username = match.group(1)
         db.add_admin_by_username(new_admin_username)
-        await message.answer(f"✅ @{new_admin_username} добавлен как администратор")
+        await answer(message, f"✅ @{new_admin_username} добавлен как администратор")
 
 # ========== ОБРАБОТКА ДАННЫХ АДМИНА ==========
 async def handle_admin_data(message: types.Message, text: str):
     """Новая логика: обрабатываем ВСЕ данные из одного сообщения"""
     
-    # Извлекаем все данные из текста
-    extracted_data = {
-        'phone': None,
-        'amount': None,
-        'bank': None,
-        'email': None
-    }
+    # Несколько почт — вставлен блок реквизитов, разбираем его по записям
+    if text.count('sir+') > 1:
+        records = split_records(text)
+        if len(records) > 1:
+            await handle_bulk_data(message, records)
+            return
     
-    # 1. Поиск телефона
-    phone_match = re.search(r'\+7\d{10}', text)
-    if phone_match:
-        extracted_data['phone'] = phone_match.group()
-    
-    # 2. Поиск суммы с исправленной логикой
-    extracted_data['amount'] = extract_amount_from_text(text)
-    
-    # 3. Поиск банка
-    if '💚Сбер💚' in text:
-        extracted_data['bank'] = '💚Сбер💚'
-    elif '💛Тбанк💛' in text:
-        extracted_data['bank'] = '💛Тбанк💛'
-    elif '💛Т-Банк💛' in text:
-        extracted_data['bank'] = '💛Т-Банк💛'
-    elif 'Тинькофф' in text or 'Тиньков' in text or 'Т-банк' in text:
-        extracted_data['bank'] = '💛Тбанк💛'
-    
-    # 4. Поиск почты
-    email_match = re.search(r'sir\+\d+@outluk\.ru', text)
-    if email_match:
-        extracted_data['email'] = email_match.group()
+    # Извлекаем все данные из текста за один проход
+    extracted_data = extract_requisites(text)
     
     # Проверяем, есть ли все необходимые данные
     if extracted_data['email']:
         # Проверяем наличие всех обязательных полей
-        missing_fields = []
-        if not extracted_data.get('phone'): 
-            missing_fields.append("телефон (+7XXXXXXXXXX)")
-        if not extracted_data.get('amount'): 
-            missing_fields.append("сумма (например: 500!)")
-        if not extracted_data.get('bank'): 
-            missing_fields.append("банк (💚Сбер💚 или 💛Тбанк💛)")
+        missing_fields = missing_requisites(extracted_data)
         
         if missing_fields:
             error_msg = f"⚠️ Не хватает данных:\n"
             for item in missing_fields:
                 error_msg += f"• {item}\n"
-            await message.answer(error_msg)
+            await answer(message, error_msg)
             return
         
-        # Ищем реального агента
-        agents = db.get_agents()
-        agent_username = None
+        # Тот же апдейт ещё раз, пересланное или вставленное заново сообщение — не новая оплата
+        original = db.find_duplicate(extracted_data['phone'], extracted_data['amount'], extracted_data['email'],
+                                     message_key=(message.chat.id, message.message_id))
+        if original:
+            minutes = int((time.time() - original.timestamp) // 60)
+            logger.info(f"♻️ Повтор реквизитов: транзакция #{original.id}")
+            await answer(message,
+                         f"♻️ Эти реквизиты уже приняты {minutes} мин назад: транзакция #{original.id}, "
+                         f"{original.amount}₽, агент @{original.agent_username}, "
+                         f"чек {'отправлен' if original.receipt_sent else 'ещё не отправлен'}. "
+                         f"Новая транзакция не создана.")
+            return
         
-        if agents:
-            # Ищем агента, который не админ
-            for agent in agents:
-                if agent['role'] == 'agent':
-                    agent_username = agent['username']
-                    break
-            
-            # Если не нашли, берем первого
-            if not agent_username and agents:
-                agent_username = agents[0]['username']
-        else:
-            # Если нет агентов, используем запасное имя
-            agent_username = "agent"
+        # Агента выбирает планировщик по ASSIGN_POLICY; если агентов нет — запасное имя
+        agent_username = db.assign_agent() or "agent"
         
         await process_admin_data(message, extracted_data, agent_username)
 
@@ -729,7 +3062,9 @@ async def process_admin_data(message: types.Message, data: dict, agent_username:
         data['amount'],
         data['bank'],
         data['email'],
-        agent_username
+        agent_username,
+        chat_id=message.chat.id,
+        message_key=(message.chat.id, message.message_id)
     )
     
     # Получаем статистику
@@ -757,45 +3092,764 @@ async def process_admin_data(message: types.Message, data: dict, agent_username:
 
     keyboard = get_receipt_confirmation_keyboard(transaction['id'], agent_username)
     
-    await message.answer(stats_text, reply_markup=keyboard, parse_mode='Markdown')
+    # Не ждём доставки: три сообщения в группу упираются в её лимит, а порядок держит очередь
+    post_message(message.chat.id, stats_text, reply_markup=keyboard, parse_mode='Markdown')
     
-    # Отправляем уведомление агенту с премиум эмодзи
-    last_transaction = db.get_last_transaction_for_agent()
-    if last_transaction:
-        group_chat_id = message.chat.id
+    # Отправляем уведомление агенту с премиум эмодзи — именно по этой транзакции
+    if not notify_agent_about_receipt(agent_username, transaction, message.chat.id):
+        logger.error(f"❌ Не удалось отправить уведомление агенту @{agent_username}")
+
+async def handle_bulk_data(message: types.Message, records):
+    """Блок реквизитов: одна пачка транзакций, одна сводка админу и одно уведомление на агента"""
+    valid = []
+    problems = []
+    in_block = {}  # Отпечаток -> номер записи: повтор внутри самого блока
+    for number, record in enumerate(records, 1):
+        data = extract_requisites(record)
+        missing_fields = missing_requisites(data)
+        if missing_fields:
+            problems.append(f"⚠️ Запись {number}: нет — {', '.join(missing_fields)}")
+            continue
         
-        sent_message = await notify_agent_about_receipt(agent_username, last_transaction, group_chat_id)
-        if sent_message:
-            logger.info(f"✅ Уведомление отправлено агенту @{agent_username}")
-        else:
-            logger.error(f"❌ Не удалось отправить уведомление агенту @{agent_username}")
+        # Ключ сообщения с номером записи: повторная доставка блока отсекается целиком
+        message_key = (message.chat.id, message.message_id, number)
+        original = db.find_duplicate(data['phone'], data['amount'], data['email'], message_key=message_key)
+        if original:
+            problems.append(f"♻️ Запись {number}: уже принята как #{original.id}")
+            continue
+        fingerprint = requisites_fingerprint(data['phone'], data['amount'], data['email'])
+        if fingerprint in in_block:
+            problems.append(f"♻️ Запись {number}: повторяет запись {in_block[fingerprint]}")
+            continue
+        in_block[fingerprint] = number
+        valid.append((data, message_key))
+    
+    transactions = db.add_transactions(valid, chat_id=message.chat.id)
+    logger.info(f"📥 Блок реквизитов: {len(transactions)} из {len(records)} записей принято")
+    
+    stats = db.get_session_stats()
+    progress = min(100, int(stats['current'] / stats['target'] * 100)) if stats['target'] > 0 else 0
+    total = sum(tx.amount for tx in transactions)
+    lines = [f"📥 Принято {len(transactions)} из {len(records)} записей на {total}₽"]
+    lines += [f"#{tx.id}: {tx.amount}₽, {tx.bank}, {tx.email} → @{tx.agent_username}"
+              for tx in transactions[:BULK_SUMMARY_LINES]]
+    if len(transactions) > BULK_SUMMARY_LINES:
+        lines.append(f"… и ещё {len(transactions) - BULK_SUMMARY_LINES}")
+    lines += problems[:BULK_SUMMARY_LINES]
+    if len(problems) > BULK_SUMMARY_LINES:
+        lines.append(f"… и ещё {len(problems) - BULK_SUMMARY_LINES} записей не принято")
+    lines.append(f"\n📈 Сессия: {stats['current']}₽ из {stats['target']}₽ ({progress}%)")
+    # Без parse_mode: в username бывают '_'
+    post_message(message.chat.id, "\n".join(lines))
+    
+    by_agent = defaultdict(list)
+    for tx in transactions:
+        by_agent[tx.agent_username].append(tx)
+    for agent_username, agent_transactions in by_agent.items():
+        for start in range(0, len(agent_transactions), BULK_NOTIFY_CHUNK):
+            chunk = agent_transactions[start:start + BULK_NOTIFY_CHUNK]
+            text = "\n".join([f"💫 @{agent_username}, отправьте чеки ({len(chunk)} шт., {sum(tx.amount for tx in chunk)}₽):"]
+                             + [receipt_text(tx) for tx in chunk])
+            post_message(message.chat.id, text, PRIORITY_RECEIPT, reply_markup=get_bulk_receipt_keyboard(chunk))
+
+# ========== МАРШРУТИЗАЦИЯ CALLBACK ==========
+TOKEN_PREFIX = '~'
+TOKEN_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+def to_base62(number):
+    digits = []
+    while True:
+        number, digit = divmod(number, 62)
+        digits.append(TOKEN_ALPHABET[digit])
+        if not number:
+            return ''.join(reversed(digits))
+
+def from_base62(text):
+    number = 0
+    for char in text:
+        number = number * 62 + TOKEN_ALPHABET.index(char)
+    return number
+
+class CallbackTokens:
+    """
+    Короткие callback_data вида "~1aB3xYz". Полные данные кнопки разбираются один раз при выдаче,
+    в таблице лежит готовый (хендлер, аргументы): нажатие — один поиск в dict.
+    Таблица ограничена по размеру (вытесняются давно не нажимавшиеся) и по сроку жизни.
+    Счётчик начинается от текущего времени в мс, а после open() — не ниже последнего сохранённого
+    токена: иначе после рестарта или перевода часов назад новый токен совпал бы со старой кнопкой.
+    """
+    
+    def __init__(self, router, ttl=CALLBACK_TOKEN_TTL, capacity=CALLBACK_TOKEN_CAPACITY):
+        self.router = router
+        self.ttl = ttl
+        self.capacity = capacity
+        self.table = OrderedDict()  # токен -> (хендлер, аргументы, истекает)
+        self.counter = int(time.time() * 1000)
+        self.storage = None
+        self.expired = 0
+        self.prune_at = time.time() + CALLBACK_TOKEN_PRUNE_INTERVAL
+    
+    def _put(self, token, route, expires_at):
+        self.table[token] = (route[0], route[1], expires_at)
+        while len(self.table) > self.capacity:
+            self.table.popitem(last=False)
+    
+    def issue(self, data):
+        """Токен для полной callback_data (например "receipt_sent_12_username")"""
+        route = self.router.resolve(data)
+        if route is None:
+            raise ValueError(f"Нет маршрута для {data!r}")
+        
+        self.counter += 1
+        token = TOKEN_PREFIX + to_base62(self.counter)
+        expires_at = time.time() + self.ttl
+        self._put(token, route, expires_at)
+        if self.storage:
+            self.storage.save_callback_token(token, data, expires_at)
+        return token
+    
+    def resolve(self, token):
+        entry = self.table.get(token)
+        if entry is None:
+            return None
+        if entry[2] < time.time():
+            del self.table[token]
+            self.expired += 1
+            return None
+        self.table.move_to_end(token)
+        return entry[0], entry[1]
+    
+    def prune(self, now=None):
+        """Раз в CALLBACK_TOKEN_PRUNE_INTERVAL удаляет из SQLite просроченные токены — иначе таблица только растёт"""
+        now = time.time() if now is None else now
+        if now < self.prune_at:
+            return
+        self.prune_at = now + CALLBACK_TOKEN_PRUNE_INTERVAL
+        if self.storage:
+            self.storage.delete_expired_callback_tokens(now)
+    
+    def open(self, storage):
+        """Подхватывает токены, выданные до рестарта: кнопки в старых сообщениях продолжают работать"""
+        self.storage = storage
+        self.counter = max(self.counter, int(time.time() * 1000))
+        for token, data, expires_at in storage.load_callback_tokens(time.time()):
+            self.counter = max(self.counter, from_base62(token[len(TOKEN_PREFIX):]))
+            route = self.router.resolve(data)
+            if route:
+                self._put(token, route, expires_at)
+
+class CallbackRouter:
+    """
+    Один хендлер aiogram на все кнопки. Точные значения callback_data ищутся в словаре,
+    префиксы — в префиксном дереве по словам до '_' ("send_", "receipt_", "email_"),
+    так что разбор идёт один раз и не зависит от числа маршрутов.
+    Остаток после префикса делится на аргументы и приводится к типам.
+    """
+    
+    def __init__(self):
+        self.exact = {}
+        self.trie = {}
+        self.tokens = CallbackTokens(self)
+    
+    def route(self, key, *types):
+        """key с '_' на конце — префикс с аргументами types, иначе точное совпадение"""
+        def decorator(handler):
+            if key.endswith('_'):
+                node = self.trie
+                for word in key[:-1].split('_'):
+                    node = node.setdefault(word + '_', {})
+                node[None] = (handler, types)
+            else:
+                self.exact[key] = (handler, ())
+            return handler
+        return decorator
+    
+    def resolve(self, data):
+        """(хендлер, аргументы) или None, если кнопка неизвестна или данные не разобрать"""
+        route = self.exact.get(data)
+        if route:
+            return route
+        if data.startswith(TOKEN_PREFIX):
+            return self.tokens.resolve(data)
+        
+        # Самый длинный совпавший префикс: "send_receipt_email_" важнее "send_receipt_"
+        node = self.trie
+        match = None
+        start = 0
+        while True:
+            end = data.find('_', start) + 1
+            if not end:
+                break
+            node = node.get(data[start:end])
+            if node is None:
+                break
+            if None in node:
+                match = node[None], end
+            start = end
+        if match is None:
+            return None
+        
+        (handler, types), end = match
+        rest = data[end:]
+        # Последний аргумент забирает остаток: в username тоже бывает '_'
+        parts = rest.split('_', len(types) - 1)
+        if len(parts) != len(types) or not parts[-1]:
+            return None
+        try:
+            return handler, [cast(part) for cast, part in zip(types, parts)]
+        except ValueError:
+            return None
+    
+    async def dispatch(self, callback: types.CallbackQuery):
+        data = callback.data or ''
+        resolved = self.resolve(data)
+        if resolved is None:
+            if data.startswith(TOKEN_PREFIX):
+                return await callback.answer("⌛ Срок действия кнопки истёк, запросите сообщение заново",
+                                             show_alert=True)
+            return await callback.answer("⚠️ Кнопка устарела")
+        
+        handler, args = resolved
+        # В метриках — настоящий хендлер кнопки, а не общий dispatch
+        handler_name.set(handler.__name__)
+        data = ctx_data.get()
+        if data is not None:
+            data['metrics_handler'] = handler.__name__
+        await handler(callback, *args)
+
+callbacks = CallbackRouter()
+
+@dp.callback_query_handler()
+async def handle_callback(callback: types.CallbackQuery):
+    await callbacks.dispatch(callback)
+
+def edit_message(callback: types.CallbackQuery, text, **kwargs):
+    """Редактирует сообщение с кнопками через общую очередь, не дожидаясь правки: за лимитом группы хендлер кнопки не ждёт"""
+    message = callback.message
+    
+    async def edit():
+        try:
+            return await message.edit_text(text, **kwargs)
+        except MessageNotModified:
+            return None
+    
+    future = outbound.post(message.chat.id, edit, PRIORITY_MENU)
+    future.add_done_callback(lambda f: log_send_failure(message.chat.id, f))
+    return future
+
+def edit_markup(callback: types.CallbackQuery, reply_markup):
+    """Меняет только кнопки сообщения через общую очередь, не дожидаясь правки: за лимитом группы хендлер кнопки не ждёт"""
+    message = callback.message
+    
+    async def edit():
+        try:
+            return await message.edit_reply_markup(reply_markup)
+        except MessageNotModified:
+            return None
+    
+    future = outbound.post(message.chat.id, edit, PRIORITY_MENU)
+    future.add_done_callback(lambda f: log_send_failure(message.chat.id, f))
+    return future
+
+# ========== CALLBACK: МЕНЮ ==========
+MEDIA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')
+
+# Тексты разделов пишут администраторы бота. Пока их нет — явная заглушка, а не выдуманная инструкция;
+# медиа — файлы из media/ по смыслу имени
+HELP_TEXT_PLACEHOLDER = "[ЗАГЛУШКА] Текст раздела ещё не подготовлен, уточните у администратора."
+
+HELP_PAGES = {
+    'agent_form': ("📝 Анкета агента\n\n" + HELP_TEXT_PLACEHOLDER, 'example_screenshot.png'),
+    'send_receipt': ("🧾 Отправка чека\n\n" + HELP_TEXT_PLACEHOLDER, 'check.mp4'),
+    'subscribe': ("⭐️ Подключить подписку\n\n" + HELP_TEXT_PLACEHOLDER, None),
+    'agent_instructions': ("📖 Инструкция агента\n\n" + HELP_TEXT_PLACEHOLDER, 'instructions.mp4'),
+}
+
+# Поле в ответе Telegram -> метод отправки по file_id этого поля
+MEDIA_SENDERS = {'photo': 'send_photo', 'video': 'send_video', 'animation': 'send_animation',
+                 'document': 'send_document'}
+
+def file_id_rejected(error):
+    """BadRequest про сам file_id (чужой, устаревший, другого типа), а не про чат или подпись"""
+    return (isinstance(error, (WrongFileIdentifier, WrongRemoteFileIdSpecified))
+            or 'type of file mismatch' in str(error).lower())
+
+class MediaCache:
+    """
+    file_id уже загруженных в Telegram файлов по sha256 содержимого: файл грузится один раз,
+    дальше отправляется по file_id. Изменился файл — другой хеш, значит новая загрузка;
+    Telegram отверг file_id (например, сменился токен бота) — грузим заново и запоминаем новый.
+    mp4 Telegram может сохранить как animation или document — по file_id шлём тем же видом.
+    С DB_PATH file_id переживают рестарт.
+    """
+    
+    def __init__(self):
+        self.file_ids = {}   # (sha256, вид) -> (поле в ответе Telegram, file_id)
+        self._hashes = {}    # путь -> (mtime_ns, размер, sha256): не перечитываем неизменённый файл
+        self._uploads = {}   # (sha256, вид) -> future идущей загрузки
+        self.storage = None
+        self.uploaded = 0
+        self.reused = 0
+        self.rejected = 0
+    
+    def open(self, storage):
+        self.storage = storage
+        for sha256, field, file_id in storage.load_media_file_ids():
+            self.file_ids[sha256, 'photo' if field == 'photo' else 'video'] = (field, file_id)
+    
+    @staticmethod
+    def _sha256(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    
+    async def digest(self, path):
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+            return cached[2]
+        # Видео — мегабайты: читаем вне event loop
+        sha256 = await asyncio.get_event_loop().run_in_executor(None, self._sha256, path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, sha256)
+        return sha256
+    
+    @staticmethod
+    def _sent_file(result):
+        """(поле, file_id) файла в ответе на отправку — под каким видом Telegram его сохранил"""
+        if result.photo:
+            return 'photo', result.photo[-1].file_id
+        for field in ('video', 'animation', 'document'):
+            media = getattr(result, field)
+            if media:
+                return field, media.file_id
+        return None
+    
+    async def send(self, chat_id, path, caption, priority=PRIORITY_MENU):
+        kind = 'photo' if path.endswith('.png') else 'video'
+        method = bot.send_photo if kind == 'photo' else bot.send_video
+        key = (await self.digest(path), kind)
+        
+        if key not in self.file_ids and key in self._uploads:
+            # Этот же файл сейчас грузится для другого чата — ждём его file_id
+            await asyncio.wait([self._uploads[key]])
+        
+        cached = self.file_ids.get(key)
+        if cached:
+            field, file_id = cached
+            send_cached = getattr(bot, MEDIA_SENDERS[field])
+            try:
+                result = await outbound.submit(chat_id, lambda: send_cached(chat_id, file_id, caption=caption),
+                                               priority)
+                self.reused += 1
+                return result
+            except BadRequest as e:
+                # Ошибка про чат или подпись повторится и при загрузке — файл тут ни при чём
+                if not file_id_rejected(e):
+                    raise
+                logger.warning(f"⚠️ Telegram отверг file_id для {os.path.basename(path)} ({e}), загружаем заново")
+                self.rejected += 1
+                if self.file_ids.get(key) == cached:
+                    del self.file_ids[key]
+        
+        upload = self._uploads[key] = asyncio.get_event_loop().create_future()
+        try:
+            result = await outbound.submit(
+                chat_id, lambda: method(chat_id, types.InputFile(path), caption=caption), priority)
+            sent = self._sent_file(result)
+            if sent:
+                self.file_ids[key] = sent
+                if self.storage:
+                    self.storage.save_media_file_id(key[0], *sent)
+            self.uploaded += 1
+            logger.info(f"📤 {os.path.basename(path)} загружен в Telegram, дальше отправляется по file_id")
+            return result
+        finally:
+            upload.set_result(None)
+            if self._uploads.get(key) is upload:
+                del self._uploads[key]
+
+media_cache = MediaCache()
+
+async def send_help_media(chat_id, filename, caption):
+    path = os.path.join(MEDIA_DIR, filename)
+    if not os.path.exists(path):
+        logger.warning(f"⚠️ Нет файла {path}, отправляем только текст")
+        return await send_message(chat_id, caption, PRIORITY_MENU)
+    
+    return await media_cache.send(chat_id, path, caption)
+
+def main_menu_text(chat):
+    if chat.type in [ChatType.GROUP, ChatType.SUPERGROUP]:
+        return "🤖 Бот помощник активирован в этой группе!"
+    return "Вы в главном меню, есть вопросы? Жми кнопки снизу, возможно там есть ответ на ваш вопрос."
+
+@callbacks.route('back_to_main')
+async def back_to_main_callback(callback: types.CallbackQuery):
+    await callback.answer()
+    edit_message(callback, main_menu_text(callback.message.chat), reply_markup=get_main_menu())
+
+@callbacks.route('help')
+async def help_callback(callback: types.CallbackQuery):
+    await callback.answer()
+    edit_message(callback, "📋 Раздел помощи:", reply_markup=get_help_menu())
+
+@callbacks.route('agent_form')
+@callbacks.route('send_receipt')
+@callbacks.route('subscribe')
+@callbacks.route('agent_instructions')
+async def help_page_callback(callback: types.CallbackQuery):
+    await callback.answer()
+    text, filename = HELP_PAGES[callback.data]
+    if filename:
+        await send_help_media(callback.message.chat.id, filename, text)
+    else:
+        await send_message(callback.message.chat.id, text, PRIORITY_MENU)
+
+@callbacks.route('members')
+@callbacks.route('back_to_members')
+async def members_callback(callback: types.CallbackQuery):
+    await callback.answer()
+    await show_members(callback)
+
+async def show_members(callback: types.CallbackQuery):
+    is_admin_user = is_admin(callback.from_user)
+    edit_message(callback, "👥 Список участников:",
+                       reply_markup=get_members_menu(show_delete=is_admin_user, show_agent_stats=is_admin_user))
+
+@callbacks.route('none')
+async def noop_callback(callback: types.CallbackQuery):
+    await callback.answer()
+
+def back_keyboard(callback_data):
+    return InlineKeyboardMarkup().add(InlineKeyboardButton("« Назад", callback_data=callback_data))
+
+@callbacks.route('view_', str)
+async def view_user_callback(callback: types.CallbackQuery, username):
+    await callback.answer()
+    user = db.get_user_by_username(username)
+    if not user:
+        edit_message(callback, f"⚠️ @{username} не найден", reply_markup=back_keyboard('back_to_members'))
+        return
+    
+    role_icon = "👑" if user['role'] == 'admin' else "👤"
+    text = f"{role_icon} @{user['username']}\nИмя: {user['full_name']}\nРоль: {user['role']}"
+    edit_message(callback, text, reply_markup=back_keyboard('back_to_members'))
+
+# ========== CALLBACK: АГЕНТЫ (только админы) ==========
+def agent_stats_text(username):
+    stats = db.get_agent_stats(username)
+    lines = [
+        f"📊 Статистика @{username}",
+        f"Оборот: {stats['total_amount']}₽, операций: {stats['transaction_count']}",
+        f"Ждут чека: {db.scheduler.outstanding.get(username, 0)}",
+    ]
+    for bank, amount in stats['by_bank'].items():
+        lines.append(f"• {bank}: {amount}₽")
+    if stats['last_transactions']:
+        lines.append("\nПоследние операции:")
+        for tx in reversed(stats['last_transactions']):
+            mark = "✅" if tx.receipt_sent else "⏳"
+            lines.append(f"{mark} #{tx.id} {tx.amount}₽ {tx.bank} {tx.email}")
+    return "\n".join(lines)
 
-# ========== CALLBACK ОБРАБОТЧИКИ (остальные функции) ==========
-# [ВСТАВЬТЕ ЗДЕСЬ ВСЕ ОСТАЛЬНЫЕ ФУНКЦИИ ИЗ ВАШЕГО ПРЕДЫДУЩЕГО КОДА]
-# Все функции начиная с @dp.callback_query_handler(lambda c: c.data.startswith('confirm_receipt_'))
-# до конца файла
+async def deny_non_admin(callback: types.CallbackQuery):
+    """True, если нажал не админ (ему уже ответили)"""
+    if is_admin(callback.from_user):
+        return False
+    await callback.answer("⚠️ Только для администраторов", show_alert=True)
+    return True
+
+@callbacks.route('agents_stats')
+async def agents_stats_callback(callback: types.CallbackQuery):
+    if await deny_non_admin(callback):
+        return
+    await callback.answer()
+    edit_message(callback, "📈 Статистика агентов:", reply_markup=get_agents_stats_menu())
+
+@callbacks.route('agent_stats_', str)
+async def agent_stats_callback(callback: types.CallbackQuery, username):
+    if await deny_non_admin(callback):
+        return
+    await callback.answer()
+    edit_message(callback, agent_stats_text(username), reply_markup=back_keyboard('back_to_members'))
+
+@callbacks.route('agent_detail_', str)
+async def agent_detail_callback(callback: types.CallbackQuery, username):
+    if await deny_non_admin(callback):
+        return
+    await callback.answer()
+    edit_message(callback, agent_stats_text(username), reply_markup=back_keyboard('agents_stats'))
+
+@callbacks.route('delete_agent_menu')
+async def delete_agent_menu_callback(callback: types.CallbackQuery):
+    if await deny_non_admin(callback):
+        return
+    await callback.answer()
+    edit_message(callback, "❌ Кого удалить из агентов?", reply_markup=get_delete_agents_menu())
+
+@callbacks.route('delete_', str)
+async def delete_agent_callback(callback: types.CallbackQuery, username):
+    if await deny_non_admin(callback):
+        return
+    if db.delete_agent(username):
+        await callback.answer(f"✅ @{username} больше не агент")
+    else:
+        await callback.answer(f"⚠️ @{username} не агент")
+    edit_message(callback, "❌ Кого удалить из агентов?", reply_markup=get_delete_agents_menu())
+
+@callbacks.route('delete_all_confirm')
+async def delete_all_confirm_callback(callback: types.CallbackQuery):
+    if await deny_non_admin(callback):
+        return
+    await callback.answer()
+    edit_message(callback, f"🗑️ Удалить всех агентов ({len(db.agents)})?",
+                       reply_markup=get_confirmation_keyboard())
+
+@callbacks.route('confirm_delete_all')
+async def confirm_delete_all_callback(callback: types.CallbackQuery):
+    if await deny_non_admin(callback):
+        return
+    count = len(db.agents)
+    db.delete_all_agents()
+    await callback.answer(f"✅ Удалено агентов: {count}")
+    await show_members(callback)
+
+@callbacks.route('cancel_delete')
+async def cancel_delete_callback(callback: types.CallbackQuery):
+    await members_callback(callback)
+
+# ========== CALLBACK: ЧЕКИ ==========
+def receipt_text(transaction):
+    return f"#{transaction.id}: {transaction.amount}₽, {transaction.bank}, {transaction.email}"
+
+async def complete_receipt(callback: types.CallbackQuery, transaction_id, agent_username, confirmed_by):
+    """Отмечает чек отправленным; False — если кнопка уже неактуальна (ответ дан)"""
+    transaction = db.transactions_by_id.get(transaction_id)
+    if not transaction:
+        await callback.answer("⚠️ Транзакция не найдена", show_alert=True)
+        return False
+    if transaction.receipt_sent:
+        await callback.answer("✅ Чек уже отмечен отправленным")
+        return False
+    if not db.mark_receipt_sent(transaction_id, agent_username):
+        # После эскалации чек мог перейти к другому агенту
+        await callback.answer(f"⚠️ Чек передан @{transaction.agent_username}", show_alert=True)
+        return False
+    
+    await callback.answer("✅ Отмечено")
+    edit_message(callback, f"✅ Чек {receipt_text(transaction)} отправлен агентом @{agent_username}"
+                                 f"\nПодтвердил: @{confirmed_by}")
+    return True
+
+@callbacks.route('receipt_sent_', int, str)
+async def receipt_sent_callback(callback: types.CallbackQuery, transaction_id, agent_username):
+    """Агент сообщает, что отправил чек"""
+    username = callback.from_user.username or ""
+    if username != agent_username and not is_admin(callback.from_user):
+        return await callback.answer(f"⚠️ Это кнопка для @{agent_username}", show_alert=True)
+    
+    if await complete_receipt(callback, transaction_id, agent_username, username or callback.from_user.full_name):
+        logger.info(f"✅ @{username} отметил чек #{transaction_id} отправленным")
+
+@callbacks.route('receipt_row_', int, str)
+async def receipt_row_callback(callback: types.CallbackQuery, transaction_id, agent_username):
+    """Чек из сводного уведомления: отмечаем и убираем его строку, остальные кнопки остаются"""
+    username = callback.from_user.username or ""
+    if username != agent_username and not is_admin(callback.from_user):
+        return await callback.answer(f"⚠️ Это кнопка для @{agent_username}", show_alert=True)
+    
+    transaction = db.transactions_by_id.get(transaction_id)
+    if not transaction:
+        return await callback.answer("⚠️ Транзакция не найдена", show_alert=True)
+    if not transaction.receipt_sent and not db.mark_receipt_sent(transaction_id, agent_username):
+        return await callback.answer(f"⚠️ Чек передан @{transaction.agent_username}", show_alert=True)
+    
+    await callback.answer(f"✅ Чек #{transaction_id} отмечен")
+    logger.info(f"✅ @{username} отметил чек #{transaction_id} отправленным")
+    markup = callback.message.reply_markup
+    rows = [row for row in (markup.inline_keyboard if markup else [])
+            if all(button.callback_data != callback.data for button in row)]
+    if rows:
+        edit_markup(callback, InlineKeyboardMarkup(inline_keyboard=rows))
+    else:
+        edit_message(callback, f"✅ Все чеки из списка отправлены (@{agent_username})")
+
+@callbacks.route('receipt_problem_', int, str)
+async def receipt_problem_callback(callback: types.CallbackQuery, transaction_id, agent_username):
+    """Агент не может отправить чек: зовём админов, чек остаётся в ожидании"""
+    username = callback.from_user.username or ""
+    if username != agent_username and not is_admin(callback.from_user):
+        return await callback.answer(f"⚠️ Это кнопка для @{agent_username}", show_alert=True)
+    
+    transaction = db.transactions_by_id.get(transaction_id)
+    if not transaction or transaction.receipt_sent:
+        return await callback.answer("⚠️ Чек уже не ждёт отправки", show_alert=True)
+    
+    await callback.answer("Администраторы получат сообщение")
+    admins = " ".join(f"@{admin}" for admin in sorted(active_admins))
+    await send_message(
+        callback.message.chat.id,
+        f"⚠️ У @{agent_username} проблема с отправкой чека {receipt_text(transaction)}\n{admins}",
+        PRIORITY_RECEIPT,
+        reply_markup=get_receipt_confirmation_keyboard(transaction_id, agent_username)
+    )
+
+@callbacks.route('confirm_receipt_', int, str)
+async def confirm_receipt_callback(callback: types.CallbackQuery, transaction_id, agent_username):
+    """Админ подтверждает, что чек отправлен"""
+    if await deny_non_admin(callback):
+        return
+    await complete_receipt(callback, transaction_id, agent_username,
+                           callback.from_user.username or callback.from_user.full_name)
+
+@callbacks.route('send_receipt_email_', int, str)
+async def send_receipt_email_callback(callback: types.CallbackQuery, transaction_id, agent_username):
+    """Админ повторно просит агента отправить чек на почту"""
+    if await deny_non_admin(callback):
+        return
+    
+    transaction = db.transactions_by_id.get(transaction_id)
+    if not transaction:
+        return await callback.answer("⚠️ Транзакция не найдена", show_alert=True)
+    if transaction.receipt_sent:
+        return await callback.answer("✅ Чек уже отправлен")
+    
+    await callback.answer("📧 Напоминание отправлено агенту")
+    notify_agent_about_receipt(transaction.agent_username, transaction, callback.message.chat.id)
+
+# ========== СЕРВЕР МЕТРИК ==========
+metrics.register(CollectedMetric('bot_users', 'Пользователей в базе', lambda: len(db.users)))
+metrics.register(CollectedMetric('bot_agents', 'Агентов', lambda: len(db.agents)))
+metrics.register(CollectedMetric('bot_transactions', 'Транзакций в памяти', lambda: len(db.transactions)))
+metrics.register(CollectedMetric('bot_receipts_pending', 'Неотправленных чеков', lambda: len(db.receipts.pending)))
+metrics.register(CollectedMetric(
+    'bot_agent_outstanding', 'Неотправленных чеков по агентам',
+    lambda: {(username,): count for username, count in db.scheduler.outstanding.items()}, ('agent',)))
+metrics.register(CollectedMetric(
+    'bot_storage_queue', 'Операций в очереди записи SQLite',
+    lambda: db.storage.pending() if db.storage else 0))
+metrics.register(CollectedMetric('bot_outbound_queue', 'Сообщений в очереди отправки', lambda: outbound.depth()))
+metrics.register(CollectedMetric('bot_pipeline_pending', 'Апдейтов в конвейере (ждут и в работе)', lambda: pipeline.pending))
+metrics.register(CollectedMetric('bot_pipeline_busy', 'Апдейтов в обработке', lambda: pipeline.busy))
+metrics.register(CollectedMetric(
+    'bot_pipeline_total', 'Итоги конвейера апдейтов',
+    lambda: {('processed',): pipeline.processed, ('throttled',): pipeline.throttled},
+    ('result',), kind='counter'))
+metrics.register(CollectedMetric(
+    'bot_outbound_total', 'Итоги очереди отправки',
+    lambda: {(result,): outbound.stats()[result] for result in ('sent', 'retried', 'failed')},
+    ('result',), kind='counter'))
+
+metrics_runner = None
+
+async def metrics_handler(request):
+    return web.Response(text=metrics.render(), content_type='text/plain')
+
+async def start_metrics_server():
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
 
 # ========== ЗАПУСК ==========
 async def on_startup(dp):
     logger.info("🤖 БОТ ЗАПУЩЕН")
     
-    # Запускаем Telethon клиент если есть
-    if telethon_client and API_ID and API_HASH:
+    # Восстанавливаем состояние из SQLite
+    if DB_PATH:
+        db.open(SQLiteStorage(DB_PATH))
+        callbacks.tokens.open(db.storage)
+        media_cache.open(db.storage)
+        logger.info(f"💾 Данные хранятся в {os.path.abspath(DB_PATH)}")
+    else:
+        logger.warning("⚠️ DB_PATH не задан: данные хранятся только в памяти и пропадут при перезапуске")
+    
+    global receipt_watchdog_task
+    receipt_watchdog_task = asyncio.ensure_future(receipt_watchdog())
+    
+    if METRICS_PORT:
         try:
-            await telethon_client.start(bot_token=BOT_TOKEN)
-            logger.info("✅ Telethon клиент запущен")
-        except Exception as e:
-            logger.error(f"❌ Ошибка запуска Telethon: {e}")
+            await start_metrics_server()
+        except OSError as e:
+            logger.error(f"❌ Не удалось запустить сервер метрик: {e}")
+    
+    # Telethon подключается в фоне: апдейты принимаем сразу
+    if telethon_transport:
+        await telethon_transport.start()
 
 async def on_shutdown(dp):
     logger.info("❌ Бот выключается...")
-    if telethon_client:
-        await telethon_client.disconnect()
+    if receipt_watchdog_task:
+        receipt_watchdog_task.cancel()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+    await outbound.close()
+    if telethon_transport:
+        await telethon_transport.stop()
+    
+    # Дожидаемся записи хвоста очереди, не блокируя event loop
+    await asyncio.get_event_loop().run_in_executor(None, db.close)
 
-if __name__ == '__main__':
-    executor.start_polling(
+# ========== WEBHOOK ==========
+def create_webhook_app():
+    """aiohttp-приложение для webhook: запросы без верного секрета отсекаются до обработки"""
+    
+    @web.middleware
+    async def check_secret(request, handler):
+        if WEBHOOK_SECRET and request.path == WEBHOOK_PATH:
+            token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(token, WEBHOOK_SECRET):
+                logger.warning(f"⚠️ Webhook-запрос с неверным секретом от {request.remote}")
+                raise web.HTTPUnauthorized()
+        return await handler(request)
+    
+    return web.Application(middlewares=[check_secret])
+
+async def on_startup_webhook(dp):
+    await on_startup(dp)
+    
+    # Самоподписанный сертификат нужно передать Telegram вместе с адресом
+    certificate = types.InputFile(WEBHOOK_SSL_CERT) if WEBHOOK_SSL_CERT else None
+    await bot.set_webhook(
+        WEBHOOK_HOST + WEBHOOK_PATH,
+        certificate=certificate,
+        secret_token=WEBHOOK_SECRET or None
+    )
+    logger.info(f"✅ Webhook установлен: {WEBHOOK_HOST}{WEBHOOK_PATH}")
+
+def start_webhook():
+    if not WEBHOOK_HOST:
+        logger.error("❌ WEBHOOK_HOST не установлен!")
+        exit(1)
+    
+    ssl_context = None
+    if WEBHOOK_SSL_CERT and WEBHOOK_SSL_KEY:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+    
+    # Накопившиеся за время рестарта обновления не пропускаем
+    webhook = executor.set_webhook(
         dp,
-        skip_updates=True,
-        on_startup=on_startup,
-        on_shutdown=on_shutdown
+        WEBHOOK_PATH,
+        skip_updates=False,
+        on_startup=on_startup_webhook,
+        on_shutdown=on_shutdown,
+        web_app=create_webhook_app()
     )
+    webhook.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT, ssl_context=ssl_context)
+
+if __name__ == '__main__':
+    if RUN_MODE == 'webhook':
+        start_webhook()
+    else:
+        executor.start_polling(
+            dp,
+            skip_updates=True,
+            on_startup=on_startup,
+            on_shutdown=on_shutdown
+        )